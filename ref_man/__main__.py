@@ -10,8 +10,15 @@ def main():
     parser = argparse.ArgumentParser("ref-man")
     parser.add_argument("--no-threaded", dest="threaded", action="store_false",
                         help="Whether flask server should be threaded or not")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of worker processes. More than one starts " +
+                        "the server in pre-forked multi worker mode")
     parser.add_argument("--port", "-p", type=int, default=9999,
                         help="Port to bind to the python server")
+    parser.add_argument("--unix-socket", dest="unix_socket", type=str, default="",
+                        help="Also listen on a Unix domain socket at this path")
+    parser.add_argument("--no-tcp", dest="tcp", action="store_false",
+                        help="Don't listen on the TCP port. Requires --unix-socket")
     parser.add_argument("--proxy-port", dest="proxy_port", type=int, default=0,
                         help="HTTP proxy server port for method 'fetch_proxy'")
     parser.add_argument("--proxy-everything", dest="proxy_everything", action="store_true",
@@ -19,22 +26,66 @@ def main():
     parser.add_argument("--proxy-everything-port", dest="proxy_everything_port",
                         type=int, default=0,
                         help="HTTP proxy server port if proxy_everything is given")
+    parser.add_argument("--proxy-check-interval", dest="proxy_check_interval",
+                        type=float, default=10,
+                        help="Seconds between background health checks of the proxies")
     parser.add_argument("--data-dir", "-d", dest="data_dir", type=str,
                         default=os.path.expanduser("~"),
                         help="Semantic Scholar cache directory")
+    parser.add_argument("--cache-budget", dest="cache_budget", type=float, default=0,
+                        help="Disk budget in MiB for the Semantic Scholar cache. " +
+                        "Least recently read papers are evicted beyond it. 0 means no limit")
+    parser.add_argument("--no-cache-fsync", dest="cache_fsync", action="store_false",
+                        help="Don't sync writes to the Semantic Scholar cache to disk")
+    parser.add_argument("--events-keepalive", dest="events_keepalive", type=float, default=15,
+                        help="Seconds after which an idle /events stream sends a keepalive")
+    parser.add_argument("--evict-interval", dest="evict_interval", type=float, default=600,
+                        help="Seconds between checks of the Semantic Scholar cache size")
+    parser.add_argument("--org-dirs", dest="org_dirs", type=str, default="",
+                        help="Comma separated directories with org files. Papers " +
+                        "referred to in them are never evicted from the cache")
     parser.add_argument("--local-pdfs-dir", dest="local_pdfs_dir", type=str,
                         default=os.path.expanduser("~/pdfs"),
                         help="Local directory where pdfs are stored")
+    parser.add_argument("--pdf-index-processes", dest="pdf_index_processes", type=int,
+                        default=0, help="Processes for extracting metadata from local pdfs. " +
+                        "Defaults to the number of CPUs")
     parser.add_argument("--remote-pdfs-dir", dest="remote_pdfs_dir", type=str,
                         default="", help="Remote rclone pdfs directory")
     parser.add_argument("--remote-links-cache", dest="remote_links_cache", type=str,
                         default="", help="Remote links cache file")
+    parser.add_argument("--job-retention", dest="job_retention", type=float, default=3600,
+                        help="Seconds for which results of finished batch jobs are kept")
+    parser.add_argument("--threads", type=int, default=32,
+                        help="Threads for upstream requests in each worker, shared by " +
+                        "interactive, bulk and background requests")
     parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, default=16,
-                        help="Simultaneous connections to DBLP")
+                        help="Initial simultaneous connections to each upstream. " +
+                        "Adapted to the latency and errors of each")
+    parser.add_argument("--max-concurrency", dest="max_concurrency", type=int, default=64,
+                        help="Maximum simultaneous connections to any upstream")
+    parser.add_argument("--rate-limits", dest="rate_limits", type=str, default="",
+                        help="Comma separated maximum requests per second of upstreams " +
+                        "by name or host, e.g., \"dblp=5,export.arxiv.org=1\"")
+    parser.add_argument("--max-attempts", dest="max_attempts", type=int, default=3,
+                        help="Maximum attempts for each query of a batch")
+    parser.add_argument("--retry-backoff", dest="retry_backoff", type=float, default=0.5,
+                        help="Maximum seconds before the first retry of a failed query " +
+                        "of a batch, doubled for each retry and jittered")
     parser.add_argument("--chrome-debugger-path", dest="chrome_debugger_path", type=str,
                         default="",
                         help="Path to chrome debugger script which can validate " +
                         "Semantic Scholar Search params (optional)")
+    parser.add_argument("--debug-endpoints", dest="debug_endpoints", action="store_true",
+                        help="Enable the /debug endpoints for tracing and profiling")
+    parser.add_argument("--trace-file", dest="trace_file", type=str, default="",
+                        help="File to which sampled and slow request traces are written " +
+                        "in Chrome trace event format. Enables tracing")
+    parser.add_argument("--trace-sample", dest="trace_sample", type=float, default=0.01,
+                        help="Fraction of request traces written to the trace file")
+    parser.add_argument("--trace-slow-ms", dest="trace_slow_ms", type=float, default=1000,
+                        help="Requests slower than this are always traced and kept " +
+                        "for /debug/traces")
     parser.add_argument("--verbosity", "-v", type=str, default="info",
                         help="Verbosity level. One of [error, info, debug]")
     parser.add_argument("--version", action="store_true",
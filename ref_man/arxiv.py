@@ -1,83 +1,124 @@
-from typing import Dict, List
+from typing import Dict, List, Any, Iterator
+import re
 import json
 import requests
 from queue import Queue
 from functools import partial
-from bs4 import BeautifulSoup
+from urllib.parse import quote
 
+from .const import upstream
 from .q_helper import q_helper
+from .bibtex import from_dict, first_word_key
+from .atom import iter_entries
+from .tracing import tracer
+from .concurrency import limits
 
 
-# TODO: There should be a cache of entries
 def dict_to_bibtex(bib_dict: Dict[str, str], json_out: bool = False):
-    temp = bib_dict.copy()
-    if "author" in temp:
-        k = "author"
-    elif "authors" in temp:
-        k = "authors"
-    else:
+    """Convert `bib_dict` to a BibTeX string.
+
+    See :func:`~ref_man.bibtex.from_dict`. The citation key is generated with
+    :func:`~ref_man.bibtex.first_word_key` so that existing keys don't change.
+
+    """
+    entry = from_dict(bib_dict, first_word_key)
+    if entry is None:
         return None
-    if isinstance(temp[k], str):
-        temp[k].split(" ")[-1].lower() + temp["year"] +\
-            temp["title"].split(" ")[0].lower()
-    else:
-        key = temp[k][0].split(" ")[-1].lower() + temp["year"] +\
-            temp["title"].split(" ")[0].lower()
-    bib = "@" + temp.pop("type") + "{" + key + "\n"
-    for k, v in temp.items():
-        if k in {"author", "authors"}:
-            if isinstance(v, list):
-                authors = [", ".join([_.split(" ")[-1], " ".join(_.split(" ")[:-1])])
-                           for _ in v]
-                bib += "  author" + "={" + " and ".join(authors) + "},\n"
-            elif isinstance(v, str):
-                bib += "  author" + "={" + v + "},\n"
-        else:
-            bib += "  " + k + "={" + v + "},\n"
-    bib = bib[:-2]
-    bib += "\n}"
+    bib = entry.render(entry.base_key)
     if json_out:
         return json.dumps(bib)
     else:
         return bib
 
 
+def _bib_dict(entry: Dict[str, Any], entry_type: str) -> Dict[str, Any]:
+    return {"abstract": entry["abstract"], "title": entry["title"],
+            "authors": entry["authors"], "year": entry["year"],
+            "url": entry["url"], "type": entry_type}
+
+
+def _match_entries(query: str, entries: Iterator[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Match `entries` of a feed to the ids in `query`.
+
+    `query` can be a single arXiv id or comma separated ids, with or without
+    versions.
+
+    """
+    ids = {re.sub(r"v\d+$", "", x.strip()): x.strip() for x in query.split(",") if x.strip()}
+    matched = {}
+    for entry in entries:
+        if "error" not in entry and entry["id"] in ids:
+            matched[ids[entry["id"]]] = entry
+    return matched
+
+
 def arxiv_get(arxiv_id: str) -> str:
     """Fetch details of article with arxiv_id from arxiv api.
 
+    The response is parsed incrementally as it's downloaded.
+
     Args:
         arxiv_id: The Arxiv ID of the article
 
     """
-    response = requests.get("http://export.arxiv.org/api/query?id_list={arxiv_id}")
-    soup = BeautifulSoup(response.content, features="lxml")
-    entry = soup.find("entry")
-    abstract = entry.find("summary").text
-    title = entry.find("title").text
-    authors = [a.text for a in entry.find_all("author")]
-    date = entry.find("published").text
-    bib_dict = {"abstract": abstract.replace("\n", " ").strip(), "title": title,
-                "authors": [a.replace("\n", " ").strip() for a in authors], "year": date[:4],
-                "url": f"https://arxiv.org/abs/{arxiv_id}", "type": "article"}
-    if bib_dict:
-        return dict_to_bibtex(bib_dict, True)
+    # The response is parsed as it's read, so the span covers both
+    with tracer.span("arxiv_fetch", "arxiv", ids=arxiv_id):
+        response = limits.get(f"{upstream['arxiv']}/api/query?id_list={arxiv_id}",
+                              stream=True)
+        entries = _match_entries(arxiv_id, iter_entries(response.iter_content(65536)))
+    if arxiv_id in entries:
+        return dict_to_bibtex(_bib_dict(entries[arxiv_id], "article"), True)
     else:
         return json.dumps("ERROR RETRIEVING")
 
 
+def arxiv_lookup(ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetch the entries for many arXiv `ids` in one request.
+
+    Returns:
+        Entries as parsed by :func:`~ref_man.atom.parse_entry` keyed by the
+        ids as given. Ids which weren't found are missing.
+
+    """
+    with tracer.span("arxiv_fetch", "arxiv", ids=len(ids)):
+        response = limits.get(f"{upstream['arxiv']}/api/query?id_list={','.join(ids)}" +
+                              f"&max_results={len(ids)}", stream=True)
+        response.raise_for_status()
+        return _match_entries(",".join(ids), iter_entries(response.iter_content(65536)))
+
+
+def arxiv_search(title: str, max_results: int = 5) -> List[Dict[str, Any]]:
+    """Search arXiv for papers with `title`.
+
+    Returns:
+        Entries as parsed by :func:`~ref_man.atom.parse_entry` in the order of
+        relevance.
+
+    """
+    words = re.findall(r"\w+", title)
+    query = quote("ti:\"" + " ".join(words) + "\"")
+    with tracer.span("arxiv_search", "arxiv", title=title):
+        response = limits.get(f"{upstream['arxiv']}/api/query?search_query={query}" +
+                              f"&max_results={max_results}", stream=True)
+        response.raise_for_status()
+        return [x for x in iter_entries(response.iter_content(65536)) if "error" not in x]
+
+
 def _arxiv_success(query: str, response: requests.Response,
-                   content: Dict[str, Dict]):
-    soup = BeautifulSoup(response.content, features="lxml")
-    entry = soup.find("entry")
-    abstract = entry.find("summary").text
-    title = entry.find("title").text
-    authors = [a.text for a in entry.find_all("author")]
-    date = entry.find("published").text
-    bib_dict = {"abstract": abstract.replace("\n", " ").strip(), "title": title,
-                "authors": [a.replace("\n", " ").strip() for a in authors],
-                "year": date[:4],
-                "url": f"https://arxiv.org/abs/{query}", "type": "misc"}
-    content[query] = dict_to_bibtex(bib_dict)
+                   content: Dict[str, Any]):
+    """Handle HTTP status 200 for `query` from arXiv.
+
+    `query` can be comma separated ids in which case there's a result for
+    each id.
+
+    """
+    with tracer.span("arxiv_parse", "arxiv", ids=query):
+        entries = _match_entries(query, iter_entries(response.content))
+    for arxiv_id in filter(None, (x.strip() for x in query.split(","))):
+        if arxiv_id in entries:
+            content[arxiv_id] = dict_to_bibtex(_bib_dict(entries[arxiv_id], "misc"))
+        else:
+            content[arxiv_id] = ["NO_RESULT"]
 
 
 def _arxiv_no_result(query: str, response: requests.Response,
@@ -95,7 +136,8 @@ def arxiv_fetch(arxiv_id: str, q: Queue, ret_type: str = "json",
     if verbose:
         print(f"Fetching for arxiv_id {arxiv_id}\n")
     if ret_type == "json":
-        response = requests.get("http://export.arxiv.org/api/query?id_list={arxiv_id}")
+        with tracer.span("arxiv_fetch", "arxiv", ids=arxiv_id):
+            response = limits.get(f"{upstream['arxiv']}/api/query?id_list={arxiv_id}")
         q.put((arxiv_id, response))
     else:
         q.put((arxiv_id, "INVALID"))
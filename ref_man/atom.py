@@ -0,0 +1,106 @@
+from typing import Dict, Iterator, Iterable, Union, Any, IO
+import re
+from xml.etree import ElementTree
+
+
+ns = {"atom": "http://www.w3.org/2005/Atom",
+      "arxiv": "http://arxiv.org/schemas/atom",
+      "opensearch": "http://a9.com/-/spec/opensearch/1.1/"}
+_atom = "{" + ns["atom"] + "}"
+_arxiv = "{" + ns["arxiv"] + "}"
+_id_regexp = re.compile(r"arxiv\.org/abs/(.+?)(v(\d+))?$")
+
+
+def _text(elem, tag: str) -> str:
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return ""
+    return " ".join(child.text.split())
+
+
+def parse_entry(entry: ElementTree.Element) -> Dict[str, Any]:
+    """Extract the fields of an arXiv Atom `entry` element.
+
+    Returns:
+        A dictionary with `id` (without version), `version`, `title`,
+        `abstract`, `authors`, `published`, `updated`, `year`, `categories`,
+        `primary_category`, `doi`, `journal_ref`, `comment`, `url` and
+        `pdf_url`. Error entries returned by the arXiv API have an `error`
+        key instead.
+
+    """
+    id_url = _text(entry, _atom + "id")
+    match = _id_regexp.search(id_url)
+    if not match:
+        return {"error": _text(entry, _atom + "summary") or id_url}
+    arxiv_id, version = match.group(1), match.group(3)
+    primary = entry.find(_arxiv + "primary_category")
+    pdf_url = ""
+    for link in entry.iterfind(_atom + "link"):
+        if link.get("title") == "pdf":
+            pdf_url = link.get("href", "")
+    published = _text(entry, _atom + "published")
+    return {"id": arxiv_id,
+            "version": int(version) if version else None,
+            "title": _text(entry, _atom + "title"),
+            "abstract": _text(entry, _atom + "summary"),
+            "authors": [_text(a, _atom + "name") for a in entry.iterfind(_atom + "author")],
+            "published": published,
+            "updated": _text(entry, _atom + "updated"),
+            "year": published[:4],
+            "categories": [c.get("term") for c in entry.iterfind(_atom + "category")],
+            "primary_category": primary.get("term") if primary is not None else "",
+            "doi": _text(entry, _arxiv + "doi"),
+            "journal_ref": _text(entry, _arxiv + "journal_ref"),
+            "comment": _text(entry, _arxiv + "comment"),
+            "url": f"https://arxiv.org/abs/{arxiv_id}",
+            "pdf_url": pdf_url}
+
+
+def iter_entries(source: Union[bytes, IO[bytes], Iterable[bytes]],
+                 chunk_size: int = 65536) -> Iterator[Dict[str, Any]]:
+    """Incrementally parse an arXiv Atom feed and yield its entries.
+
+    The feed is fed to the parser in chunks and each `entry` element is
+    discarded once it's parsed, so memory stays flat however large the feed.
+
+    Args:
+        source: The feed as :class:`bytes`, a binary file like object or an
+                iterable of byte chunks, e.g., :code:`response.iter_content()`
+        chunk_size: Size of chunks to read from `source`
+
+    Yields:
+        Entries as returned by :func:`parse_entry`
+
+    """
+    if isinstance(source, bytes):
+        chunks: Iterable[bytes] = (source[i:i + chunk_size]
+                                   for i in range(0, len(source), chunk_size))
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), b"")  # type: ignore
+    else:
+        chunks = source
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+            elif elem.tag == _atom + "entry":
+                yield parse_entry(elem)
+                elem.clear()
+                if root is not None:
+                    root.remove(elem)
+    parser.close()
+
+
+def parse_feed(source: Union[bytes, IO[bytes], Iterable[bytes]]) -> Dict[str, Dict[str, Any]]:
+    """Parse all the entries of an arXiv Atom feed.
+
+    Returns:
+        A dictionary of entries keyed by arXiv id. Error entries are skipped.
+
+    """
+    return {e["id"]: e for e in iter_entries(source) if "error" not in e}
@@ -0,0 +1,249 @@
+from typing import Callable, Dict, List, Iterator, Tuple, Any, Optional, Union
+import json
+import time
+import heapq
+import random
+import logging
+from collections import deque
+from queue import Queue, Empty
+
+import flask
+
+from .scheduler import scheduler, bulk
+
+
+def collect(q: Queue) -> Dict[str, Any]:
+    """Helper for fetch functions which put the final result in the queue."""
+    content = {}
+    while not q.empty():
+        key, retval = q.get()
+        content[key] = retval
+    return content
+
+
+def is_error(result: Any) -> bool:
+    return isinstance(result, list) and bool(result) and\
+        isinstance(result[0], str) and result[0].startswith("ERROR")
+
+
+class RetryPolicy:
+    """Retries of failed queries in :func:`iter_batch`.
+
+    A query is tried at most `max_attempts` times. Before each retry it waits
+    for a random delay of up to `base_delay` doubled for each attempt, capped
+    at `max_delay` (exponential backoff with full jitter), so that the retries
+    of queries which failed together are spread out. A `Retry-After` from the
+    upstream is honoured for all the requests to that host by
+    :class:`~ref_man.concurrency.AdaptiveLimit`.
+
+    Args:
+        max_attempts: Maximum attempts for each query
+        base_delay: Maximum delay in seconds before the first retry
+        max_delay: Maximum delay in seconds before any retry
+
+    """
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 30):
+        self.configure(max_attempts, base_delay, max_delay)
+
+    def configure(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 30):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        "Delay before retrying a query which failed `attempt` times."
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+retry_policy = RetryPolicy()
+
+
+def parse_json_request(request: flask.Request) -> Optional[List[str]]:
+    """Get the list of queries from JSON data in `request`.
+
+    Returns:
+        The queries or `None` if the data can't be decoded.
+
+    """
+    if not isinstance(request.json, str):
+        return request.json
+    else:
+        try:
+            return json.loads(request.json)
+        except Exception:
+            return None
+
+
+def iter_batch(data: List[str], fetch_func: Callable[[str, Queue], None],
+               helper: Callable[[Queue], Dict], batch_size: Union[int, Callable[[], int]],
+               fetch_kwargs: Dict[str, Any] = {},
+               priority: str = bulk, retry: Optional[RetryPolicy] = None,
+               failed: Optional[List[str]] = None,
+               should_stop: Optional[Callable[[], bool]] = None,
+               poll_interval: float = 0.5) -> Iterator[Tuple[str, Any]]:
+    """Fetch all queries in `data` in parallel and yield results as they complete.
+
+    At most `batch_size` fetches are in flight at any time and a new one is
+    started as soon as one completes. `batch_size` can also be a function,
+    e.g., :meth:`~ref_man.concurrency.UpstreamLimits.window`, in which case
+    it's checked before each fetch is started. Each result is validated by `helper`.
+    The fetches run on the shared :class:`~ref_man.scheduler.Scheduler` pool
+    in class `priority`.
+
+    Queries which result in an error are retried according to `retry`. They
+    wait out their backoff aside, so that fresh queries keep being fetched
+    meanwhile, and go ahead of the remaining fresh queries once it's over.
+    Queries which fail on every attempt are yielded with the last error and
+    appended to `failed`.
+
+    If `should_stop` returns true no more fetches are started and the
+    iteration ends, even while queries wait out their backoff or are stuck
+    on a slow upstream. It's checked at least every `poll_interval` seconds.
+
+    Args:
+        data: The queries
+        fetch_func: :func:`fetch_func` fetches the request from the server
+        helper: :func:`helper` validates and collates the results
+        batch_size: Number of simultaneous fetch requests or a function returning it
+        fetch_kwargs: Additional keyword arguments for `fetch_func`
+        priority: Scheduling class of the fetches
+        retry: The retry policy. Defaults to :data:`retry_policy`
+        failed: List to which permanently failed queries are appended
+        should_stop: Function returning whether to stop, e.g., on cancellation
+        poll_interval: Maximum seconds between calls of `should_stop`
+
+    Yields:
+        Tuples of query and its result
+
+    """
+    done: Queue = Queue()
+
+    def fetch(query: str):
+        q: Queue = Queue()
+        try:
+            fetch_func(query, q, **fetch_kwargs)
+            result = helper(q)
+        except Exception as e:
+            result = {query: [f"ERROR, {e}"]}
+        done.put((query, result))
+
+    retry = retry or retry_policy
+    pending = deque(data)
+    # Failed queries waiting for their backoff as (time, seq, query, attempt)
+    retries: List[Tuple[float, int, str, int]] = []
+    attempts: Dict[str, int] = {}
+    in_flight = 0
+    seq = 0
+    while pending or retries or in_flight:
+        if should_stop is not None and should_stop():
+            return
+        window = batch_size() if callable(batch_size) else batch_size
+        now = time.monotonic()
+        while in_flight < window and (pending or (retries and retries[0][0] <= now)):
+            if retries and retries[0][0] <= now:
+                _, _, query, attempt = heapq.heappop(retries)
+            else:
+                query, attempt = pending.popleft(), 1
+            attempts[query] = attempt
+            scheduler.submit(priority, fetch, query)
+            in_flight += 1
+        timeout = None
+        if retries and in_flight < window:
+            timeout = max(0.0, retries[0][0] - now)
+        if should_stop is not None:
+            timeout = poll_interval if timeout is None else min(timeout, poll_interval)
+        try:
+            query, result = done.get(timeout=timeout)
+        except Empty:
+            continue
+        in_flight -= 1
+        for k, v in result.items():
+            # Results can be for parts of a query, e.g., comma separated ids
+            attempt = attempts.get(k, attempts.get(query, 1))
+            if is_error(v) and attempt < retry.max_attempts:
+                seq += 1
+                heapq.heappush(retries, (time.monotonic() + retry.delay(attempt), seq, k,
+                                         attempt + 1))
+            else:
+                if is_error(v) and failed is not None:
+                    failed.append(k)
+                yield k, v
+
+
+def post_json_wrapper(request: flask.Request, fetch_func: Callable[[str, Queue], None],
+                      helper: Callable, batch_size: Union[int, Callable[[], int]], host: str,
+                      logger: logging.Logger):
+    """Helper function to parallelize the requests and gather them.
+
+    If the request has a `stream` argument or accepts `application/x-ndjson`
+    the result of each query is streamed as a newline delimited JSON record
+    `{"query": query, "result": result}` as soon as it's available, followed
+    by a final record `{"done": true, "count": num_results, "failed": [...]}`.
+    Otherwise all the results are returned as one JSON object.
+
+    Queries which failed on every attempt have an `["ERROR..."]` result and
+    are also listed in the `failed` field of the final record, or in the
+    `X-Failed-Queries` header as a JSON list, with their number in
+    `X-Failed-Count`.
+
+    Args:
+        request: An instance :class:`~Flask.Request`
+        fetch_func: :func:`fetch_func` fetches the request from the server
+        helper: :func:`helper` validates and collates the results
+        batch_size: Number of simultaneous fetch requests or a function returning it
+        host: Name of the upstream host for logging
+        logger: Logger instance
+
+    """
+    data = parse_json_request(request)
+    if data is None:
+        return json.dumps("BAD REQUEST")
+    logger.info(f"Fetching {len(data)} queries from {host}")
+    failed: List[str] = []
+    results = iter_batch(data, fetch_func, helper, batch_size, {"verbose": True},
+                         failed=failed)
+    if wants_stream(request):
+        return stream_results(results, failed)
+    else:
+        response = flask.Response(json.dumps(dict(results)))
+        set_failed_headers(response, failed, logger)
+        return response
+
+
+def set_failed_headers(response: flask.Response, failed: List[str],
+                       logger: Optional[logging.Logger] = None, max_size: int = 4096):
+    """Report the `failed` queries in the headers of `response`.
+
+    The list is left out if it's longer than `max_size` as clients limit the
+    size of headers, but the count is always given.
+
+    """
+    response.headers["X-Failed-Count"] = str(len(failed))
+    if failed:
+        if logger:
+            logger.warning(f"{len(failed)} queries failed after retries")
+        value = json.dumps(failed)
+        if len(value) <= max_size:
+            response.headers["X-Failed-Queries"] = value
+
+
+def wants_stream(request: flask.Request) -> bool:
+    return "stream" in request.args or\
+        "application/x-ndjson" in request.headers.get("Accept", "")
+
+
+def stream_results(results: Iterator[Tuple[str, Any]],
+                   failed: Optional[List[str]] = None) -> flask.Response:
+    """Return a streaming NDJSON :class:`flask.Response` for `results`.
+
+    The final record lists the `failed` queries, which :func:`iter_batch`
+    has filled by the time `results` is exhausted.
+
+    """
+    def generate():
+        count = 0
+        for query, result in results:
+            count += 1
+            yield json.dumps({"query": query, "result": result}) + "\n"
+        yield json.dumps({"done": True, "count": count, "failed": failed or []}) + "\n"
+    return flask.Response(generate(), mimetype="application/x-ndjson")
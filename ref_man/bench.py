@@ -0,0 +1,536 @@
+"""Micro benchmarks for the ref-man server.
+
+Usage:
+    python -m ref_man.bench <benchmark> [options]
+
+Run :code:`python -m ref_man.bench -h` for the list of benchmarks.
+
+"""
+from typing import Callable, Dict, List, Any
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+def timeit(func: Callable, *args, repeat: int = 5) -> float:
+    "Return the minimum time in seconds taken by `func` over `repeat` runs."
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def emacs_decode_time(payload: bytes, repeat: int = 5) -> float:
+    """Time `json-read` of `payload` in a batch Emacs.
+
+    Returns:
+        Minimum time in seconds over `repeat` runs or -1 if Emacs isn't available.
+
+    """
+    if not shutil.which("emacs"):
+        return -1
+    with tempfile.NamedTemporaryFile("wb", suffix=".json", delete=False) as f:
+        f.write(payload)
+    form = f"""(progn (require 'json)
+      (with-temp-buffer
+        (insert-file-contents "{f.name}")
+        (let ((best 1e9))
+          (dotimes (_ {repeat})
+            (goto-char (point-min))
+            (let ((start (float-time)))
+              (json-read)
+              (setq best (min best (- (float-time) start)))))
+          (princ best))))"""
+    try:
+        out = subprocess.run(["emacs", "--batch", "-Q", "--eval", form],
+                             capture_output=True, timeout=300)
+        return float(out.stdout.decode().strip())
+    except Exception:
+        return -1
+    finally:
+        os.remove(f.name)
+
+
+def bench_payload(args):
+    """Payload size and decode time of `/semantic_scholar` records with field projection."""
+    from .semantic_scholar import parse_fields, project_fields
+    if args.file:
+        with open(args.file) as f:
+            record = json.load(f)
+    else:
+        from .load_test import MockUpstream
+        record = json.loads(MockUpstream(citations=args.citations).ss_paper("bench"))
+    payloads = {"full": json.dumps(record).encode(),
+                "projected": json.dumps(project_fields(record, parse_fields(args.fields))).encode()}
+    print(f"{'payload':<12}{'bytes':>10}{'gzip bytes':>12}{'py decode ms':>14}" +
+          f"{'emacs decode ms':>17}")
+    for name, payload in payloads.items():
+        compressed = gzip.compress(payload, compresslevel=5)
+        py_time = timeit(json.loads, payload)
+        emacs_time = emacs_decode_time(payload) if args.emacs else -1
+        emacs = f"{emacs_time * 1000:.2f}" if emacs_time >= 0 else "n/a"
+        print(f"{name:<12}{len(payload):>10}{len(compressed):>12}" +
+              f"{py_time * 1000:>14.3f}{emacs:>17}")
+
+
+def bench_bibtex(args):
+    """Bulk BibTeX rendering of mixed DBLP, arXiv and Semantic Scholar records."""
+    import random
+    from .bibtex import BibtexRenderer
+    from .arxiv import dict_to_bibtex
+    names = ["Jane Doe", "John Smith", "Yann LeCun", "Geoffrey Hinton", "Ada Lovelace"]
+    words = ["deep", "learning", "attention", "graph", "neural", "networks", "vision"]
+    items = []
+    for i in range(args.n):
+        authors = random.sample(names, 3)
+        title = " ".join(random.sample(words, 4)).title()
+        year = str(random.randint(2010, 2021))
+        kind = i % 3
+        if kind == 0:
+            items.append(("dblp", {"key": f"conf/x/{i}", "title": title + ".", "authors": authors,
+                                   "year": year, "venue": "NeurIPS",
+                                   "type": "Conference and Workshop Papers"}))
+        elif kind == 1:
+            items.append(("arxiv", {"id": f"2001.{i:05d}", "title": title, "authors": authors,
+                                    "published": f"{year}-01-01", "abstract": "Abstract " * 30}))
+        else:
+            items.append(("ss", {"paperId": "%040x" % i, "title": title, "year": int(year),
+                                 "authors": [{"name": a} for a in authors], "venue": "ICML"}))
+    renderer = BibtexRenderer()
+    cold = timeit(lambda: BibtexRenderer().render_many(items), repeat=3)
+    renderer.render_many(items)
+    warm = timeit(renderer.render_many, items, repeat=3)
+    arxiv_items = [dict(x[1], type="misc", url="") for x in items if x[0] == "arxiv"]
+    old = timeit(lambda: [dict_to_bibtex(x) for x in arxiv_items], repeat=3)
+    keys = [b.split("{", 1)[1].split(",", 1)[0] for b in renderer.render_many(items)]
+    print(f"{args.n} entries: cold {cold * 1000:.1f} ms ({args.n / cold:.0f} entries/s), " +
+          f"memoized {warm * 1000:.1f} ms ({args.n / warm:.0f} entries/s)")
+    print(f"dict_to_bibtex on {len(arxiv_items)} arXiv entries: {old * 1000:.1f} ms")
+    print(f"Unique keys: {len(set(keys)) == len(keys)}")
+
+
+def _atom_feed(n: int) -> bytes:
+    entry = """<entry>
+    <id>http://arxiv.org/abs/2001.{i:05d}v2</id>
+    <updated>2020-02-01T00:00:00Z</updated>
+    <published>2020-01-01T00:00:00Z</published>
+    <title>A Title for Paper
+      {i} about Things</title>
+    <summary>  {abstract}
+    </summary>
+    <author><name>Jane Doe</name></author>
+    <author><name>John Smith</name><arxiv:affiliation>Somewhere</arxiv:affiliation></author>
+    <arxiv:doi>10.1000/{i}</arxiv:doi>
+    <link title="doi" href="http://dx.doi.org/10.1000/{i}" rel="related"/>
+    <arxiv:comment>10 pages</arxiv:comment>
+    <arxiv:journal_ref>Journal 1 (2020)</arxiv:journal_ref>
+    <link href="http://arxiv.org/abs/2001.{i:05d}v2" rel="alternate" type="text/html"/>
+    <link title="pdf" href="http://arxiv.org/pdf/2001.{i:05d}v2" rel="related"/>
+    <arxiv:primary_category term="cs.LG" scheme="http://arxiv.org/schemas/atom"/>
+    <category term="cs.LG" scheme="http://arxiv.org/schemas/atom"/>
+    <category term="stat.ML" scheme="http://arxiv.org/schemas/atom"/>
+  </entry>"""
+    abstract = "We study things. " * 60
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom" '
+            'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+            'xmlns:arxiv="http://arxiv.org/schemas/atom">' +
+            "".join(entry.format(i=i, abstract=abstract) for i in range(n)) +
+            "</feed>").encode()
+
+
+def bench_atom(args):
+    """arXiv Atom feed parsing with the streaming parser against BeautifulSoup."""
+    import warnings
+    import tracemalloc
+    from .atom import iter_entries
+    warnings.filterwarnings("ignore", message=".*HTML parser to parse an XML document")
+
+    def streaming(feed):
+        return [*iter_entries(feed)]
+
+    def soup_first(feed):
+        from bs4 import BeautifulSoup
+        entry = BeautifulSoup(feed, features="lxml").find("entry")
+        return entry.find("summary").text, entry.find("title").text,\
+            [a.text for a in entry.find_all("author")], entry.find("published").text
+
+    def soup_all(feed):
+        from bs4 import BeautifulSoup
+        return [(e.find("summary").text, e.find("title").text,
+                 [a.text for a in e.find_all("author")], e.find("published").text)
+                for e in BeautifulSoup(feed, features="lxml").find_all("entry")]
+
+    funcs = {"streaming (all entries)": streaming}
+    try:
+        import bs4  # noqa
+        funcs.update({"bs4 lxml (first entry)": soup_first,
+                      "bs4 lxml (all entries)": soup_all})
+    except ImportError:
+        print("bs4 not available. Only timing the streaming parser.")
+    # NOTE: tracemalloc doesn't see allocations made by lxml itself, so peak
+    #       memory for bs4 is a lower bound
+    print(f"{'entries':>8}  {'parser':<26}{'time ms':>10}{'peak MiB':>10}")
+    for n in args.entries:
+        feed = _atom_feed(n)
+        for name, func in funcs.items():
+            t = timeit(func, feed, repeat=3)
+            tracemalloc.start()
+            func(feed)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{n:>8}  {name:<26}{t * 1000:>10.2f}{peak / 2**20:>10.2f}")
+
+
+def _write_metadata(path: str, n: int):
+    "Write `n` synthetic `metadata` lines with a typical mix of identifiers."
+    import hashlib
+    with open(path, "w") as f:
+        for i in range(n):
+            pid = hashlib.sha1(i.to_bytes(8, "little")).hexdigest()
+            f.write(",".join([f"P{i % 100:02d}-{i}" if i % 20 == 0 else "",
+                              f"{1000 + i % 9000}.{i:05d}" if i % 3 == 0 else "",
+                              str(i), f"10.{1000 + i % 5000}/x{i}" if i % 5 < 3 else "",
+                              pid]) + "\n")
+
+
+def bench_ss_index(args):
+    """Memory, startup and lookup time of the compact ss_cache index against dicts."""
+    import gc
+    import random
+    import psutil
+    from .semantic_scholar import load_ss_cache
+    proc = psutil.Process()
+
+    def rss():
+        gc.collect()
+        return proc.memory_info().rss
+
+    print(f"{'entries':>9}  {'index':<14}{'build s':>9}{'load ms':>9}{'RSS MiB':>9}" +
+          f"{'file MiB':>10}{'lookup us':>11}")
+    for n in args.entries:
+        with tempfile.TemporaryDirectory() as data_dir:
+            metadata = os.path.join(data_dir, "metadata")
+            _write_metadata(metadata, n)
+            queries = [str(random.randrange(n)) for _ in range(100000)]
+            if n <= args.max_dict:
+                before = rss()
+                start = time.perf_counter()
+                cache: Dict[str, Dict[str, str]] = {"acl": {}, "arxiv": {},
+                                                    "corpus": {}, "doi": {}}
+                with open(metadata) as f:
+                    for line in f:
+                        c = line.rstrip("\n").split(",")
+                        for key, ID in zip(["acl", "arxiv", "corpus", "doi"], c):
+                            if ID:
+                                cache[key][ID] = c[-1]
+                load = time.perf_counter() - start
+                used = rss() - before
+                corpus = cache["corpus"]
+                lookup = timeit(lambda: [corpus[q] for q in queries], repeat=3)
+                print(f"{n:>9}  {'dicts':<14}{'':>9}{load * 1000:>9.0f}{used / 2**20:>9.1f}" +
+                      f"{'':>10}{lookup / len(queries) * 1e6:>11.2f}")
+                del cache, corpus
+            start = time.perf_counter()
+            load_ss_cache(data_dir)
+            build = time.perf_counter() - start
+            before = rss()
+            start = time.perf_counter()
+            ss_cache = load_ss_cache(data_dir)
+            load = time.perf_counter() - start
+            table = ss_cache["corpus"]
+            lookup = timeit(lambda: [table[q] for q in queries], repeat=3)
+            # Includes the pages of the index touched by the lookups
+            used = rss() - before
+            size = os.path.getsize(ss_cache.index_file)
+            print(f"{n:>9}  {'compact+mmap':<14}{build:>9.1f}{load * 1000:>9.1f}" +
+                  f"{used / 2**20:>9.1f}{size / 2**20:>10.1f}" +
+                  f"{lookup / len(queries) * 1e6:>11.2f}")
+
+
+def bench_title_lookup(args):
+    """Tail latency of hedged title lookups against trying the sources one by one."""
+    import random
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from .load_test import percentile
+    from .title_lookup import TitleLookup
+    # Median latency in seconds, spread of the log normal and rate of good matches
+    profiles = {"dblp": (0.3, 0.8, 0.7), "ss_search": (0.5, 0.6, 0.85),
+                "arxiv": (0.6, 0.7, 0.5)}
+    rng = random.Random(args.seed)
+    # Both strategies see the same draws for each title
+    draws = {f"title of paper number {i}": {
+        name: (args.scale * median * rng.lognormvariate(0, sigma), rng.random() < rate)
+        for name, (median, sigma, rate) in profiles.items()} for i in range(args.n)}
+    searches = {"count": 0}
+    lock = threading.Lock()
+
+    def source(name):
+        def search(title):
+            with lock:
+                searches["count"] += 1
+            latency, hit = draws[title][name]
+            time.sleep(latency)
+            return [{"title": title if hit else "an unrelated paper", "year": "2020",
+                     "key": f"{name}/{title}", "paperId": title, "id": title}]
+        return search
+
+    lookup = TitleLookup({name: source(name) for name in profiles},
+                         grace=args.scale * args.grace / 1000)
+    print(f"{args.n} titles, {args.concurrency} at a time, latencies and grace " +
+          f"scaled by {args.scale}")
+    print(f"{'strategy':<12}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}" +
+          f"{'found %':>9}{'searches':>10}")
+    for sequential in [True, False]:
+        searches["count"] = 0
+
+        def do(title):
+            start = time.perf_counter()
+            result = lookup.lookup(title, sequential=sequential)
+            return time.perf_counter() - start, result["confidence"] >= lookup.min_confidence
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = [*pool.map(do, draws)]
+        times = [x[0] for x in results]
+        found = 100 * sum(x[1] for x in results) / len(results)
+        print(f"{'sequential' if sequential else 'hedged':<12}" +
+              "".join(f"{percentile(times, p) * 1000:>9.0f}" for p in [50, 95, 99]) +
+              f"{max(times) * 1000:>9.0f}{found:>9.1f}{searches['count'] / args.n:>10.2f}")
+
+
+def bench_ss_contention(args):
+    """Lookups in the ss_cache index by many threads while entries are added."""
+    import random
+    import threading
+    from .load_test import percentile
+    from .semantic_scholar import SSCache, assoc
+
+    class GlobalLock:
+        "Entries not in the index in :class:`dict` guarded by one lock."
+        def __init__(self, index):
+            self.index = index
+            self.recent: Dict[str, Dict[str, str]] = {k: {} for k, _ in assoc}
+            self.lock = threading.Lock()
+
+        def get(self, id_type, ID):
+            with self.lock:
+                paper_id = self.recent[id_type].get(ID)
+                return paper_id if paper_id is not None else self.index.get(id_type, ID)
+
+        def add_many(self, entries):
+            with self.lock:
+                for c in entries:
+                    for key, ind in assoc:
+                        if c[ind]:
+                            self.recent[key][c[ind]] = c[-1]
+
+    class CopyOnWrite:
+        def __init__(self, cache):
+            self.cache = cache
+
+        def get(self, id_type, ID):
+            return self.cache[id_type].get(ID)
+
+        def add_many(self, entries):
+            self.cache.add_many(entries)
+
+    def new_entries(start, n):
+        return [["", f"9{i:09d}", str(start + i), f"10.9/{start + i}", "%040x" % (start + i)]
+                for i in range(n)]
+
+    def run(index, threads):
+        stop = threading.Event()
+        latencies: List[List[float]] = [[] for _ in range(threads)]
+        counts = [0] * threads
+
+        def reader(k):
+            rng = random.Random(k)
+            lat = latencies[k]
+            while not stop.is_set():
+                ID = str(rng.randrange(args.entries))
+                start = time.perf_counter()
+                index.get("corpus", ID)
+                lat.append(time.perf_counter() - start)
+                counts[k] += 1
+
+        def writer():
+            n = args.entries
+            last_batch = time.perf_counter()
+            while not stop.is_set():
+                # Fetches by this process and now and then entries appended by
+                # others, read by refresh
+                if time.perf_counter() - last_batch > args.batch_interval:
+                    index.add_many(new_entries(n, args.batch))
+                    n += args.batch
+                    last_batch = time.perf_counter()
+                index.add_many(new_entries(n, 1))
+                n += 1
+                time.sleep(0.001)
+
+        workers = [threading.Thread(target=reader, args=[k]) for k in range(threads)]
+        workers.append(threading.Thread(target=writer))
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        time.sleep(args.seconds)
+        stop.set()
+        total, elapsed = sum(counts), time.perf_counter() - start
+        for t in workers:
+            t.join()
+        values = [x for lat in latencies for x in lat]
+        return total / elapsed, percentile(values, 99), percentile(values, 99.9)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        _write_metadata(os.path.join(data_dir, "metadata"), args.entries)
+        print(f"{args.entries} entries, a writer adding one every ms and {args.batch} " +
+              f"every {args.batch_interval}s, {args.seconds}s per run")
+        print(f"{'index':<16}{'threads':>8}{'lookups/s':>12}{'p99 us':>10}{'p99.9 us':>10}")
+        for threads in args.threads:
+            for name in ["global lock", "copy on write"]:
+                cache = SSCache(data_dir)
+                cache.load()
+                index = CopyOnWrite(cache) if name == "copy on write" else\
+                    GlobalLock(cache._snapshot.index)
+                rate, p99, p999 = run(index, threads)
+                print(f"{name:<16}{threads:>8}{rate:>12.0f}{p99 * 1e6:>10.1f}{p999 * 1e6:>10.1f}")
+
+
+def bench_transport(args):
+    """Round trip latency of small requests over TCP and a Unix domain socket."""
+    import socket
+    import http.client
+    from .load_test import MockUpstream, ServerProcess, percentile
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def __init__(self, path: str):
+            super().__init__("localhost")
+            self.path = path
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.path)
+
+    mock = MockUpstream(latency=0).start()
+    sock_dir = tempfile.mkdtemp(prefix="ref_man_bench_")
+    sock_path = os.path.join(sock_dir, "server.sock")
+    server = ServerProcess(mock.url, ["--unix-socket", sock_path, "--workers", str(args.workers)])
+    try:
+        server.start()
+        server.wait_ready()
+        paths = ["/version", "/semantic_scholar?id=10.1000/bench&id_type=doi", "/echo?x=1"]
+        connections = {"tcp": lambda: http.client.HTTPConnection("127.0.0.1", server.port),
+                       "unix": lambda: UnixHTTPConnection(sock_path)}
+
+        def request(conn, path):
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise ValueError(f"{path} returned {response.status}")
+
+        # Fetched once so that the rest are cache hits
+        request(connections["tcp"](), paths[1])
+        print(f"{args.n} requests each, {args.workers} worker(s)")
+        print(f"{'path':<20}{'transport':<22}{'p50 us':>9}{'p99 us':>9}{'req/s':>9}")
+        for path in paths:
+            for name, connect in connections.items():
+                for keep_alive in [False, True]:
+                    times = []
+                    conn = connect()
+                    start = time.perf_counter()
+                    for _ in range(args.n):
+                        t = time.perf_counter()
+                        if not keep_alive:
+                            conn = connect()
+                        request(conn, path)
+                        if not keep_alive:
+                            conn.close()
+                        times.append(time.perf_counter() - t)
+                    total = time.perf_counter() - start
+                    conn.close()
+                    label = f"{name}, {'keep-alive' if keep_alive else 'new connection'}"
+                    print(f"{path.split('?')[0]:<20}{label:<22}" +
+                          f"{percentile(times, 50) * 1e6:>9.0f}" +
+                          f"{percentile(times, 99) * 1e6:>9.0f}{args.n / total:>9.0f}")
+    finally:
+        server.stop()
+        mock.stop()
+        shutil.rmtree(sock_dir, ignore_errors=True)
+
+
+benchmarks: Dict[str, Any] = {
+    "atom": bench_atom,
+    "payload": bench_payload,
+    "bibtex": bench_bibtex,
+    "ss_index": bench_ss_index,
+    "title_lookup": bench_title_lookup,
+    "ss_contention": bench_ss_contention,
+    "transport": bench_transport,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser("ref-man-bench")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    payload = subparsers.add_parser("payload", help=bench_payload.__doc__)
+    payload.add_argument("--file", type=str, default="",
+                         help="Semantic Scholar record to use. A synthetic one is used if not given")
+    payload.add_argument("--citations", type=int, default=500,
+                         help="Number of citations in the synthetic record")
+    payload.add_argument("--fields", type=str,
+                         default="paperId,title,authors.name,year,venue,arxivId,doi,abstract," +
+                         "references.paperId,references.title,citations.paperId,citations.title",
+                         help="Fields to project")
+    payload.add_argument("--emacs", action="store_true",
+                         help="Also measure json-read time in a batch Emacs")
+    bibtex = subparsers.add_parser("bibtex", help=bench_bibtex.__doc__)
+    bibtex.add_argument("-n", type=int, default=10000, help="Number of entries")
+    atom = subparsers.add_parser("atom", help=bench_atom.__doc__)
+    atom.add_argument("--entries", type=int, nargs="+", default=[1, 100, 2000],
+                      help="Number of entries in the feeds")
+    ss_index = subparsers.add_parser("ss_index", help=bench_ss_index.__doc__)
+    ss_index.add_argument("--entries", type=int, nargs="+", default=[1000000, 10000000],
+                          help="Number of metadata lines")
+    ss_index.add_argument("--max-dict", dest="max_dict", type=int, default=3000000,
+                          help="Largest number of lines for which the dicts are also loaded")
+    title_lookup = subparsers.add_parser("title_lookup", help=bench_title_lookup.__doc__)
+    title_lookup.add_argument("-n", type=int, default=300, help="Number of titles")
+    title_lookup.add_argument("--concurrency", type=int, default=4,
+                              help="Simultaneous lookups")
+    title_lookup.add_argument("--scale", type=float, default=0.2,
+                              help="Factor for the simulated latencies of the sources")
+    title_lookup.add_argument("--grace", type=float, default=100,
+                              help="Milliseconds to wait for other sources after a good match, " +
+                              "before scaling")
+    title_lookup.add_argument("--seed", type=int, default=0, help="Random seed")
+    ss_contention = subparsers.add_parser("ss_contention", help=bench_ss_contention.__doc__)
+    ss_contention.add_argument("--entries", type=int, default=1000000,
+                               help="Number of metadata lines")
+    ss_contention.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16],
+                               help="Numbers of lookup threads")
+    ss_contention.add_argument("--batch", type=int, default=20000,
+                               help="Entries added at once by a refresh")
+    ss_contention.add_argument("--batch-interval", dest="batch_interval", type=float,
+                               default=0.5, help="Seconds between refreshes")
+    ss_contention.add_argument("--seconds", type=float, default=3, help="Duration of each run")
+    transport = subparsers.add_parser("transport", help=bench_transport.__doc__)
+    transport.add_argument("-n", type=int, default=2000, help="Requests of each kind")
+    transport.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit(1)
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+from typing import Callable, Dict, List, Optional, Any, Tuple
+import re
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+
+
+_stop_words = {"a", "an", "the", "on", "of", "in", "for", "to", "and", "with", "from",
+               "towards", "via", "by", "at", "is", "are"}
+_dblp_types = {"Conference and Workshop Papers": "inproceedings",
+               "Journal Articles": "article",
+               "Books and Theses": "book",
+               "Parts in Books or Collections": "incollection",
+               "Informal Publications": "misc",
+               "Informal and Other Publications": "misc"}
+
+
+_dblp_number = re.compile(r"\s+\d{4}$")
+_word = re.compile(r"[a-z0-9]+")
+_non_alnum = re.compile(r"[^a-z0-9]")
+
+
+def _ascii(text: str) -> str:
+    if text.isascii():
+        return text
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+
+
+def split_name(name: str) -> Tuple[str, str]:
+    """Split a name into last and first names.
+
+    Names already of the form "Last, First" are kept as they are. DBLP
+    disambiguation numbers like "John Smith 0001" are removed.
+
+    """
+    name = name.strip()
+    if name[-1:].isdigit():
+        name = _dblp_number.sub("", name)
+    if "," in name:
+        last, first = name.split(",", 1)
+        return last.strip(), first.strip()
+    parts = name.split()
+    if not parts:
+        return "", ""
+    return parts[-1], " ".join(parts[:-1])
+
+
+def make_key(authors: List[str], year: str, title: str) -> str:
+    """Generate a citation key from last name of first author, year and the
+    first significant word of the title."""
+    last = split_name(authors[0])[0] if authors else "anon"
+    word = next((w for w in _word.findall(_ascii(title).lower()) if w not in _stop_words), "")
+    return _non_alnum.sub("", _ascii(last).lower()) + str(year or "") + word
+
+
+def first_word_key(authors: List[str], year: str, title: str) -> str:
+    """Generate a citation key from the last word of the first author's name,
+    year and the first word of the title, as :func:`~ref_man.arxiv.dict_to_bibtex`
+    always has, e.g., "smith2020on" for "On the ..."."""
+    last = authors[0].split(" ")[-1] if authors else ""
+    return last.lower() + str(year or "") + title.split(" ")[0].lower()
+
+
+class Entry:
+    """A BibTeX entry with its base citation key and rendered fields.
+
+    Args:
+        entry_type: BibTeX entry type, e.g., `article`
+        base_key: Citation key before disambiguation
+        fields: Rendered fields of the entry
+
+    """
+    __slots__ = ["entry_type", "base_key", "fields"]
+
+    def __init__(self, entry_type: str, base_key: str, fields: str):
+        self.entry_type = entry_type
+        self.base_key = base_key
+        self.fields = fields
+
+    def render(self, key: str) -> str:
+        return f"@{self.entry_type}{{{key},\n{self.fields}\n}}"
+
+
+def make_entry(entry_type: str, authors: List[str], fields: Dict[str, Any],
+               key_func: Callable[[List[str], str, str], str] = make_key) -> Entry:
+    """Render `authors` and `fields` into an :class:`Entry`.
+
+    Fields with empty values are skipped. Authors are rendered as
+    "Last, First and ...", splitting each name only once. The base key is
+    generated by `key_func` from the authors, year and title.
+
+    """
+    lines = []
+    if authors:
+        names = []
+        for a in authors:
+            last, first = split_name(a)
+            names.append(f"{last}, {first}" if first else last)
+        lines.append("  author={" + " and ".join(names) + "}")
+    for k, v in fields.items():
+        if v:
+            lines.append(f"  {k}={{{v}}}")
+    return Entry(entry_type, key_func(authors, fields.get("year", ""), fields.get("title", "")),
+                 ",\n".join(lines))
+
+
+def from_dict(bib_dict: Dict[str, Any],
+              key_func: Callable[[List[str], str, str], str] = make_key) -> Optional[Entry]:
+    """Convert a generic dictionary with a `type` and `author` or `authors` to
+    an :class:`Entry`. See :func:`make_entry` for `key_func`."""
+    temp = bib_dict.copy()
+    if "author" in temp:
+        authors = temp.pop("author")
+    elif "authors" in temp:
+        authors = temp.pop("authors")
+    else:
+        return None
+    if isinstance(authors, str):
+        authors = [a.strip() for a in authors.split(" and ")]
+    entry_type = temp.pop("type", "misc")
+    return make_entry(entry_type, authors, {k: str(v) for k, v in temp.items()}, key_func)
+
+
+def from_dblp(info: Dict[str, Any]) -> Entry:
+    "Convert a DBLP hit as returned by `/dblp` to an :class:`Entry`."
+    authors = info.get("authors", [])
+    if isinstance(authors, dict):   # raw DBLP format
+        authors = authors["author"]
+        authors = [a["text"] for a in (authors if isinstance(authors, list) else [authors])]
+    entry_type = _dblp_types.get(info.get("type", ""), "misc")
+    venue = "journal" if entry_type == "article" else "booktitle"
+    title = info.get("title", "").rstrip(".")
+    return make_entry(entry_type, authors,
+                      {"title": title, venue: info.get("venue", ""),
+                       "year": info.get("year", ""), "volume": info.get("volume", ""),
+                       "number": info.get("number", ""), "pages": info.get("pages", ""),
+                       "doi": info.get("doi", ""), "url": info.get("ee", "")})
+
+
+def from_arxiv(entry: Dict[str, Any]) -> Entry:
+    "Convert an arXiv entry to an :class:`Entry`."
+    arxiv_id = entry.get("id") or entry.get("arxiv_id") or ""
+    return make_entry("misc", entry.get("authors", []),
+                      {"title": entry.get("title", ""),
+                       "year": entry.get("year") or entry.get("published", "")[:4],
+                       "eprint": arxiv_id, "archivePrefix": "arXiv" if arxiv_id else "",
+                       "primaryClass": entry.get("primary_category", ""),
+                       "doi": entry.get("doi", ""),
+                       "url": entry.get("url") or
+                       (f"https://arxiv.org/abs/{arxiv_id}" if arxiv_id else ""),
+                       "abstract": entry.get("abstract", "")})
+
+
+def from_ss(record: Dict[str, Any]) -> Entry:
+    "Convert a Semantic Scholar record to an :class:`Entry`."
+    authors = [a["name"] if isinstance(a, dict) else a for a in record.get("authors", [])]
+    arxiv_id = record.get("arxivId") or ""
+    return make_entry("article" if record.get("venue") else "misc", authors,
+                      {"title": record.get("title", ""),
+                       "journal": record.get("venue", ""),
+                       "year": str(record.get("year") or ""),
+                       "doi": record.get("doi") or "",
+                       "eprint": arxiv_id, "archivePrefix": "arXiv" if arxiv_id else "",
+                       "url": record.get("url") or ""})
+
+
+converters = {"dblp": (from_dblp, lambda x: x.get("key") or x.get("url")),
+              "arxiv": (from_arxiv, lambda x: x.get("id") or x.get("arxiv_id")),
+              "ss": (from_ss, lambda x: x.get("paperId")),
+              "dict": (from_dict, lambda x: None)}
+# Fields of the records of each source which are rendered
+_rendered_fields = {"dblp": ("title", "authors", "type", "venue", "year", "volume", "number",
+                             "pages", "doi", "ee"),
+                    "arxiv": ("title", "authors", "year", "published", "primary_category",
+                              "doi", "url", "abstract"),
+                    "ss": ("title", "authors", "venue", "year", "doi", "arxivId", "url")}
+
+
+class BibtexRenderer:
+    """Render DBLP, arXiv and Semantic Scholar records to BibTeX in bulk.
+
+    Rendered entries are memoized by source and source ID along with the
+    fields they were rendered from, so records seen earlier aren't converted
+    again unless they've changed, e.g., after a refetch. Citation keys are made unique across each
+    batch by suffixing `a`, `b`, ... to duplicates.
+
+    Args:
+        maxsize: Maximum number of memoized entries
+
+    """
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._memo: "OrderedDict[Tuple[str, str], Tuple[List[Any], Entry]]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, source: str, data: Dict[str, Any]) -> Optional[Entry]:
+        convert, get_id = converters[source]
+        source_id = get_id(data)
+        if source_id:
+            values = [data.get(k) for k in _rendered_fields[source]]
+            with self._lock:
+                memo = self._memo.get((source, source_id))
+                if memo is not None and memo[0] == values:
+                    self._memo.move_to_end((source, source_id))
+                    self.hits += 1
+                    return memo[1]
+        entry = convert(data)
+        if source_id and entry is not None:
+            with self._lock:
+                self.misses += 1
+                self._memo[(source, source_id)] = (values, entry)
+                self._memo.move_to_end((source, source_id))
+                if len(self._memo) > self.maxsize:
+                    self._memo.popitem(last=False)
+        return entry
+
+    def render_many(self, items: List[Tuple[str, Dict[str, Any]]]) -> List[Optional[str]]:
+        """Render `items` of (source, data) to BibTeX with unique keys.
+
+        Returns:
+            BibTeX strings in the same order as `items`, `None` for items which
+            couldn't be converted.
+
+        """
+        entries = [self.entry(source, data) for source, data in items]
+        counts: Dict[str, int] = {}
+        for e in entries:
+            if e is not None:
+                counts[e.base_key] = counts.get(e.base_key, 0) + 1
+        used = {k for k, v in counts.items() if v == 1}
+        seen: Dict[str, int] = {}
+        result: List[Optional[str]] = []
+        for e in entries:
+            if e is None:
+                result.append(None)
+                continue
+            key = e.base_key
+            if counts[key] > 1:
+                i = seen.get(key, 0)
+                while key + _suffix(i) in used:
+                    i += 1
+                seen[e.base_key] = i + 1
+                key += _suffix(i)
+                used.add(key)
+            result.append(e.render(key))
+        return result
+
+    def render(self, source: str, data: Dict[str, Any]) -> Optional[str]:
+        return self.render_many([(source, data)])[0]
+
+
+def _suffix(i: int) -> str:
+    "Suffixes a, b, ..., z, aa, ab, ..."
+    s = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        s = chr(ord("a") + r) + s
+    return s
+
+
+renderer = BibtexRenderer()
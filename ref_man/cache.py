@@ -1,42 +1,110 @@
 import os
 import time
+import fcntl
 import shutil
 from subprocess import Popen, PIPE, TimeoutExpired
 from threading import Thread, Event
 
+from .events import events
+from .scheduler import scheduler, background
+from .tracing import tracer
+
 
 class CacheHelper:
-    def __init__(self, local_dir, remote_dir, cache_file, logger):
+    """Maintain a cache of remote links for local pdf files.
+
+    The update state is also kept in files next to `cache_file` so that it's
+    shared by all the server workers. A lock file ensures that only one worker
+    updates the cache at a time, a status file records the result of the last
+    update and a stop file signals an update running in another worker to stop.
+
+    The progress of an update is published as `cache` events with `state` one
+    of `updating`, `finished`, `finished_with_errors`, `stopped` or `error`.
+    See :class:`~ref_man.events.EventBus`.
+
+    Args:
+        local_dir: Local directory where the pdfs are stored
+        remote_dir: Remote rclone directory for the pdfs
+        cache_file: File where the links are stored
+        logger: Logger instance
+        check: Check and fix the cache on initialization
+
+    """
+    def __init__(self, local_dir, remote_dir, cache_file, logger, check=True):
         self.local_dir = local_dir
         self.remote_dir = remote_dir
         self.cache_file = cache_file
+        self.lock_file = cache_file + ".lock"
+        self.status_file = cache_file + ".status"
+        self.stop_file = cache_file + ".stop"
         self.updating_ev = Event()
         self.success_ev = Event()
         self.success_with_errors_ev = Event()
         self.update_thread = None
         self.logger = logger
-        self.check_and_fix_cache()
+        if check:
+            self.check_and_fix_cache()
+
+    def _try_lock(self):
+        f = open(self.lock_file, "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except OSError:
+            f.close()
+            return None
+
+    def _release_lock(self, f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def _set_status(self, status):
+        with open(self.status_file, "w") as f:
+            f.write(status)
+
+    @property
+    def shared_status(self):
+        try:
+            with open(self.status_file) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ""
 
     @property
     def updating(self):
-        return self.updating_ev.is_set()
+        if self.updating_ev.is_set():
+            return True
+        lock = self._try_lock()
+        if lock is None:
+            return True
+        self._release_lock(lock)
+        return False
 
     @property
     def finished(self):
-        return self.success_ev.is_set()
+        return self.success_ev.is_set() or self.shared_status == "finished"
 
     @property
     def finished_with_errors(self):
-        return self.success_with_errors_ev.is_set()
+        return self.success_with_errors_ev.is_set() or\
+            self.shared_status == "finished_with_errors"
+
+    @property
+    def state(self) -> str:
+        "State of the cache as in the `cache` events. Cheaper than :meth:`read_cache`."
+        if self.updating:
+            return "updating"
+        return self.shared_status or "idle"
 
     # TODO: Change to sqlite
     def read_cache(self):
-        local_files = [os.path.join(self.local_dir, f)
-                       for f in os.listdir(self.local_dir)
-                       if not f.startswith(".")]
-        with open(self.cache_file) as f:
-            cache = [x for x in f.read().split("\n") if len(x)]
-            cached_files = [x.rsplit(";")[0] for x in cache]
+        with tracer.span("links_cache_read", "cache"):
+            local_files = [os.path.join(self.local_dir, f)
+                           for f in os.listdir(self.local_dir)
+                           if not f.startswith(".")]
+            with open(self.cache_file) as f:
+                cache = [x for x in f.read().split("\n") if len(x)]
+                cached_files = [x.rsplit(";")[0] for x in cache]
         return local_files, cache, cached_files
 
     @property
@@ -53,6 +121,9 @@ class CacheHelper:
 
     def stop_update(self):
         self.updating_ev.clear()
+        # Signal an update running in any other worker
+        if self.updating:
+            open(self.stop_file, "w").close()
 
     def shutdown(self):
         self.stop_update()
@@ -97,6 +168,10 @@ class CacheHelper:
 
     def try_get_link(self, remote_path):
         self.logger.debug(f"Fetching link for {remote_path}")
+        with tracer.span("rclone_link", "cache", path=remote_path):
+            return self._try_get_link(remote_path)
+
+    def _try_get_link(self, remote_path):
         try:
             p = Popen(f"rclone -v link {remote_path}", shell=True, stdout=PIPE, stderr=PIPE)
             out, err = p.communicate(timeout=10)
@@ -154,6 +229,13 @@ class CacheHelper:
             self.logger.error("We are still updating")
 
     def update_cache_helper(self, fix_files=[]):
+        lock = self._try_lock()
+        if lock is None:
+            self.logger.error("Cache is being updated by another worker")
+            return
+        if os.path.exists(self.stop_file):
+            os.remove(self.stop_file)
+        self._set_status("updating")
         if not self.updating_ev.is_set():
             self.updating_ev.set()
         if self.success_ev.is_set():
@@ -173,10 +255,17 @@ class CacheHelper:
             init_cache_size = len(cache)
             cache = dict(c.split(";") for c in cache)
             self.logger.info(f"Will try to fetch links for {len(files)} files")
-            for f in files:
-                if not self.updating_ev.is_set():
+            events.publish("cache", {"state": "updating", "done": 0, "total": len(files)})
+            stopped = False
+            for i, f in enumerate(files):
+                if not self.updating_ev.is_set() or os.path.exists(self.stop_file):
+                    stopped = True
                     break
-                self.get_link(f, cache, warnings)
+                # Run on the shared pool so that interactive requests go first
+                scheduler.run(background, self.get_link, f, cache, warnings)
+                events.publish("cache", {"state": "updating", "done": i + 1,
+                                         "total": len(files), "file": f,
+                                         "ok": bool(cache.get(f))})
             self.logger.info(f"Writing {len(cache) - init_cache_size} links to {self.cache_file}")
             shutil.copyfile(self.cache_file, self.cache_file + ".bak")
             with open(self.cache_file, "w") as cf:
@@ -185,10 +274,19 @@ class CacheHelper:
             self.updating_ev.clear()
             if warnings:
                 self.success_with_errors_ev.set()
+                self._set_status("finished_with_errors")
             else:
                 self.success_ev.set()
+                self._set_status("finished")
+            events.publish("cache", {"state": "stopped" if stopped else self.shared_status,
+                                     "links": len(cache) - init_cache_size,
+                                     "errors": warnings})
         except Exception as e:
             self.updating_ev.clear()
+            self._set_status("")
+            events.publish("cache", {"state": "error", "error": str(e)})
             self.logger.error(f"Error {e} while updating cache")
             self.logger.error(f"Overwritten {self.cache_file}.\n" +
                               f"Original file backed up to {self.cache_file}.bak")
+        finally:
+            self._release_lock(lock)
@@ -0,0 +1,323 @@
+from typing import Callable, Dict, Optional, Any
+import os
+import json
+import time
+import tempfile
+import requests
+from email.utils import parsedate_to_datetime
+from requests.utils import select_proxy
+from threading import Condition, Lock, Thread, Event
+from urllib.parse import urlparse
+
+from .const import upstream
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+def retry_after(response: requests.Response, max_wait: float = 300) -> float:
+    """Seconds to wait as per the `Retry-After` header of `response`.
+
+    The header can be a number of seconds or an HTTP date. Returns 0 if it's
+    absent or invalid and at most `max_wait`.
+
+    """
+    value = response.headers.get("Retry-After", "").strip()
+    if not value:
+        return 0
+    try:
+        wait = float(value)
+    except ValueError:
+        try:
+            wait = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError, IndexError):
+            return 0
+    return min(max(wait, 0), max_wait)
+
+
+class AdaptiveLimit:
+    """Concurrency limit for one upstream host adjusted by AIMD.
+
+    The limit grows by about one for each limit's worth of healthy responses
+    (additive increase) and is multiplied by `backoff` on a 429, a 5xx or a
+    connection error (multiplicative decrease). If the recent latency rises
+    above `latency_factor` times the long term latency, the limit is reduced
+    by a tenth, as the host is queueing requests. Decreases happen at most
+    once per recent latency, so that one burst of failures counts once.
+
+    Optionally requests are also capped at `rate` per second with a token
+    bucket of `burst` tokens. After a :meth:`pause`, e.g., for a
+    `Retry-After`, no request is started until it's over.
+
+    Args:
+        host: The upstream host
+        initial: Initial limit
+        min_limit: Minimum limit
+        max_limit: Maximum limit
+        rate: Maximum requests per second. 0 means no cap
+        burst: Size of the token bucket. Defaults to `rate`
+        backoff: Factor by which the limit is reduced on errors
+        latency_factor: Ratio of recent to long term latency beyond which the
+                        limit is reduced
+
+    """
+    def __init__(self, host: str, initial: float = 16, min_limit: int = 1,
+                 max_limit: int = 64, rate: float = 0, burst: Optional[float] = None,
+                 backoff: float = 0.75, latency_factor: float = 2.0):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.recent: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.counts = {"requests": 0, "errors": 0, "throttled": 0, "latency_backoffs": 0,
+                       "paused": 0}
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._cond = Condition()
+        self._bucket_lock = Lock()
+
+    def _take_token(self):
+        while True:
+            with self._bucket_lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a free slot and, if rate capped, a token.
+
+        Returns:
+            False if no slot was free within `timeout`.
+
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if self.rate:
+            self._take_token()
+        return True
+
+    def pause(self, seconds: float):
+        "Start no request for `seconds`."
+        with self._cond:
+            self.counts["paused"] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._last_decrease < (self.recent or 0.1):
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * factor)
+
+    def cancel(self):
+        "Release a slot of a request which didn't reach the host, without adjusting the limit."
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self, latency: float, status: Optional[int] = None):
+        """Release a slot and adjust the limit.
+
+        Args:
+            latency: Seconds taken by the request
+            status: HTTP status of the response or `None` for a connection error
+
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self.counts["requests"] += 1
+            if status is None or status >= 500 or status == 429:
+                self.counts["throttled" if status == 429 else "errors"] += 1
+                self._decrease(self.backoff)
+            else:
+                self.recent = latency if self.recent is None else\
+                    0.8 * self.recent + 0.2 * latency
+                self.baseline = latency if self.baseline is None else\
+                    0.98 * self.baseline + 0.02 * latency
+                if self.counts["requests"] > 20 and\
+                   self.recent > self.latency_factor * self.baseline:
+                    self.counts["latency_backoffs"] += 1
+                    self._decrease(0.9)
+                elif self.in_flight + 1 >= int(self.limit):
+                    # Only grow when the limit is actually in use
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"limit": int(self.limit), "in_flight": self.in_flight,
+                    "rate": self.rate or None,
+                    "recent_ms": self.recent and round(self.recent * 1000, 1),
+                    "baseline_ms": self.baseline and round(self.baseline * 1000, 1),
+                    **self.counts}
+
+
+class UpstreamLimits:
+    """Adaptive concurrency limits of all the upstream hosts.
+
+    HTTP requests made through :meth:`get` and :meth:`post` wait for a slot
+    of their host's :class:`AdaptiveLimit` and report their outcome to it.
+    Failures to connect to a proxy aren't reported, as the host wasn't
+    contacted.
+    A `Retry-After` with a 429 or a 503 pauses all the requests to the host.
+    The limits are saved to `state_file` periodically and on :meth:`stop`,
+    and used as the initial limits on the next start.
+
+    Limits are per process, so with several workers the total concurrency
+    to a host is up to the number of workers times the limit.
+
+    """
+    def __init__(self):
+        self.initial = 16
+        self.min_limit = 1
+        self.max_limit = 64
+        self.rates: Dict[str, float] = {}
+        self.state_file = ""
+        self.save_interval = 60.0
+        self._saved: Dict[str, float] = {}
+        self._limits: Dict[str, AdaptiveLimit] = {}
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Limits learnt before a fork are kept as initial limits
+        self._saved.update({h: x.limit for h, x in self._limits.items()})
+        self._limits = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def configure(self, initial: int = 16, max_limit: int = 64,
+                  rates: Dict[str, float] = {}, state_file: str = "",
+                  save_interval: float = 60):
+        """Configure the limits.
+
+        Args:
+            initial: Initial limit of hosts without a saved limit
+            max_limit: Maximum limit of any host
+            rates: Maximum requests per second by host or by upstream name,
+                   e.g., `dblp`
+            state_file: File where the limits are saved
+            save_interval: Seconds between saves
+
+        """
+        self.initial = initial
+        self.max_limit = max_limit
+        self.rates = {host_of(upstream[k]) if k in upstream else k.lower(): v
+                      for k, v in rates.items()}
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self._limits = {}
+        self._saved = {}
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    self._saved = {k: v["limit"] for k, v in json.load(f).items()}
+            except (json.JSONDecodeError, KeyError, TypeError):
+                pass
+
+    def limit_for(self, url: str) -> AdaptiveLimit:
+        "The :class:`AdaptiveLimit` of the host of `url`."
+        host = host_of(url)
+        with self._lock:
+            if self.state_file and self._thread is None:
+                # Started lazily so that it runs in the worker processes
+                self._thread = Thread(target=self._save_loop, daemon=True)
+                self._thread.start()
+            if host not in self._limits:
+                self._limits[host] = AdaptiveLimit(host, self._saved.get(host, self.initial),
+                                                   self.min_limit, self.max_limit,
+                                                   self.rates.get(host, 0))
+            return self._limits[host]
+
+    def window(self, url: str) -> Callable[[], int]:
+        "Function returning the current limit of the host of `url`."
+        limit = self.limit_for(url)
+        return lambda: int(limit.limit)
+
+    def request(self, method: Callable[..., requests.Response], url: str,
+                **kwargs) -> requests.Response:
+        "Make a request with `method`, e.g., :func:`requests.get`, within the limit."
+        limit = self.limit_for(url)
+        limit.acquire()
+        start = time.monotonic()
+        status = None
+        proxy_failed = False
+        try:
+            response = method(url, **kwargs)
+            status = response.status_code
+            if status in {429, 503} and "Retry-After" in response.headers:
+                limit.pause(retry_after(response))
+            return response
+        except requests.exceptions.ConnectionError as e:
+            # With a proxy the only connection made is to the proxy
+            proxy_failed = isinstance(e, requests.exceptions.ProxyError) or\
+                isinstance(e, requests.exceptions.ConnectTimeout) and\
+                bool(select_proxy(url, kwargs.get("proxies")))
+            raise
+        finally:
+            if proxy_failed:
+                limit.cancel()
+            else:
+                limit.release(time.monotonic() - start, status)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request(requests.get, url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request(requests.post, url, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        names = {host_of(v): k for k, v in upstream.items()}
+        with self._lock:
+            limits = [*self._limits.values()]
+        return {x.host: {"upstream": names.get(x.host), **x.stats()} for x in limits}
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            state = {**{k: {"limit": v} for k, v in self._saved.items()},
+                     **{h: {"limit": round(x.limit, 2), "baseline_ms": x.stats()["baseline_ms"]}
+                        for h, x in self._limits.items() if x.counts["requests"]}}
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.state_file) or ".",
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(state, f)
+        os.replace(f.name, self.state_file)
+
+    def _save_loop(self):
+        while not self._stop.wait(self.save_interval):
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self.save()
+        except OSError:
+            pass
+
+
+limits = UpstreamLimits()
@@ -1,3 +1,5 @@
+import os
+
 ACCEPT = "text/html,application/xhtml+xml,application/xml;" +\
     "q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8," +\
     "application/signed-exchange;v=b3;q=0.9"
@@ -9,3 +11,13 @@ default_headers = {"accept": ACCEPT,
                    "cache-control": "no-cache",
                    "user-agent": USER_AGENT}
 __version__ = "0.3.1"
+
+
+# Base urls of the upstream services. These can be overridden from the
+# environment, e.g., to point the server at local stand-ins for load testing.
+upstream = {"dblp": os.environ.get("REF_MAN_DBLP_URL", "https://dblp.uni-trier.de"),
+            "arxiv": os.environ.get("REF_MAN_ARXIV_URL", "http://export.arxiv.org"),
+            "ss_api": os.environ.get("REF_MAN_SS_API_URL", "https://api.semanticscholar.org"),
+            "ss_search": os.environ.get("REF_MAN_SS_SEARCH_URL",
+                                        "https://www.semanticscholar.org")}
+proxy_check_url = os.environ.get("REF_MAN_PROXY_CHECK_URL", "http://google.com")
@@ -4,7 +4,11 @@ import json
 import requests
 import queue
 
+from .const import upstream
 from .q_helper import QHelper
+from .singleflight import single_flight
+from .tracing import tracer
+from .concurrency import limits
 
 
 class _DBLPHelper:
@@ -15,6 +19,7 @@ class _DBLPHelper:
 
     verbose = False
     proxies = None
+    proxy_monitor = None
 
     @classmethod
     def dblp_fetch(cls, query: str, q: queue.Queue, ret_type: str = "json", verbose=False):
@@ -31,10 +36,30 @@ class _DBLPHelper:
         if verbose or cls.verbose:
             print(f"Fetching from DBLP, query: {query}\n")
         if ret_type == "json":
-            response = requests.get(f"https://dblp.uni-trier.de/search/publ/api" +
-                                    f"?q={query}&format=json",
-                                    proxies=cls.proxies)
-            q.put((query, response))
+            url = f"{upstream['dblp']}/search/publ/api?q={query}&format=json"
+            # proxies can be a function which returns the currently healthy proxies
+            proxies = cls.proxies() if callable(cls.proxies) else cls.proxies
+
+            def fetch():
+                with tracer.span("dblp_fetch", "dblp", query=query,
+                                 proxy=bool(proxies)) as span:
+                    if not proxies:
+                        return limits.get(url)
+                    monitor = cls.proxy_monitor
+                    try:
+                        return limits.get(url, proxies=proxies,
+                                          timeout=(monitor and monitor.timeout, None))
+                    except (requests.exceptions.ConnectTimeout,
+                            requests.exceptions.ProxyError):
+                        if verbose or cls.verbose:
+                            print(f"Proxy failed for query: {query}. Fetching without proxy\n")
+                        span["proxy_failed"] = True
+                        if monitor:
+                            monitor.report_failure("everything")
+                        return limits.get(url)
+            # Identical queries in flight from overlapping batches share one request
+            key = ("dblp", " ".join(query.lower().split()))
+            q.put((query, single_flight.do(key, fetch)))
         else:
             q.put((query, "INVALID"))
 
@@ -46,7 +71,8 @@ class _DBLPHelper:
         results are finally stored.
 
         """
-        result = json.loads(response.content)["result"]
+        with tracer.span("dblp_parse", "dblp", query=query):
+            result = json.loads(response.content)["result"]
         if result and "hits" in result and "hit" in result["hits"]:
             content[query] = []
             for hit in result["hits"]["hit"]:
@@ -88,8 +114,19 @@ class _DBLPHelper:
             content[query] = [f"ERROR"]
 
 
-def dblp_helper(proxies=None, verbose=False) -> Tuple[Callable, QHelper]:
+def dblp_helper(proxies=None, verbose=False, proxy_monitor=None) -> Tuple[Callable, QHelper]:
+    """Fetch function and helper for DBLP queries.
+
+    Args:
+        proxies: Proxies or a function returning the currently healthy proxies
+        verbose: Print the queries
+        proxy_monitor: :class:`~ref_man.proxy.ProxyMonitor` whose `everything`
+                       proxy is used. Its probe timeout is the connect timeout
+                       of proxied requests and failures are reported to it.
+
+    """
     _DBLPHelper.proxies = proxies
+    _DBLPHelper.proxy_monitor = proxy_monitor
     _DBLPHelper.verbose = verbose
     return _DBLPHelper.dblp_fetch, QHelper(_DBLPHelper._dblp_success,
                                            _DBLPHelper._dblp_no_result,
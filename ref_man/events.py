@@ -0,0 +1,265 @@
+from typing import Dict, List, Optional, Any, Iterator, Set, Tuple
+import os
+import json
+import time
+import fcntl
+from queue import Queue, Empty, Full
+from threading import Condition, Thread
+
+
+class Subscription:
+    """Events of some topics for one client of :class:`EventBus`.
+
+    Args:
+        topics: The topics. All topics if empty
+        max_queued: Maximum events waiting to be sent. A client which falls
+                    further behind is dropped and reconnects with the id of
+                    the last event it got.
+
+    """
+    def __init__(self, topics: Set[str], max_queued: int = 1024):
+        self.topics = topics
+        self.queue: Queue = Queue(max_queued)
+        self.closed = False
+
+    def wants(self, topic: str) -> bool:
+        return not self.topics or topic in self.topics
+
+    def offer(self, item: Optional[Tuple[str, str, str]]) -> bool:
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Full:
+            self.closed = True
+            return False
+
+
+class EventBus:
+    """Progress events pushed to clients as server-sent events.
+
+    Events are appended as JSON lines to `path` so that they reach the
+    clients connected to any of the server workers. In each worker with
+    subscribers, a thread follows the file, checking it every
+    `poll_interval` seconds and at once for events published by the worker
+    itself, and passes new events to the subscribers of their topic.
+
+    The id of an event is the inode of the file and the offset after the
+    event, so that a client reconnecting with `Last-Event-ID` gets the
+    events it missed. The file is rotated to `path.1` when it's larger than
+    `max_size`. Events are lost to other workers only if it's rotated twice
+    within `poll_interval`.
+
+    Without a `path` events are only delivered within the process.
+
+    Args:
+        max_size: Size in bytes beyond which the file is rotated
+        poll_interval: Seconds between checks for events of other workers
+        keepalive: Seconds after which an idle stream sends a comment, so
+                   that closed connections are noticed
+
+    """
+    def __init__(self, max_size: int = 2**20, poll_interval: float = 0.1,
+                 keepalive: float = 15):
+        self.path = ""
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = Condition()
+        self._subscribers: List[Subscription] = []
+        self._thread: Optional[Thread] = None
+        self._file = None
+        self._inode = 0
+        self._pos = 0
+        self._seq = 0
+        self._stopped = False
+
+    def configure(self, path: str = "", max_size: int = 2**20, poll_interval: float = 0.1,
+                  keepalive: float = 15):
+        self.path = path
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+
+    def publish(self, topic: str, data: Dict[str, Any]):
+        "Publish `data` to the subscribers of `topic`."
+        line = json.dumps({"topic": topic, "time": time.time(), "pid": os.getpid(),
+                           "data": data})
+        if not self.path:
+            with self._cond:
+                self._seq += 1
+                self._deliver(str(self._seq), topic, line)
+            return
+        try:
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_size:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            print(f"Error {e} publishing {topic} event")
+            return
+        with self._cond:
+            self._cond.notify_all()
+
+    def _deliver(self, event_id: str, topic: str, line: str):
+        for sub in [*self._subscribers]:
+            if sub.wants(topic) and not sub.offer((event_id, topic, line)):
+                self._subscribers.remove(sub)
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            self._file = open(self.path, "rb")
+        except FileNotFoundError:
+            open(self.path, "a").close()
+            self._file = open(self.path, "rb")
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._pos = 0
+
+    def _read(self) -> List[Tuple[str, str, str]]:
+        "New complete events in the current file."
+        self._file.seek(self._pos)
+        chunk = self._file.read()
+        # A partly written event is read on the next pass
+        end = chunk.rfind(b"\n") + 1
+        events = []
+        pos = self._pos
+        for raw in chunk[:end].splitlines(keepends=True):
+            pos += len(raw)
+            try:
+                topic = json.loads(raw)["topic"]
+            except (ValueError, KeyError):
+                continue
+            events.append((f"{self._inode}:{pos}", topic, raw.decode().rstrip("\n")))
+        self._pos += end
+        return events
+
+    def _rotated(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def _follow(self):
+        with self._cond:
+            while self._subscribers and not self._stopped:
+                for event in self._read():
+                    self._deliver(*event)
+                if self._rotated():
+                    # Events written before the rotation are still in the old file
+                    for event in self._read():
+                        self._deliver(*event)
+                    self._open()
+                    continue
+                self._cond.wait(self.poll_interval)
+            self._thread = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def subscribe(self, topics: Set[str] = set(),
+                  last_id: Optional[str] = None) -> Subscription:
+        """Subscribe to `topics`, or to all topics if empty.
+
+        Args:
+            topics: The topics
+            last_id: Id of the last event the client got. The later events
+                     still in the file are sent first.
+
+        """
+        sub = Subscription(set(topics))
+        with self._cond:
+            if self.path and self._thread is None:
+                self._open()
+                self._file.seek(0, os.SEEK_END)
+                self._pos = self._file.tell()
+                self._thread = Thread(target=self._follow, daemon=True)
+                self._thread.start()
+            if self.path and last_id:
+                self._replay(sub, last_id)
+            self._subscribers.append(sub)
+        return sub
+
+    def _replay(self, sub: Subscription, last_id: str):
+        try:
+            inode, offset = map(int, last_id.split(":"))
+        except ValueError:
+            return
+        if inode != self._inode or offset >= self._pos:
+            return
+        self._file.seek(offset)
+        for raw in self._file.read(self._pos - offset).splitlines(keepends=True):
+            offset += len(raw)
+            try:
+                topic = json.loads(raw)["topic"]
+            except (ValueError, KeyError):
+                continue
+            if sub.wants(topic):
+                sub.offer((f"{inode}:{offset}", topic, raw.decode().rstrip("\n")))
+
+    def unsubscribe(self, sub: Subscription):
+        with self._cond:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            sub.closed = True
+
+    def stream(self, sub: Subscription,
+               initial: List[Tuple[str, Dict[str, Any]]] = []) -> Iterator[str]:
+        """Server-sent events of `sub`.
+
+        Args:
+            sub: The subscription
+            initial: Events as `(topic, data)` sent first without an id,
+                     e.g., the current state of a topic
+
+        """
+        try:
+            yield "retry: 2000\n\n"
+            for topic, data in initial:
+                yield format_event(topic, json.dumps({"topic": topic, "time": time.time(),
+                                                      "pid": os.getpid(), "data": data}))
+            while True:
+                try:
+                    item = sub.queue.get(timeout=self.keepalive)
+                except Empty:
+                    if sub.closed:
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    return
+                event_id, topic, line = item
+                yield format_event(topic, line, event_id)
+        finally:
+            self.unsubscribe(sub)
+
+    def stop(self):
+        "End all the streams of this process."
+        with self._cond:
+            self._stopped = True
+            for sub in self._subscribers:
+                sub.closed = True
+                sub.offer(None)
+            self._subscribers = []
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"subscribers": len(self._subscribers), "path": self.path,
+                    "following": self._thread is not None}
+
+
+def format_event(topic: str, line: str, event_id: Optional[str] = None) -> str:
+    "Format an event as in the `text/event-stream` format."
+    return (f"id: {event_id}\n" if event_id else "") + f"event: {topic}\ndata: {line}\n\n"
+
+
+events = EventBus()
@@ -0,0 +1,252 @@
+from typing import Dict, List, Set, Tuple, Optional, Any
+import os
+import re
+import time
+import fcntl
+import logging
+import tempfile
+from threading import Thread, Event
+
+from .id_index import IdIndex
+from .semantic_scholar import SSCache, _paper_id_regexp
+
+
+_org_prop_regexp = re.compile(r"^[ \t]*:(PAPERID|DOI|ARXIVID):[ \t]*(\S+)", re.MULTILINE)
+_org_prop_types = {"PAPERID": "ss", "DOI": "doi", "ARXIVID": "arxiv"}
+
+
+def compact_metadata(data_dir: str, remove: Set[str]) -> int:
+    """Remove the lines of `metadata` in `data_dir` for paperIds in `remove`.
+
+    The bulk of the file is rewritten and its index rebuilt without holding
+    the lock, so that :func:`~ref_man.semantic_scholar.append_metadata` isn't
+    blocked for long. Lines appended in the meantime, which may be for papers
+    fetched again, are copied as they are under the lock just before the new
+    file and index replace the old ones. Servers pick up the new file with
+    :meth:`~ref_man.semantic_scholar.SSCache.refresh`.
+
+    Returns:
+        The number of lines removed.
+
+    """
+    metadata_file = os.path.join(data_dir, "metadata")
+    index_file = metadata_file + ".idx"
+    removed = 0
+
+    def copy(src, dst, check: bool = True) -> int:
+        nonlocal removed
+        pos = src.tell()
+        for line in src:
+            if not line.endswith(b"\n"):
+                break
+            pos += len(line)
+            if check and line.rstrip(b"\n").rsplit(b",", 1)[-1].decode() in remove:
+                removed += 1
+            else:
+                dst.write(line)
+        return pos
+
+    with open(metadata_file, "rb") as src,\
+            tempfile.NamedTemporaryFile("wb", dir=data_dir, suffix=".tmp", delete=False) as dst:
+        end = copy(src, dst)
+    IdIndex.build(dst.name, dst.name + ".idx")
+    with open(index_file + ".lock", "w") as index_lock:
+        fcntl.flock(index_lock, fcntl.LOCK_EX)
+        with open(metadata_file, "rb") as src:
+            fcntl.flock(src, fcntl.LOCK_EX)
+            src.seek(end)
+            with open(dst.name, "ab") as f:
+                copy(src, f, False)
+            os.replace(dst.name + ".idx", index_file)
+            os.replace(dst.name, metadata_file)
+    return removed
+
+
+class CacheEvictor:
+    """Keep the Semantic Scholar cache in `data_dir` within a disk budget.
+
+    Reads from the cache set the access time of the paper files. When the
+    paper files take more than `budget` bytes, the least recently accessed
+    ones are removed until they're within `low_water` of the budget, along
+    with their lines in `metadata` and the index.
+
+    Pinned papers are never evicted. They are listed in the `pinned` file in
+    `data_dir`, one per line, either as a `paperId` or as `id_type:ID`, e.g.,
+    `doi:10.18653/v1/N19-1423`. Papers referred to by the `PAPERID`, `DOI`
+    or `ARXIVID` properties in org files under `org_dirs` are also pinned.
+
+    Args:
+        data_dir: Directory where the cache is located
+        ss_cache: The Semantic Scholar cache
+        budget: Disk budget in bytes. If 0, the cache isn't evicted
+        logger: Logger instance
+        interval: Seconds between checks
+        org_dirs: Directories with org files to scan for pinned papers
+        low_water: Fraction of the budget to which the cache is reduced
+
+    """
+    def __init__(self, data_dir: str, ss_cache: SSCache, budget: int,
+                 logger: logging.Logger, interval: float = 600,
+                 org_dirs: List[str] = [], low_water: float = 0.9):
+        self.data_dir = data_dir
+        self.ss_cache = ss_cache
+        self.budget = budget
+        self.logger = logger
+        self.interval = interval
+        self.org_dirs = org_dirs
+        self.low_water = low_water
+        self.pin_file = os.path.join(data_dir, "pinned")
+        self.lock_file = os.path.join(data_dir, "metadata.evict.lock")
+        self.last_run: Dict[str, Any] = {}
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def _resolve(self, id_type: str, ID: str) -> Optional[str]:
+        if id_type == "ss":
+            return ID
+        elif id_type in self.ss_cache:
+            return self.ss_cache[id_type].get(ID)
+        return None
+
+    def _read_pins(self) -> List[Tuple[str, str]]:
+        pins = []
+        try:
+            with open(self.pin_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if ":" in line:
+                        id_type, ID = line.split(":", 1)
+                        pins.append((id_type, ID))
+                    else:
+                        pins.append(("ss", line))
+        except FileNotFoundError:
+            pass
+        return pins
+
+    def _org_pins(self) -> List[Tuple[str, str]]:
+        pins = []
+        for org_dir in self.org_dirs:
+            for root, _, files in os.walk(os.path.expanduser(org_dir)):
+                for fname in files:
+                    if not fname.endswith(".org"):
+                        continue
+                    try:
+                        with open(os.path.join(root, fname), errors="ignore") as f:
+                            text = f.read()
+                    except OSError:
+                        continue
+                    pins.extend((_org_prop_types[p.upper()], ID)
+                                for p, ID in _org_prop_regexp.findall(text))
+        return pins
+
+    def pinned(self) -> Set[str]:
+        "The paperIds of all the pinned papers."
+        result = set()
+        for id_type, ID in self._read_pins() + self._org_pins():
+            paper_id = self._resolve(id_type, ID)
+            if paper_id:
+                result.add(paper_id)
+        return result
+
+    def pin(self, id_type: str, ID: str):
+        "Pin paper `ID` of `id_type`."
+        line = ID if id_type == "ss" else f"{id_type}:{ID}"
+        with open(self.pin_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line + "\n")
+
+    def unpin(self, id_type: str, ID: str):
+        "Unpin paper `ID` of `id_type` if it was pinned in the `pinned` file."
+        pins = [p for p in self._read_pins() if p != (id_type, ID)]
+        with tempfile.NamedTemporaryFile("w", dir=self.data_dir, suffix=".tmp",
+                                         delete=False) as f:
+            f.write("".join((x if t == "ss" else f"{t}:{x}") + "\n" for t, x in pins))
+        os.replace(f.name, self.pin_file)
+
+    def usage(self) -> Tuple[int, List[Tuple[float, int, str, float]]]:
+        """Disk usage of the paper files.
+
+        Returns:
+            Total size in bytes and a list of access time, size, `paperId` and
+            modification time of each paper file.
+
+        """
+        total = 0
+        files = []
+        with os.scandir(self.data_dir) as it:
+            for entry in it:
+                if _paper_id_regexp.match(entry.name):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    total += st.st_size
+                    files.append((st.st_atime, st.st_size, entry.name, st.st_mtime))
+        return total, files
+
+    def evict(self) -> Dict[str, Any]:
+        """Evict the least recently accessed papers if the cache is over budget.
+
+        Only one process evicts at a time.
+
+        Returns:
+            A summary of the run.
+
+        """
+        start = time.time()
+        total, files = self.usage()
+        result: Dict[str, Any] = {"time": start, "bytes": total, "files": len(files),
+                                  "budget": self.budget, "evicted": 0, "freed": 0}
+        if not self.budget or total <= self.budget:
+            self.last_run = result
+            return result
+        with open(self.lock_file, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                result["error"] = "Eviction running in another worker"
+                return result
+            pinned = self.pinned()
+            target = total - self.budget * self.low_water
+            victims: Set[str] = set()
+            freed = 0
+            for atime, size, paper_id, _ in sorted(files):
+                if freed >= target:
+                    break
+                if paper_id not in pinned:
+                    victims.add(paper_id)
+                    freed += size
+            self.logger.info(f"Evicting {len(victims)} papers ({freed} bytes) " +
+                             f"from Semantic Scholar cache of {total} bytes")
+            lines = compact_metadata(self.data_dir, victims)
+            mtimes = {paper_id: mtime for _, _, paper_id, mtime in files}
+            for paper_id in victims:
+                path = os.path.join(self.data_dir, paper_id)
+                try:
+                    # Skip papers fetched again in the meantime
+                    if os.stat(path).st_mtime <= mtimes[paper_id]:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.ss_cache.refresh()
+        result.update({"evicted": len(victims), "freed": freed, "metadata_lines": lines,
+                       "pinned": len(pinned), "seconds": round(time.time() - start, 2)})
+        self.last_run = result
+        return result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evict()
+            except Exception as e:
+                self.logger.error(f"Error {e} while evicting Semantic Scholar cache")
+
+    def start(self):
+        if self.budget and self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,254 @@
+"""Ingest Semantic Scholar bulk dataset files into the local cache.
+
+Usage:
+    python -m ref_man.ingest -d <data_dir> [options] files...
+
+The files are gzipped (or plain) JSONL of the Semantic Scholar Open Research
+Corpus, the Datasets API `papers` dataset or records as returned by the
+`/v1/paper` API. Records are written in the format used by
+:func:`~ref_man.semantic_scholar.save_data`, so running servers pick them up
+on the next cache miss.
+
+"""
+from typing import Dict, List, Iterator, Iterable, Optional, Set, Any, IO
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+
+from .semantic_scholar import normalize_id, append_metadata
+
+
+def open_dump(path: str) -> IO[bytes]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    else:
+        return open(path, "rb")
+
+
+def _paper_id(url: str) -> str:
+    return url.rstrip("/").rsplit("/", 1)[-1] if url else ""
+
+
+def to_record(raw: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Convert a bulk dataset record to the `/v1/paper` format of the cache.
+
+    Citations and references in the dumps have only ids, so they're kept as
+    :code:`{"paperId": ...}` entries.
+
+    Returns:
+        The record or `None` if it doesn't have a `paperId`. The ACL id, which
+        isn't part of the format, is returned as `_acl`.
+
+    """
+    if "paperId" in raw:        # API format
+        return raw
+    elif "corpusid" in raw:     # Datasets API papers
+        ext = raw.get("externalids") or {}
+        paper_id = _paper_id(raw.get("url") or "")
+        if not paper_id:
+            return None
+        fields = [f["category"] for f in raw.get("s2fieldsofstudy") or []]
+        return {"paperId": paper_id, "corpusId": raw["corpusid"],
+                "arxivId": ext.get("ArXiv"), "doi": ext.get("DOI"),
+                "title": raw.get("title"), "abstract": raw.get("abstract"),
+                "authors": [{"authorId": a.get("authorId"), "name": a.get("name")}
+                            for a in raw.get("authors") or []],
+                "venue": raw.get("venue") or "", "year": raw.get("year"),
+                "fieldsOfStudy": sorted(set(fields)) or None,
+                "numCitedBy": raw.get("citationcount"),
+                "numCiting": raw.get("referencecount"),
+                "isOpenAccess": raw.get("isopenaccess"),
+                "url": raw.get("url"), "citations": [], "references": [],
+                "_acl": ext.get("ACL")}
+    elif "id" in raw:           # Open Research Corpus
+        return {"paperId": raw["id"], "corpusId": raw.get("corpusId"),
+                "arxivId": raw.get("arxivId"), "doi": raw.get("doi") or None,
+                "title": raw.get("title"), "abstract": raw.get("paperAbstract"),
+                "authors": [{"authorId": (a.get("ids") or [None])[0], "name": a.get("name")}
+                            for a in raw.get("authors") or []],
+                "venue": raw.get("venue") or raw.get("journalName") or "",
+                "year": raw.get("year"),
+                "fieldsOfStudy": raw.get("fieldsOfStudy") or None,
+                "numCitedBy": len(raw.get("inCitations") or []),
+                "numCiting": len(raw.get("outCitations") or []),
+                "url": raw.get("s2Url") or f"https://www.semanticscholar.org/paper/{raw['id']}",
+                "citations": [{"paperId": x} for x in raw.get("inCitations") or []],
+                "references": [{"paperId": x} for x in raw.get("outCitations") or []],
+                "_acl": None}
+    return None
+
+
+def record_ids(record: Dict[str, Any]) -> List[str]:
+    "All the identifiers of `record` normalized for matching an allowlist."
+    ids = [record["paperId"], str(record.get("corpusId") or "")]
+    for id_type, key in [("arxiv", "arxivId"), ("doi", "doi"), ("acl", "_acl")]:
+        if record.get(key):
+            ids.append(normalize_id(id_type, record[key]))
+    return [x for x in ids if x]
+
+
+def read_allowlist(path: str) -> Set[str]:
+    """Read an allowlist with one id per line.
+
+    Ids can be Semantic Scholar `paperId`, `corpusId`, DOI, arXiv or ACL ids
+    and may be prefixed with their type like the API, e.g., `arXiv:2001.00001`.
+
+    """
+    prefixes = {"arxiv": "arxiv", "doi": "doi", "acl": "acl", "corpusid": "corpus"}
+    ids = set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            id_type = ""
+            if ":" in line and line.split(":", 1)[0].lower() in prefixes:
+                prefix, line = line.split(":", 1)
+                id_type = prefixes[prefix.lower()]
+            ids.add(normalize_id(id_type or ("doi" if line.startswith("10.") else ""), line))
+    return ids
+
+
+class Ingester:
+    """Write records to the Semantic Scholar cache in batches.
+
+    Records are buffered and each batch is written as one file per paper
+    followed by a single append of all the identifier mappings to `metadata`
+    with :func:`~ref_man.semantic_scholar.append_metadata`. Memory is bounded
+    by `batch_size`.
+
+    Args:
+        data_dir: Directory where the cache is located
+        batch_size: Number of records written at a time
+        overwrite: Overwrite papers already in the cache
+
+    """
+    def __init__(self, data_dir: str, batch_size: int = 5000, overwrite: bool = False):
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+        self.batch: List[Dict[str, Any]] = []
+        self.written = 0
+        self.skipped = 0
+
+    def add(self, record: Dict[str, Any]):
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        lines = []
+        pid = os.getpid()
+        for record in self.batch:
+            path = os.path.join(self.data_dir, record["paperId"])
+            if not self.overwrite and os.path.exists(path):
+                self.skipped += 1
+                continue
+            acl_id = record.pop("_acl", None)
+            tmp = f"{path}.{pid}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(record, f)
+            os.replace(tmp, path)
+            lines.append(",".join([acl_id or "", record.get("arxivId") or "",
+                                   str(record.get("corpusId") or ""),
+                                   record.get("doi") or "", record["paperId"]]))
+        if lines:
+            append_metadata(self.data_dir, lines)
+        self.written += len(lines)
+        self.batch = []
+
+
+def iter_records(paths: Iterable[str], fields_of_study: List[str] = [],
+                 allowlist: Optional[Set[str]] = None,
+                 stats: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+    """Stream the records in `paths` which match the filters.
+
+    Args:
+        paths: Dump files
+        fields_of_study: Keep only records in any of these fields of study
+        allowlist: Keep only records with any of these ids.
+                   See :func:`read_allowlist`
+        stats: Updated with the number of lines `read` and records `matched`
+
+    """
+    if stats is None:
+        stats = {}
+    stats.update({"read": 0, "matched": 0})
+    fos = set(fields_of_study)
+    fos_bytes = [f.encode() for f in fields_of_study]
+    for path in paths:
+        with open_dump(path) as f:
+            for line in f:
+                stats["read"] += 1
+                # Cheap check on the raw line before parsing
+                if fos_bytes and not any(x in line for x in fos_bytes):
+                    continue
+                record = to_record(json.loads(line))
+                if record is None:
+                    continue
+                if fos and not fos.intersection(record.get("fieldsOfStudy") or []):
+                    continue
+                if allowlist is not None and not allowlist.intersection(record_ids(record)):
+                    continue
+                stats["matched"] += 1
+                yield record
+
+
+def ingest(paths: List[str], data_dir: str, fields_of_study: List[str] = [],
+           allowlist: Optional[Set[str]] = None, batch_size: int = 5000,
+           overwrite: bool = False, report_every: int = 100000) -> Dict[str, Any]:
+    """Ingest dump files in `paths` into the cache in `data_dir`.
+
+    Returns:
+        Counts of lines read, records matched, written and skipped as they
+        were already in the cache, with the time taken and throughput.
+
+    """
+    ingester = Ingester(data_dir, batch_size, overwrite)
+    stats: Dict[str, int] = {}
+    start = time.time()
+    for record in iter_records(paths, fields_of_study, allowlist, stats):
+        ingester.add(record)
+        if stats["matched"] % report_every == 0:
+            rate = stats["read"] / (time.time() - start)
+            print(f"Read {stats['read']} records, matched {stats['matched']} " +
+                  f"({rate:.0f} records/sec)")
+    ingester.flush()
+    duration = time.time() - start
+    return {**stats, "written": ingester.written, "skipped": ingester.skipped,
+            "seconds": round(duration, 2),
+            "records_per_sec": round(stats["read"] / duration) if duration else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser("ref-man-ingest")
+    parser.add_argument("files", nargs="+", help="Semantic Scholar dump files (JSONL, maybe gzipped)")
+    parser.add_argument("--data-dir", "-d", dest="data_dir", type=str,
+                        default=os.path.expanduser("~"),
+                        help="Semantic Scholar cache directory")
+    parser.add_argument("--fields-of-study", dest="fields_of_study", type=str, default="",
+                        help="Comma separated fields of study to keep, e.g., \"Computer Science\"")
+    parser.add_argument("--ids", type=str, default="",
+                        help="File with ids to keep, one per line")
+    parser.add_argument("--batch-size", "-b", dest="batch_size", type=int, default=5000,
+                        help="Number of records written at a time")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Overwrite papers already in the cache")
+    args = parser.parse_args()
+    if not os.path.exists(args.data_dir):
+        print(f"Data dir {args.data_dir} doesn't exist")
+        sys.exit(1)
+    fields_of_study = [x.strip() for x in args.fields_of_study.split(",") if x.strip()]
+    allowlist = read_allowlist(args.ids) if args.ids else None
+    result = ingest(args.files, args.data_dir, fields_of_study, allowlist,
+                    args.batch_size, args.overwrite)
+    print(f"Read {result['read']} records, matched {result['matched']}, " +
+          f"wrote {result['written']}, skipped {result['skipped']} already in cache " +
+          f"in {result['seconds']}s ({result['records_per_sec']} records/sec)")
+
+
+if __name__ == '__main__':
+    main()
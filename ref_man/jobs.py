@@ -0,0 +1,282 @@
+from typing import Callable, Dict, List, Any, Optional, Union
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from queue import Queue
+from threading import Thread, Event, Lock
+
+from .batch import iter_batch
+from .events import events
+
+
+class Job:
+    """A batch of queries fetched in the background.
+
+    Args:
+        job_id: ID of the job
+        source: Name of the upstream source, e.g., `dblp`
+        queries: The queries
+
+    """
+    def __init__(self, job_id: str, source: str, queries: List[str]):
+        self.id = job_id
+        self.source = source
+        self.queries = queries
+        self.results: List[List[Any]] = []
+        self.failed: List[str] = []
+        self.status = "running"
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.cancel_ev = Event()
+
+    def to_dict(self, offset: Optional[int] = None) -> Dict[str, Any]:
+        """Status of the job.
+
+        `failed` lists the queries which failed on every attempt.
+
+        Args:
+            offset: If given, include results after the first `offset` ones
+
+        """
+        state = {"id": self.id, "source": self.source, "status": self.status,
+                 "total": len(self.queries), "done": len(self.results),
+                 "failed": self.failed,
+                 "created": self.created, "finished": self.finished}
+        if offset is not None:
+            state["offset"] = offset
+            state["results"] = dict(self.results[offset:])
+        return state
+
+
+class JobManager:
+    """Run batch fetches as background jobs.
+
+    A job is identified by a hash of its source and queries, so submitting the
+    same batch again while the job is running or retained returns the same job
+    and its results aren't fetched again. Finished jobs are kept for
+    `retention` seconds.
+
+    The state of each job is also written to `jobs_dir`, so that any of the
+    server workers can report its status and results, and a cancel file
+    signals the worker running the job to stop. The results are appended to
+    an NDJSON file, one `[query, result]` per line, and the JSON state file
+    only has the status and the number of results written, so that neither
+    is rewritten whole as the job progresses.
+
+    The status of a job, without its results, is published as a `job` event
+    when it starts, as it progresses and when it ends. See
+    :class:`~ref_man.events.EventBus`.
+
+    Args:
+        jobs_dir: Directory where the job states are kept
+        logger: Logger instance
+        retention: Seconds for which finished jobs are kept
+        save_interval: Minimum seconds between writes of a running job's state
+        event_interval: Minimum seconds between progress events of a job
+
+    """
+    def __init__(self, jobs_dir: str, logger: logging.Logger,
+                 retention: float = 3600, save_interval: float = 1,
+                 event_interval: float = 0.25):
+        self.jobs_dir = jobs_dir
+        self.logger = logger
+        self.retention = retention
+        self.save_interval = save_interval
+        self.event_interval = event_interval
+        self.jobs: Dict[str, Job] = {}
+        self._lock = Lock()
+        if not os.path.exists(jobs_dir):
+            os.makedirs(jobs_dir, exist_ok=True)
+
+    def _state_file(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id + ".json")
+
+    def _results_file(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id + ".ndjson")
+
+    def _cancel_file(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id + ".cancel")
+
+    def _save(self, job: Job):
+        state = job.to_dict()
+        state["pid"] = os.getpid()
+        with tempfile.NamedTemporaryFile("w", dir=self.jobs_dir, delete=False) as f:
+            json.dump(state, f)
+        os.replace(f.name, self._state_file(job.id))
+
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._state_file(job_id)) as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if state["status"] == "running" and state["pid"] != os.getpid():
+            try:
+                os.kill(state["pid"], 0)
+            except ProcessLookupError:
+                state["status"] = "failed"
+        return state
+
+    def _read_results(self, job_id: str, offset: int, done: int) -> List[List[Any]]:
+        "Results `offset` to `done` from the results file of job `job_id`."
+        results = []
+        try:
+            with open(self._results_file(job_id)) as f:
+                for i, line in enumerate(f):
+                    # Later lines may be partly written
+                    if i >= done:
+                        break
+                    if i >= offset:
+                        results.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        return results
+
+    def _expired(self, state: Dict[str, Any]) -> bool:
+        return state["status"] != "running" and\
+            time.time() - (state["finished"] or state["created"]) > self.retention
+
+    def cleanup(self) -> List[Dict[str, Any]]:
+        """Remove expired jobs.
+
+        Returns:
+            The states of the remaining jobs in `jobs_dir`.
+
+        """
+        with self._lock:
+            for job_id, job in [*self.jobs.items()]:
+                if self._expired(job.to_dict()):
+                    self.jobs.pop(job_id)
+        states = []
+        for fname in os.listdir(self.jobs_dir):
+            if fname.endswith(".json"):
+                state = self._load(fname[:-5])
+                if state is None:
+                    continue
+                if self._expired(state):
+                    self.logger.debug(f"Removing expired job {state['id']}")
+                    for f in [self._state_file(state["id"]), self._results_file(state["id"]),
+                              self._cancel_file(state["id"])]:
+                        if os.path.exists(f):
+                            os.remove(f)
+                else:
+                    states.append(state)
+        return states
+
+    def submit(self, source: str, queries: List[str], fetch_func: Callable[[str, Queue], None],
+               helper: Callable[[Queue], Dict], batch_size: Union[int, Callable[[], int]],
+               fetch_kwargs: Dict[str, Any] = {}) -> Dict[str, Any]:
+        """Start a job fetching `queries` from `source` unless one is already
+        running or retained.
+
+        See :func:`~ref_man.batch.iter_batch` for the rest of the arguments.
+
+        Returns:
+            The status of the job.
+
+        """
+        self.cleanup()
+        job_id = hashlib.sha1(json.dumps([source, queries]).encode()).hexdigest()[:16]
+        with self._lock:
+            state = self.status(job_id)
+            if state is not None and state["status"] in {"running", "finished"}:
+                self.logger.debug(f"Job {job_id} already exists")
+                return state
+            if os.path.exists(self._cancel_file(job_id)):
+                os.remove(self._cancel_file(job_id))
+            job = self.jobs[job_id] = Job(job_id, source, queries)
+            open(self._results_file(job_id), "w").close()
+            self._save(job)
+        events.publish("job", job.to_dict())
+        self.logger.info(f"Starting job {job_id} for {len(queries)} queries from {source}")
+        Thread(target=self._run, args=[job, fetch_func, helper, batch_size, fetch_kwargs],
+               daemon=True).start()
+        return job.to_dict()
+
+    def _run(self, job: Job, fetch_func: Callable[[str, Queue], None],
+             helper: Callable[[Queue], Dict], batch_size: Union[int, Callable[[], int]],
+             fetch_kwargs: Dict[str, Any]):
+        def cancelled() -> bool:
+            return job.cancel_ev.is_set() or os.path.exists(self._cancel_file(job.id))
+
+        # Stops waiting for the remaining queries as soon as the job is cancelled
+        results = iter_batch(job.queries, fetch_func, helper, batch_size, fetch_kwargs,
+                             failed=job.failed, should_stop=cancelled)
+        results_file = open(self._results_file(job.id), "a")
+        last_save = last_event = time.time()
+        try:
+            for query, result in results:
+                results_file.write(json.dumps([query, result]) + "\n")
+                job.results.append([query, result])
+                if time.time() - last_save > self.save_interval:
+                    # The results counted in the state must be on disk first
+                    results_file.flush()
+                    self._save(job)
+                    last_save = time.time()
+                if time.time() - last_event > self.event_interval:
+                    events.publish("job", job.to_dict())
+                    last_event = time.time()
+            job.status = "cancelled" if cancelled() else "finished"
+        except Exception as e:
+            self.logger.error(f"Error {e} in job {job.id}")
+            job.status = "failed"
+        finally:
+            results.close()
+            results_file.close()
+            job.finished = time.time()
+            self._save(job)
+            events.publish("job", job.to_dict())
+            self.logger.info(f"Job {job.id} {job.status} with " +
+                             f"{len(job.results)}/{len(job.queries)} results, " +
+                             f"{len(job.failed)} failed")
+
+    def status(self, job_id: str, offset: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Status of job `job_id` and optionally its results after `offset`.
+
+        Returns:
+            The status or `None` if there's no such job.
+
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict(offset)
+        state = self._load(job_id)
+        if state is None:
+            return None
+        state.pop("pid")
+        if offset is not None:
+            state["offset"] = offset
+            state["results"] = dict(self._read_results(job_id, offset, state["done"]))
+        return state
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel job `job_id`. Results fetched so far are kept.
+
+        Returns:
+            The status or `None` if there's no such job.
+
+        """
+        state = self.status(job_id)
+        if state is None:
+            return None
+        if state["status"] == "running":
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.cancel_ev.set()
+            else:
+                open(self._cancel_file(job_id), "w").close()
+        return state
+
+    def list(self) -> List[Dict[str, Any]]:
+        "Status of all the jobs."
+        states = {}
+        for state in self.cleanup():
+            state.pop("pid")
+            states[state["id"]] = state
+        # Jobs of this worker are more up to date in memory
+        with self._lock:
+            states.update({job_id: job.to_dict() for job_id, job in self.jobs.items()})
+        return sorted(states.values(), key=lambda x: x["created"])
@@ -0,0 +1,534 @@
+"""Load test harness for the ref-man server.
+
+Starts a :class:`~ref_man.server.Server` process with all its upstreams (DBLP,
+arXiv export, Semantic Scholar API and search and PDF hosts) redirected to a
+local stand-in, replays a request mix against it at a given concurrency and
+reports throughput, latency percentiles and peak RSS of the server.
+
+Usage:
+    python -m ref_man.load_test --concurrency 8 --requests 500 --batch-size 16
+
+The request mix is either synthetic (see :code:`--mix`) or replayed from a file
+with one JSON request per line of the form::
+
+    {"method": "POST", "path": "/dblp", "json": ["some title", ...]}
+    {"method": "GET", "path": "/semantic_scholar", "params": {"id": "...", "id_type": "ss"}}
+
+The string :code:`{upstream}` anywhere in a recorded request is replaced by the
+base url of the stand-in upstream, so recorded :code:`/fetch_proxy` urls can
+point at it.
+
+"""
+from typing import List, Dict, Any, Optional
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _fake_id(seed: str) -> str:
+    return hashlib.sha1(seed.encode()).hexdigest()
+
+
+class MockUpstream:
+    """Local stand-in for all the upstreams the server talks to.
+
+    Args:
+        latency: Mean latency in seconds added to every response
+        jitter: Maximum random jitter in seconds added to `latency`
+        error_rate: Fraction of requests answered with HTTP 500
+        rate_429: Fraction of requests answered with HTTP 429 and a `Retry-After`
+        pdf_size: Size in bytes of the PDFs served
+        citations: Number of citations in each Semantic Scholar record
+
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02,
+                 error_rate: float = 0.0, rate_429: float = 0.0,
+                 pdf_size: int = 512 * 1024, citations: int = 100):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.pdf = b"%PDF-1.4\n" + b"0" * max(0, pdf_size - 9)
+        self.citations = citations
+        self.counts: Dict[str, int] = {}
+        self._lock = Lock()
+        self.httpd: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, kind: str):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def dblp(self, query: str) -> bytes:
+        hits = [{"info": {"title": f"{query} {i}", "year": "2020", "type": "Conference",
+                          "venue": "NeurIPS", "key": f"conf/nips/{i}",
+                          "authors": {"author": [{"text": "Jane Doe"},
+                                                 {"text": "John Smith"}]}}}
+                for i in range(3)]
+        return json.dumps({"result": {"hits": {"hit": hits}}}).encode()
+
+    def arxiv(self, ids: List[str], title: str = "") -> bytes:
+        entries = "".join(f"""<entry><id>http://arxiv.org/abs/{i}{"" if re.search("v[0-9]+$", i) else "v1"}</id>
+<published>2020-01-01T00:00:00Z</published><updated>2020-02-01T00:00:00Z</updated>
+<title>{title or f"Paper {i}"}</title><summary>Abstract for {i}</summary>
+<author><name>Jane Doe</name></author><author><name>John Smith</name></author>
+<category term="cs.LG"/></entry>""" for i in ids)
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<feed xmlns="http://www.w3.org/2005/Atom">' + entries + "</feed>").encode()
+
+    def ss_paper(self, ID: str) -> bytes:
+        paper_id = ID if re.fullmatch("[0-9a-f]{40}", ID) else _fake_id(ID)
+        cites = [{"paperId": _fake_id(f"{ID}{i}"), "title": f"Citing paper {i}",
+                  "authors": [{"name": "Jane Doe", "authorId": "1"}],
+                  "year": 2021, "venue": "ArXiv", "arxivId": None, "doi": None,
+                  "intent": [], "isInfluential": False}
+                 for i in range(self.citations)]
+        return json.dumps({"paperId": paper_id, "title": f"Paper {ID}",
+                           "arxivId": ID[len("arXiv:"):] if ID.startswith("arXiv:") else None,
+                           "doi": ID if ID.startswith("10.") else None,
+                           "corpusId": int(_fake_id(ID)[:7], 16),
+                           "year": 2020, "venue": "NeurIPS", "abstract": "Abstract " * 50,
+                           "authors": [{"name": "Jane Doe", "authorId": "1"}],
+                           "citations": cites, "references": cites[:self.citations // 2]}).encode()
+
+    def ss_search(self, query: str) -> bytes:
+        return json.dumps({"results": [{"id": _fake_id(query + str(i)),
+                                        "title": {"text": f"{query} {i}"}}
+                                       for i in range(10)]}).encode()
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code: int, body: bytes = b"",
+                       content_type: str = "application/json",
+                       headers: Dict[str, str] = {}):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                parsed = urlparse(self.path)
+                args = parse_qs(parsed.query)
+                path = parsed.path
+                if path.startswith("/search/publ/api"):
+                    kind = "dblp"
+                elif path.startswith("/api/query"):
+                    kind = "arxiv"
+                elif path.startswith("/v1/paper/"):
+                    kind = "ss"
+                elif path.startswith("/api/1/search"):
+                    kind = "ss_search"
+                elif path.startswith("/pdf/"):
+                    kind = "pdf"
+                elif path == "/":
+                    # proxy and connectivity checks
+                    return self._reply(200, b"OK", "text/plain")
+                else:
+                    return self._reply(404, b"NOT FOUND", "text/plain")
+                mock.count(kind)
+                time.sleep(max(0, mock.latency + random.uniform(0, mock.jitter)))
+                roll = random.random()
+                if roll < mock.rate_429:
+                    mock.count("429")
+                    return self._reply(429, b"Too Many Requests", "text/plain",
+                                       {"Retry-After": "1"})
+                elif roll < mock.rate_429 + mock.error_rate:
+                    mock.count("500")
+                    return self._reply(500, b"Internal Server Error", "text/plain")
+                if kind == "dblp":
+                    self._reply(200, mock.dblp(args.get("q", [""])[0]))
+                elif kind == "arxiv" and "search_query" in args:
+                    title = re.sub(r'^ti:"|"$', "", args["search_query"][0])
+                    self._reply(200, mock.arxiv([f"2001.{int(_fake_id(title)[:4], 16):05d}"],
+                                                title), "application/atom+xml")
+                elif kind == "arxiv":
+                    ids = args.get("id_list", [""])[0].split(",")
+                    self._reply(200, mock.arxiv(ids), "application/atom+xml")
+                elif kind == "ss":
+                    self._reply(200, mock.ss_paper(unquote(path[len("/v1/paper/"):])))
+                elif kind == "ss_search":
+                    length = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    self._reply(200, mock.ss_search(body.get("queryString", "")))
+                else:
+                    self._reply(200, mock.pdf, "application/pdf")
+
+            do_GET = _handle
+            do_POST = _handle
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", _free_port()), Handler)
+        self.httpd.daemon_threads = True
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+class ServerProcess:
+    """A ref-man server in a subprocess with its upstreams pointed at `upstream_url`.
+
+    Args:
+        upstream_url: Base url of :class:`MockUpstream`
+        extra_args: Additional command line arguments for the server
+        data_dir: Semantic Scholar cache directory. A temporary one is created if
+                  not given.
+        log_file: File to which the server output is written. Discarded if not given.
+
+    """
+    def __init__(self, upstream_url: str, extra_args: List[str] = [],
+                 data_dir: Optional[str] = None, log_file: Optional[str] = None):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._tmp_dir = None if data_dir else tempfile.mkdtemp(prefix="ref_man_load_")
+        self.data_dir = data_dir or self._tmp_dir
+        metadata = os.path.join(self.data_dir, "metadata")
+        if not os.path.exists(metadata):
+            open(metadata, "w").close()
+        self.env = os.environ.copy()
+        for var in ["REF_MAN_DBLP_URL", "REF_MAN_ARXIV_URL",
+                    "REF_MAN_SS_API_URL", "REF_MAN_SS_SEARCH_URL"]:
+            self.env[var] = upstream_url
+        self.cmd = [sys.executable, "-m", "ref_man", "--port", str(self.port),
+                    "--data-dir", self.data_dir, "--verbosity", "error", *extra_args]
+        self.log_file = log_file
+        self.proc: Optional[subprocess.Popen] = None
+        self._peak_rss = 0
+        self._sampling = False
+
+    def start(self, timeout: float = 60) -> float:
+        """Start the server and wait till it answers `/version`.
+
+        Returns:
+            Seconds taken for the first successful `/version`.
+
+        """
+        start = self._start_time = time.perf_counter()
+        out = open(self.log_file, "w") if self.log_file else subprocess.DEVNULL
+        self.proc = subprocess.Popen(self.cmd, env=self.env, stdout=out,
+                                     stderr=subprocess.STDOUT)
+        while time.perf_counter() - start < timeout:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.proc.returncode}")
+            try:
+                if requests.get(f"{self.url}/version", timeout=1).status_code == 200:
+                    duration = time.perf_counter() - start
+                    self._sampling = True
+                    Thread(target=self._sample_rss, daemon=True).start()
+                    return duration
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.01)
+        raise TimeoutError(f"Server did not come up in {timeout} seconds")
+
+    def wait_ready(self, timeout: float = 60) -> float:
+        """Wait till `/ready` reports all subsystems ready.
+
+        Returns:
+            Seconds since the process was started.
+
+        """
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            try:
+                response = requests.get(f"{self.url}/ready", timeout=1)
+                if response.status_code == 200 and response.json()["ready"]:
+                    return time.perf_counter() - self._start_time
+            except (requests.exceptions.ConnectionError, ValueError):
+                pass
+            time.sleep(0.01)
+        raise TimeoutError(f"Server was not ready in {timeout} seconds")
+
+    def _rss(self) -> int:
+        try:
+            import psutil
+            proc = psutil.Process(self.proc.pid)
+            return sum(p.memory_info().rss for p in [proc, *proc.children(recursive=True)])
+        except Exception:
+            return 0
+
+    def _sample_rss(self):
+        while self._sampling:
+            self._peak_rss = max(self._peak_rss, self._rss())
+            time.sleep(0.1)
+
+    @property
+    def peak_rss(self) -> int:
+        """Peak resident memory of the server in bytes.
+
+        Read from :code:`VmHWM` where available, else sampled with :mod:`psutil`.
+
+        """
+        status = f"/proc/{self.proc.pid}/status"
+        if os.path.exists(status):
+            with open(status) as f:
+                match = re.search(r"VmHWM:\s+(\d+) kB", f.read())
+            if match:
+                return max(self._peak_rss, int(match.group(1)) * 1024)
+        return self._peak_rss
+
+    def stop(self):
+        self._sampling = False
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                requests.get(f"{self.url}/shutdown", timeout=5)
+                self.proc.wait(timeout=10)
+            except Exception:
+                self.proc.kill()
+                self.proc.wait()
+        if self._tmp_dir:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def synthetic_mix(n: int, weights: Dict[str, float], dblp_batch: int,
+                  ss_ids: int) -> List[Dict[str, Any]]:
+    """Generate `n` requests drawn from `weights`.
+
+    Keys of `weights` can be `dblp`, `arxiv`, `ss`, `ss_search` and `pdf`.
+    Semantic Scholar ids are drawn from a pool of `ss_ids` so that a realistic
+    fraction of the lookups are cache hits.
+
+    """
+    kinds = [*weights.keys()]
+    reqs = []
+    for i in range(n):
+        kind = random.choices(kinds, [weights[k] for k in kinds])[0]
+        if kind == "dblp":
+            reqs.append({"method": "POST", "path": "/dblp",
+                         "json": [f"title {i} {j}" for j in range(dblp_batch)]})
+        elif kind == "arxiv":
+            reqs.append({"method": "POST", "path": "/arxiv",
+                         "json": [f"2001.{i:05d}"]})
+        elif kind == "ss":
+            reqs.append({"method": "GET", "path": "/semantic_scholar",
+                         "params": {"id": _fake_id(str(random.randrange(ss_ids))),
+                                    "id_type": "ss"}})
+        elif kind == "ss_search":
+            reqs.append({"method": "GET", "path": "/semantic_scholar_search",
+                         "params": {"q": f"query {i}"}})
+        elif kind == "pdf":
+            reqs.append({"method": "GET", "path": "/fetch_proxy",
+                         "params": {"url": "{upstream}/pdf/" + f"{i}.pdf"}})
+        else:
+            raise ValueError(f"Unknown request kind {kind}")
+    return reqs
+
+
+def load_requests(path: str, upstream_url: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line.replace("{upstream}", upstream_url))
+                for line in f if line.strip()]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_load(server_url: str, reqs: List[Dict[str, Any]], concurrency: int,
+             upstream_url: str = "", timeout: float = 300) -> Dict[str, Any]:
+    """Replay `reqs` against `server_url` with `concurrency` parallel clients.
+
+    Returns:
+        A report with throughput and latency percentiles, overall and per path.
+
+    """
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    lock = Lock()
+    session_pool = [requests.Session() for _ in range(concurrency)]
+
+    def do(i_req):
+        i, req = i_req
+        session = session_pool[i % concurrency]
+        params = {k: v.replace("{upstream}", upstream_url) if isinstance(v, str) else v
+                  for k, v in req.get("params", {}).items()}
+        start = time.perf_counter()
+        try:
+            response = session.request(req.get("method", "GET"), server_url + req["path"],
+                                       params=params, json=req.get("json"),
+                                       timeout=timeout)
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        duration = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(req["path"], []).append(duration)
+            if not ok:
+                errors[req["path"]] = errors.get(req["path"], 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        [*pool.map(do, enumerate(reqs))]
+    wall = time.perf_counter() - start
+
+    def summary(values: List[float]) -> Dict[str, float]:
+        return {"count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values) if values else 0.0}
+    all_latencies = [x for v in latencies.values() for x in v]
+    return {"requests": len(reqs),
+            "concurrency": concurrency,
+            "wall_time": wall,
+            "throughput": len(reqs) / wall if wall else 0.0,
+            "errors": sum(errors.values()),
+            "latency": summary(all_latencies),
+            "paths": {k: {**summary(v), "errors": errors.get(k, 0)}
+                      for k, v in latencies.items()}}
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Requests: {report['requests']}, concurrency: {report['concurrency']}, " +
+          f"wall time: {report['wall_time']:.2f}s")
+    print(f"Throughput: {report['throughput']:.2f} req/s, errors: {report['errors']}")
+    if "startup_time" in report:
+        print(f"Time to first /version: {report['startup_time'] * 1000:.1f} ms")
+    if "peak_rss" in report:
+        print(f"Peak server RSS: {report['peak_rss'] / 2**20:.1f} MiB")
+    print(f"{'path':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for path, s in [("ALL", report["latency"]), *report["paths"].items()]:
+        print(f"{path:<28}{s['count']:>7}{s['p50'] * 1000:>10.1f}" +
+              f"{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}{s.get('errors', ''):>8}")
+    if "upstream_counts" in report:
+        print(f"Upstream requests: {report['upstream_counts']}")
+
+
+def startup_benchmark(upstream_url: str, runs: int,
+                      server_args: List[str]) -> Dict[str, Dict[str, float]]:
+    """Measure time to first `/version` and to `/ready` over `runs` server starts."""
+    times: Dict[str, List[float]] = {"version": [], "ready": []}
+    for _ in range(runs):
+        server = ServerProcess(upstream_url, server_args)
+        try:
+            times["version"].append(server.start())
+            times["ready"].append(server.wait_ready())
+        finally:
+            server.stop()
+    return {k: {"min": min(v), "p50": percentile(v, 50), "max": max(v)}
+            for k, v in times.items()}
+
+
+def parse_weights(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        k, v = item.split("=")
+        weights[k.strip()] = float(v)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser("ref-man-load-test")
+    parser.add_argument("--concurrency", "-c", type=int, default=8,
+                        help="Number of simultaneous clients")
+    parser.add_argument("--requests", "-n", type=int, default=200,
+                        help="Number of synthetic requests to send")
+    parser.add_argument("--mix", type=str, default="dblp=1,ss=4,ss_search=1,pdf=1",
+                        help="Weights of synthetic request kinds. " +
+                        "Kinds are dblp, arxiv, ss, ss_search and pdf")
+    parser.add_argument("--replay", type=str, default="",
+                        help="File with recorded requests, one JSON per line")
+    parser.add_argument("--dblp-batch", dest="dblp_batch", type=int, default=20,
+                        help="Number of titles in each synthetic /dblp request")
+    parser.add_argument("--ss-ids", dest="ss_ids", type=int, default=100,
+                        help="Size of the pool of Semantic Scholar ids")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Mean upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02,
+                        help="Maximum random jitter added to upstream latency")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0,
+                        help="Fraction of upstream requests which fail with 500")
+    parser.add_argument("--rate-429", dest="rate_429", type=float, default=0.0,
+                        help="Fraction of upstream requests which fail with 429")
+    parser.add_argument("--pdf-size", dest="pdf_size", type=int, default=512 * 1024,
+                        help="Size of PDFs served by the upstream in bytes")
+    parser.add_argument("--server", type=str, default="",
+                        help="Use an already running server at this url instead")
+    parser.add_argument("--server-log", dest="server_log", type=str, default="",
+                        help="Write the server output to this file")
+    parser.add_argument("--startup-runs", dest="startup_runs", type=int, default=0,
+                        help="Only benchmark server startup over these many runs")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON")
+    args, server_args = parser.parse_known_args()
+    mock = MockUpstream(args.latency, args.jitter, args.error_rate, args.rate_429,
+                        args.pdf_size).start()
+    if args.startup_runs:
+        try:
+            report = startup_benchmark(mock.url, args.startup_runs, server_args)
+        finally:
+            mock.stop()
+        for k, v in report.items():
+            print(f"Time to first /{k}: min {v['min'] * 1000:.1f} ms, " +
+                  f"p50 {v['p50'] * 1000:.1f} ms, max {v['max'] * 1000:.1f} ms")
+        return
+    server = None
+    report: Dict[str, Any] = {}
+    try:
+        if args.server:
+            server_url = args.server
+        else:
+            server = ServerProcess(mock.url, server_args, log_file=args.server_log or None)
+            report["startup_time"] = server.start()
+            server_url = server.url
+        if args.replay:
+            reqs = load_requests(args.replay, mock.url)
+        else:
+            reqs = synthetic_mix(args.requests, parse_weights(args.mix),
+                                 args.dblp_batch, args.ss_ids)
+        report.update(run_load(server_url, reqs, args.concurrency, mock.url))
+        if server is not None:
+            report["peak_rss"] = server.peak_rss
+        report["upstream_counts"] = mock.counts
+    finally:
+        if server is not None:
+            server.stop()
+        mock.stop()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
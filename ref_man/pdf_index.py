@@ -0,0 +1,380 @@
+"""Index of the pdfs in `local_pdfs_dir` by title, arXiv id, DOI and `paperId`.
+
+Usage:
+    python -m ref_man.pdf_index -d <data_dir> [-j processes] <pdfs_dir>
+
+Metadata is extracted with `pdfinfo` and `pdftotext` from poppler if they're
+available and otherwise from the raw pdf with a crude parser of the document
+info and the text operators of the first content streams.
+
+"""
+from typing import Dict, List, Optional, Tuple, Any
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import fcntl
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+
+from .semantic_scholar import SSCache, normalize_id, load_ss_cache
+
+
+_arxiv_regexp = re.compile(r"arxiv[:\s]*(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?",
+                           re.IGNORECASE)
+_arxiv_fname_regexp = re.compile(r"^(\d{4}\.\d{4,5})(?:v\d+)?$")
+_arxiv_url_regexp = re.compile(r"arxiv\.org/(?:abs|pdf)/" +
+                               r"(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[A-Z]{2})?/\d{7})" +
+                               r"(?:v\d+)?(?:\.pdf)?$", re.IGNORECASE)
+_doi_regexp = re.compile(r"\b(10\.\d{4,9}/[^\s\"<>()\[\]]+)")
+_doi_url_regexp = re.compile(r"doi\.org/(10\.\d{4,9}/\S+)$", re.IGNORECASE)
+_info_title_regexp = re.compile(rb"/Title\s*(\((?:\\.|[^\\)])*\)|<[0-9a-fA-F\s]*>)")
+_stream_regexp = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.DOTALL)
+# Text showing operators and the positioning operators which start a new line
+_text_regexp = re.compile(rb"(\((?:\\.|[^\\)])*\))\s*(?:Tj|'|\")|(\[(?:[^\]\\]|\\.)*\])\s*TJ|" +
+                          rb"-?[\d.]+\s+(-?[\d.]+)\s+T[dD]\b|" +
+                          rb"(?:-?[\d.]+\s+){5}(-?[\d.]+)\s+Tm\b|(T\*|ET)\b")
+_tj_regexp = re.compile(rb"\(((?:\\.|[^\\)])*)\)|(-?[\d.]+)")
+_escape_regexp = re.compile(rb"\\([0-7]{1,3}|.)", re.DOTALL)
+_escapes = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
+_word_regexp = re.compile(r"[a-z0-9]+")
+
+
+def _normalize_title(title: str) -> str:
+    return " ".join(_word_regexp.findall(title.lower()))
+
+
+def _pdf_string(s: bytes) -> str:
+    if s.startswith(b"<"):
+        s = bytes.fromhex(re.sub(rb"\s", b"", s[1:-1]).decode())
+    elif s.startswith(b"("):
+        s = _escape_regexp.sub(lambda m: bytes([int(m.group(1), 8) & 0xff])
+                               if m.group(1)[:1].isdigit()
+                               else _escapes.get(m.group(1), m.group(1)), s[1:-1])
+    if s.startswith(b"\xfe\xff"):
+        return s[2:].decode("utf-16-be", errors="ignore")
+    return s.decode("latin-1")
+
+
+def _raw_extract(path: str, max_bytes: int = 4 * 2**20,
+                 max_streams: int = 8) -> Tuple[str, str]:
+    """Title from the document info and text of the first content streams of
+    the pdf at `path` without any external tools.
+
+    Only plain and `FlateDecode` streams are read and text is joined as it
+    appears, so the result is rough but enough to find ids and the title.
+
+    """
+    with open(path, "rb") as f:
+        data = f.read(max_bytes)
+    match = _info_title_regexp.search(data)
+    title = _pdf_string(match.group(1)) if match else ""
+    lines: List[str] = []
+    streams = 0
+    for stream in _stream_regexp.finditer(data):
+        raw = stream.group(1)
+        try:
+            raw = zlib.decompress(raw)
+        except zlib.error:
+            pass
+        line: List[str] = []
+        found = False
+        for m in _text_regexp.finditer(raw):
+            string, array, td_y, tm_y, other = m.groups()
+            if string:
+                line.append(_pdf_string(string))
+            elif array:
+                # Large negative offsets in TJ arrays are spaces between words
+                line.append("".join(_pdf_string(b"(" + x + b")") if x or not n else
+                                    (" " if float(n) < -200 else "")
+                                    for x, n in _tj_regexp.findall(array)))
+            elif line and (other or float(td_y or 0) != 0 or tm_y):
+                lines.append(" ".join(line))
+                line = []
+            found = found or bool(string or array)
+        if line:
+            lines.append(" ".join(line))
+        streams += found
+        if streams >= max_streams:
+            break
+    return title, "\n".join(lines)
+
+
+def _poppler_extract(path: str, timeout: float = 30) -> Tuple[str, str, Optional[int]]:
+    info = subprocess.run(["pdfinfo", path], capture_output=True, timeout=timeout)
+    title, pages = "", None
+    for line in info.stdout.decode("utf-8", errors="ignore").split("\n"):
+        if line.startswith("Title:"):
+            title = line.split(":", 1)[1].strip()
+        elif line.startswith("Pages:"):
+            pages = int(line.split(":", 1)[1])
+    text = subprocess.run(["pdftotext", "-f", "1", "-l", "1", "-enc", "UTF-8", path, "-"],
+                          capture_output=True, timeout=timeout)
+    return title, text.stdout.decode("utf-8", errors="ignore"), pages
+
+
+def _guess_title(text: str) -> str:
+    "The first reasonably long line of the first page which isn't an id stamp."
+    for line in text.split("\n")[:20]:
+        line = " ".join(line.split())
+        if len(line.split()) >= 3 and not _arxiv_regexp.search(line) and\
+           not _doi_regexp.search(line) and not line[0].isdigit():
+            return line
+    return ""
+
+
+def extract_pdf(path: str, max_text: int = 2000) -> Dict[str, Any]:
+    """Extract title, arXiv id, DOI and first page text from the pdf at `path`.
+
+    The title from the document info is used only if it looks like one, as
+    it's often the file name or the name of the TeX file. The arXiv id is
+    also looked for in the file name.
+
+    Returns:
+        A dictionary of `title`, `arxiv`, `doi`, `text`, `pages` and `error`
+        if the file couldn't be read.
+
+    """
+    result: Dict[str, Any] = {"title": "", "arxiv": "", "doi": "", "text": "", "pages": None}
+    try:
+        if shutil.which("pdftotext") and shutil.which("pdfinfo"):
+            title, text, result["pages"] = _poppler_extract(path)
+        else:
+            title, text = _raw_extract(path)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    text = text.strip()
+    if len(title.split()) < 3 or title.lower().endswith((".pdf", ".tex", ".dvi")):
+        title = _guess_title(text)
+    arxiv = _arxiv_regexp.search(text) or\
+        _arxiv_fname_regexp.match(os.path.splitext(os.path.basename(path))[0])
+    doi = _doi_regexp.search(text)
+    result.update({"title": title.strip(), "arxiv": arxiv.group(1) if arxiv else "",
+                   "doi": doi.group(1).rstrip(".,;") if doi else "",
+                   "text": text[:max_text]})
+    return result
+
+
+class PdfIndex:
+    """Index of the pdfs in `pdfs_dir` linked to the Semantic Scholar cache.
+
+    Metadata is extracted with :func:`extract_pdf` in a pool of processes.
+    Updates are incremental, only files whose modification time or size
+    changed are extracted again. The index is kept as JSON in `data_dir` so
+    that it persists across restarts and is shared by all the workers. Only
+    one process updates it at a time and the others reload it when it
+    changes.
+
+    Each entry is linked to a `paperId` through the arXiv id or DOI if it's
+    in `ss_cache`. Entries which aren't linked yet are linked again on each
+    update, as papers are added to the cache.
+
+    Args:
+        pdfs_dir: Directory with the pdfs
+        data_dir: Directory where the index is stored
+        ss_cache: The Semantic Scholar cache
+        logger: Logger instance
+        processes: Number of processes for extraction. Defaults to the number
+                   of CPUs
+
+    """
+    def __init__(self, pdfs_dir: str, data_dir: str, ss_cache: Optional[SSCache],
+                 logger: logging.Logger, processes: Optional[int] = None):
+        self.pdfs_dir = pdfs_dir
+        self.index_file = os.path.join(data_dir, "pdf_index.json")
+        self.ss_cache = ss_cache
+        self.logger = logger
+        self.processes = processes or os.cpu_count() or 1
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.last_update: Dict[str, Any] = {}
+        self._by_id: Dict[Tuple[str, str], str] = {}
+        self._mtime = 0.0
+        self._lock = Lock()
+
+    def _link(self, entry: Dict[str, Any]):
+        if entry.get("paper_id") or self.ss_cache is None:
+            return
+        for id_type in ["arxiv", "doi"]:
+            ID = entry.get(id_type)
+            if ID:
+                paper_id = self.ss_cache[id_type].get(ID) or\
+                    self.ss_cache[id_type].get(normalize_id(id_type, ID))
+                if paper_id:
+                    entry["paper_id"] = paper_id
+                    return
+
+    def _build_lookup(self):
+        by_id = {}
+        for fname, entry in self.entries.items():
+            for id_type, key in [("arxiv", "arxiv"), ("doi", "doi"), ("ss", "paper_id")]:
+                if entry.get(key):
+                    by_id[(id_type, normalize_id(id_type, entry[key]))] = fname
+            if entry.get("title"):
+                by_id[("title", _normalize_title(entry["title"]))] = fname
+        self._by_id = by_id
+
+    def load(self):
+        "Load the index from disk if it changed since it was last loaded."
+        try:
+            mtime = os.stat(self.index_file).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.index_file) as f:
+            entries = json.load(f)
+        with self._lock:
+            self.entries = entries
+            self._mtime = mtime
+            self._build_lookup()
+
+    def _save(self):
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.index_file),
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(self.entries, f)
+        os.replace(f.name, self.index_file)
+        self._mtime = os.stat(self.index_file).st_mtime
+
+    def _scan(self) -> Dict[str, Tuple[float, int]]:
+        files = {}
+        for root, _, fnames in os.walk(self.pdfs_dir):
+            for fname in fnames:
+                if fname.lower().endswith(".pdf"):
+                    path = os.path.join(root, fname)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files[os.path.relpath(path, self.pdfs_dir)] = (st.st_mtime, st.st_size)
+        return files
+
+    def update(self) -> Dict[str, Any]:
+        """Extract metadata of new and changed pdfs and remove deleted ones.
+
+        Returns:
+            A summary of the update.
+
+        """
+        start = time.time()
+        if not os.path.isdir(self.pdfs_dir):
+            return {"error": f"{self.pdfs_dir} doesn't exist"}
+        with open(self.index_file + ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return {"error": "Update running in another worker"}
+            self.load()
+            files = self._scan()
+            entries = {k: v for k, v in self.entries.items() if k in files}
+            removed = len(self.entries) - len(entries)
+            changed = [fname for fname, (mtime, size) in files.items()
+                       if fname not in entries or entries[fname]["mtime"] != mtime or
+                       entries[fname]["size"] != size]
+            if changed:
+                self.logger.info(f"Extracting metadata from {len(changed)} pdfs " +
+                                 f"with {self.processes} processes")
+                paths = [os.path.join(self.pdfs_dir, x) for x in changed]
+                # spawn, as forking a threaded server isn't safe
+                with ProcessPoolExecutor(self.processes,
+                                         multiprocessing.get_context("spawn")) as pool:
+                    chunksize = max(1, len(paths) // (self.processes * 4))
+                    for fname, result in zip(changed, pool.map(extract_pdf, paths,
+                                                               chunksize=chunksize)):
+                        mtime, size = files[fname]
+                        entries[fname] = {**result, "mtime": mtime, "size": size}
+            for entry in entries.values():
+                self._link(entry)
+            with self._lock:
+                self.entries = entries
+                self._build_lookup()
+            self._save()
+        duration = time.time() - start
+        self.last_update = {"time": start, "files": len(files), "extracted": len(changed),
+                            "removed": removed,
+                            "errors": sum("error" in entries[x] for x in changed),
+                            "linked": sum(bool(x.get("paper_id")) for x in entries.values()),
+                            "seconds": round(duration, 2),
+                            "pdfs_per_sec": round(len(changed) / duration, 1) if changed else 0}
+        self.logger.info(f"Updated pdf index {self.last_update}")
+        return self.last_update
+
+    def lookup(self, id_type: str, ID: str) -> Optional[Dict[str, Any]]:
+        """Look up a local pdf by `ID` of `id_type`.
+
+        `id_type` can be `arxiv`, `doi`, `ss` for a `paperId`, `title`, or any
+        other type in the Semantic Scholar cache, e.g., `corpus` or `acl`.
+
+        Returns:
+            The entry with its absolute `path`, or `None` if there's no such pdf.
+
+        """
+        self.load()
+        if id_type == "title":
+            key = ("title", _normalize_title(ID))
+        elif id_type in {"arxiv", "doi", "ss"}:
+            key = (id_type, normalize_id(id_type, ID))
+        elif self.ss_cache is not None and id_type in self.ss_cache:
+            key = ("ss", self.ss_cache[id_type].get(ID) or "")
+        else:
+            return None
+        with self._lock:
+            fname = self._by_id.get(key)
+            if fname is None and id_type == "ss" and self.ss_cache is not None:
+                # Papers cached after the last update aren't linked yet
+                for entry_type in ["arxiv", "doi"]:
+                    for k, v in self._by_id.items():
+                        if k[0] == entry_type and self.ss_cache[entry_type].get(k[1]) == ID:
+                            fname = v
+                            break
+                    if fname:
+                        break
+            if fname is None:
+                return None
+            entry = {k: v for k, v in self.entries[fname].items() if k != "text"}
+        path = os.path.join(self.pdfs_dir, fname)
+        if not os.path.exists(path):
+            return None
+        return {**entry, "path": path}
+
+    def lookup_url(self, url: str) -> Optional[Dict[str, Any]]:
+        "Look up a local pdf for an arXiv or doi.org `url`."
+        match = _arxiv_url_regexp.search(url)
+        if match:
+            return self.lookup("arxiv", match.group(1))
+        match = _doi_url_regexp.search(url)
+        if match:
+            return self.lookup("doi", match.group(1))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser("ref-man-pdf-index")
+    parser.add_argument("pdfs_dir", help="Directory with the pdfs")
+    parser.add_argument("--data-dir", "-d", dest="data_dir", type=str,
+                        default=os.path.expanduser("~"),
+                        help="Directory where the index is stored")
+    parser.add_argument("--processes", "-j", type=int, default=0,
+                        help="Number of processes for extraction. Defaults to number of CPUs")
+    args = parser.parse_args()
+    if not os.path.exists(args.data_dir):
+        print(f"Data dir {args.data_dir} doesn't exist")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    ss_cache = load_ss_cache(args.data_dir) if\
+        os.path.exists(os.path.join(args.data_dir, "metadata")) else None
+    index = PdfIndex(args.pdfs_dir, args.data_dir, ss_cache, logging.getLogger("pdf_index"),
+                     args.processes or None)
+    print(json.dumps(index.update()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from typing import Dict, Callable, List, Optional
+import os
+import signal
+import socket
+import logging
+import selectors
+
+from werkzeug import serving
+
+
+class KeepAliveRequestHandler(serving.WSGIRequestHandler):
+    """Request handler which keeps connections open between requests.
+
+    Responses are sent as HTTP/1.1 so that clients can reuse the connection
+    for the next request. Responses without a `Content-Length`, e.g.,
+    streamed ones, still close the connection. Connections idle for
+    `timeout` seconds are closed so that they don't hold a thread.
+
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+
+    def setup(self):
+        super().setup()
+        # The headers and the body are separate writes, which Nagle's
+        # algorithm delays until the previous one is acknowledged, and the
+        # client delays the acknowledgement on a kept alive connection
+        if self.connection.family in {socket.AF_INET, socket.AF_INET6}:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def remove_stale_socket(path: str):
+    """Remove the Unix socket at `path` if no server is listening on it.
+
+    Raises:
+        OSError if a server is listening on it.
+
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+            return
+    raise OSError(f"A server is already listening on {path}")
+
+
+def make_servers(host: str, port: int, app: Callable, threaded: bool,
+                 unix_socket: str = "", tcp: bool = True) -> List[serving.BaseWSGIServer]:
+    """Make WSGI servers for `app` on TCP `host` and `port` and/or on the Unix
+    domain socket at path `unix_socket`.
+
+    Connections are kept alive between requests if `threaded`, as otherwise
+    an idle connection would block other clients. The Unix socket can only
+    be used by the user running the server.
+
+    """
+    handler = KeepAliveRequestHandler if threaded else None
+    servers = []
+    if tcp:
+        servers.append(serving.make_server(host, port, app, threaded=threaded,
+                                           request_handler=handler))
+    if unix_socket:
+        remove_stale_socket(unix_socket)
+        servers.append(serving.make_server("unix://" + unix_socket, 0, app,
+                                           threaded=threaded, request_handler=handler))
+        os.chmod(unix_socket, 0o600)
+    if not servers:
+        raise ValueError("No TCP port or Unix socket to listen on")
+    return servers
+
+
+def serve(servers: List[serving.BaseWSGIServer], stop: Callable[[], bool],
+          poll_interval: float = 0.5):
+    """Handle requests on all of `servers` until `stop` returns True or one of
+    them is shut down with `werkzeug.server.shutdown`."""
+    # NOTE: We don't use serve_forever as it serves only one server and
+    #       shutdown() from a signal handler can block forever.
+    for server in servers:
+        server.timeout = 0
+    with selectors.DefaultSelector() as selector:
+        for server in servers:
+            selector.register(server, selectors.EVENT_READ)
+        while not stop() and not any(s.shutdown_signal for s in servers):
+            for key, _ in selector.select(poll_interval):
+                key.fileobj.handle_request()  # type: ignore
+
+
+def server_urls(servers: List[serving.BaseWSGIServer]) -> str:
+    return ", ".join(s.host if s.host.startswith("unix://") else f"http://{s.host}:{s.port}"
+                     for s in servers)
+
+
+class PreforkServer:
+    """Serve a WSGI `app` from `workers` pre-forked processes.
+
+    The listening sockets, TCP and/or Unix, are bound once in the parent and
+    inherited by all the workers, which accept connections from it independently, so that CPU
+    bound work (parsing, JSON) in one worker doesn't hold up the others. The
+    parent only supervises; it restarts workers which die and on `SIGTERM` or
+    `SIGINT` shuts all of them down.
+
+    Args:
+        host: host on which to bind
+        port: port on which to bind
+        app: The WSGI application
+        workers: Number of worker processes
+        threaded: Whether each worker should handle requests in threads
+        logger: Logger instance
+        on_worker_start: Called in each worker with the worker index after the fork
+        on_worker_exit: Called in each worker before it exits
+        unix_socket: Path of a Unix domain socket on which to listen
+        tcp: Whether to listen on `host` and `port`
+
+    """
+    def __init__(self, host: str, port: int, app: Callable, workers: int,
+                 threaded: bool, logger: logging.Logger,
+                 on_worker_start: Optional[Callable[[int], None]] = None,
+                 on_worker_exit: Optional[Callable[[], None]] = None,
+                 unix_socket: str = "", tcp: bool = True):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.tcp = tcp
+        self.app = app
+        self.workers = workers
+        self.threaded = threaded
+        self.logger = logger
+        self.on_worker_start = on_worker_start
+        self.on_worker_exit = on_worker_exit
+        self.children: Dict[int, int] = {}
+        self.stopping = False
+        self.servers: List[serving.BaseWSGIServer] = []
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+        # child
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._stop_worker)
+        status = 0
+        try:
+            if self.on_worker_start is not None:
+                self.on_worker_start(index)
+            serve(self.servers, lambda: self.stopping)
+            for server in self.servers:
+                server.server_close()
+        except Exception as e:
+            self.logger.error(f"Worker {index} failed with error {e}")
+            status = 1
+        finally:
+            if self.on_worker_exit is not None:
+                self.on_worker_exit()
+            os._exit(status)
+
+    def _stop_worker(self, *_):
+        self.stopping = True
+
+    def _stop(self, *_):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def serve_forever(self):
+        self.servers = make_servers(self.host, self.port, self.app, self.threaded,
+                                    self.unix_socket, self.tcp)
+        self.logger.info(f"Serving on {server_urls(self.servers)} with {self.workers} workers")
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for i in range(self.workers):
+            self._spawn(i)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            index = self.children.pop(pid, None)
+            if index is not None and not self.stopping:
+                self.logger.error(f"Worker {index} exited with status {status}. Restarting")
+                self._spawn(index)
+        for server in self.servers:
+            server.server_close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        self.logger.info("All workers stopped")
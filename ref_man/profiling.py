@@ -0,0 +1,144 @@
+from typing import Dict, List, Optional, Tuple
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+
+# Functions in which threads wait for work, excluded by default
+_idle = {("wait", "threading.py"), ("select", "selectors.py"), ("poll", "selectors.py"),
+         ("accept", "socket.py")}
+
+
+def _frame_label(code) -> str:
+    fname = "/".join(code.co_filename.rsplit(os.sep, 2)[-2:])
+    return f"{code.co_name} ({fname}:{code.co_firstlineno})"
+
+
+def _is_idle(code) -> bool:
+    return (code.co_name, os.path.basename(code.co_filename)) in _idle
+
+
+def sample_stacks(seconds: float, interval: float = 0.005,
+                  idle: bool = False) -> Tuple[Counter, int]:
+    """Sample the stacks of all the threads of the process every `interval`
+    seconds for `seconds`.
+
+    Sampling :func:`sys._current_frames` from a separate thread sees every
+    thread, including the ones started before the profile, and costs nothing
+    for the threads being profiled apart from holding the GIL while a sample
+    is taken. The sampling thread itself is excluded, and so are threads
+    waiting for work, e.g., idle threads of the pool, unless `idle` is given.
+    Threads waiting on the network are always included.
+
+    Returns:
+        Counts of the stacks as tuples of thread name and frame labels from
+        the outermost frame, and the number of samples taken.
+
+    """
+    counts: Counter = Counter()
+    me = threading.get_ident()
+    labels: Dict[object, str] = {}
+    samples = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (not idle and _is_idle(frame.f_code)):
+                continue
+            stack: List[str] = []
+            while frame is not None:
+                code = frame.f_code
+                if code not in labels:
+                    labels[code] = _frame_label(code)
+                stack.append(labels[code])
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[tuple(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+def collapsed(counts: Counter) -> str:
+    """Stacks in the collapsed format of `flamegraph.pl`, which is also read
+    by speedscope and inferno."""
+    return "".join(";".join(stack) + f" {n}\n" for stack, n in counts.most_common())
+
+
+def top_functions(counts: Counter, samples: int, interval: float, n: int = 40) -> str:
+    """Table of the functions with most samples, like :mod:`pstats`.
+
+    `self` counts samples where the function was running and `total`
+    samples where it was anywhere on the stack. Times are estimated from the
+    sampling interval, per thread.
+
+    """
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, c in counts.items():
+        frames = stack[1:]
+        if frames:
+            own[frames[-1]] += c
+        for label in set(frames):
+            total[label] += c
+    all_samples = sum(counts.values()) or 1
+    lines = [f"{samples} samples of {len(set(s[0] for s in counts))} threads " +
+             f"every {interval * 1000:.1f}ms\n",
+             f"{'self':>8} {'self%':>6} {'total':>8} {'total%':>6} {'self_s':>8}  function"]
+    for label, c in own.most_common(n):
+        lines.append(f"{c:>8} {100 * c / all_samples:>6.1f} {total[label]:>8} " +
+                     f"{100 * total[label] / all_samples:>6.1f} {c * interval:>8.2f}  {label}")
+    return "\n".join(lines) + "\n"
+
+
+def tracemalloc_top(seconds: float = 0, n: int = 25, group: str = "lineno",
+                    frames: int = 1) -> str:
+    """Top `n` allocations as reported by :mod:`tracemalloc`.
+
+    If tracemalloc isn't already tracing, it's started for `seconds` and the
+    allocations made in that window which are still alive are reported, and
+    then it's stopped again as it slows down allocations considerably. If it
+    was already tracing, e.g., with :envvar:`PYTHONTRACEMALLOC`, the top
+    allocations are reported, or with `seconds` the growth in that window.
+
+    Args:
+        seconds: Seconds to trace for
+        n: Number of entries
+        group: Group by `lineno`, `filename` or `traceback`
+        frames: Number of frames stored for each allocation
+
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(max(frames, 1))
+        seconds = seconds or 10
+    try:
+        before: Optional[tracemalloc.Snapshot] = None
+        if seconds and not started:
+            before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    snapshot = snapshot.filter_traces(filters)
+    lines = [f"pid {os.getpid()}, traced {current / 2**20:.1f} MiB, " +
+             f"peak {peak / 2**20:.1f} MiB" +
+             (f", allocations in the last {seconds}s" if seconds else "") + "\n"]
+    if before is not None:
+        stats = snapshot.compare_to(before.filter_traces(filters), group)
+        for i, stat in enumerate(stats[:n], 1):
+            lines.append(f"#{i}: {stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks " +
+                         f"(total {stat.size / 1024:.1f} KiB)")
+            lines.extend("    " + line for line in stat.traceback.format())
+    else:
+        for i, stat in enumerate(snapshot.statistics(group)[:n], 1):
+            lines.append(f"#{i}: {stat.size / 1024:.1f} KiB, {stat.count} blocks")
+            lines.extend("    " + line for line in stat.traceback.format())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,173 @@
+from typing import Dict, Optional, List
+import time
+import logging
+from threading import Thread, Event, Lock
+
+import requests
+
+from .const import proxy_check_url
+
+
+class CircuitBreaker:
+    """Circuit breaker for a proxy.
+
+    The breaker is `closed` while the proxy is healthy and requests go through
+    it. After `failure_threshold` consecutive failures it `open`s and requests
+    go direct. Once `reset_timeout` seconds have passed it is `half_open` and
+    the next probe decides whether it closes again or stays open.
+
+    Args:
+        failure_threshold: Consecutive failures after which the breaker opens
+        reset_timeout: Seconds after which an open breaker can be probed again
+
+    """
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, failure_threshold: int = 2, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.open     # Not known to be healthy till the first probe
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.open and\
+               time.time() - self.opened_at >= self.reset_timeout:
+                self._state = self.half_open
+            return self._state
+
+    @property
+    def allow(self) -> bool:
+        "Whether user requests should go through the proxy"
+        return self.state == self.closed
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._state = self.closed
+
+    def record_failure(self, trip: bool = False):
+        """Record a failure of the proxy.
+
+        Args:
+            trip: Open the breaker irrespective of the failures so far, e.g.,
+                  for a wrong response, which is unlikely to be transient
+
+        """
+        with self._lock:
+            self.failures += 1
+            if trip or self._state == self.half_open or\
+               self.failures >= self.failure_threshold:
+                self._state = self.open
+                self.opened_at = time.time()
+
+
+class ProxyMonitor:
+    """Probe proxies in the background and route requests according to their health.
+
+    Each proxy has a :class:`CircuitBreaker`. A background thread probes all
+    the proxies every `interval` seconds so that no user request has to find
+    out about a dead proxy by timing out on it. :meth:`proxies` returns the
+    `proxies` argument for :mod:`requests` immediately, which is `None` if the
+    proxy is not healthy.
+
+    Args:
+        logger: Logger instance
+        interval: Seconds between probes
+        timeout: Timeout for each probe
+
+    """
+    def __init__(self, logger: logging.Logger, interval: float = 10, timeout: float = 1):
+        self.logger = logger
+        self.interval = interval
+        self.timeout = timeout
+        self.ports: Dict[str, int] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._stop_ev = Event()
+        self._thread: Optional[Thread] = None
+
+    def add(self, name: str, port: int):
+        self.ports[name] = port
+        self.breakers[name] = CircuitBreaker(reset_timeout=self.interval * 3)
+
+    def _proxies(self, name: str) -> Dict[str, str]:
+        return {"http": f"http://127.0.0.1:{self.ports[name]}",
+                "https": f"http://127.0.0.1:{self.ports[name]}"}
+
+    def proxies(self, name: str) -> Optional[Dict[str, str]]:
+        """Return proxies for `name` if it's healthy else `None`."""
+        if name in self.breakers and self.breakers[name].allow:
+            return self._proxies(name)
+        else:
+            return None
+
+    def report_failure(self, name: str):
+        "Report a failure of proxy `name` seen by a user request."
+        if name in self.breakers:
+            self.breakers[name].record_failure()
+
+    def probe(self, name: str) -> str:
+        """Probe proxy `name` and update its breaker.
+
+        Returns:
+            A status message.
+
+        """
+        breaker = self.breakers[name]
+        try:
+            response = requests.get(proxy_check_url, proxies=self._proxies(name),
+                                    timeout=self.timeout)
+            if response.status_code == 200:
+                breaker.record_success()
+                msg = f"Proxy {name} on {self.ports[name]} seems to work"
+            else:
+                breaker.record_failure(trip=True)
+                msg = f"Proxy {name} on {self.ports[name]} seems reachable but " +\
+                    f"wrong status_code {response.status_code}. Breaker is {breaker.state}"
+        except requests.exceptions.Timeout:
+            breaker.record_failure()
+            msg = f"Timeout: Proxy {name} on {self.ports[name]} not reachable"
+        except requests.exceptions.ConnectionError:
+            breaker.record_failure()
+            msg = f"ProxyError: Proxy {name} on {self.ports[name]} not reachable"
+        return msg
+
+    def probe_all(self, force: bool = False) -> List[str]:
+        """Probe the proxies which are due.
+
+        Proxies with a `closed` or `half_open` breaker are probed. Proxies with
+        an `open` breaker are probed only if `force` is given.
+
+        """
+        msgs = []
+        for name, breaker in self.breakers.items():
+            prev = breaker.state
+            if force or prev != CircuitBreaker.open:
+                msgs.append(self.probe(name))
+                if breaker.state != prev:
+                    self.logger.info(f"Proxy {name} is now {breaker.state}, was {prev}")
+        return msgs
+
+    def status(self) -> Dict[str, Dict]:
+        return {name: {"port": self.ports[name], "state": b.state, "failures": b.failures}
+                for name, b in self.breakers.items()}
+
+    def _run(self):
+        while not self._stop_ev.wait(self.interval):
+            self.probe_all()
+
+    def start(self):
+        "Probe all proxies once and then keep probing in a background thread."
+        for msg in self.probe_all(force=True):
+            self.logger.info(msg)
+        if self.breakers:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_ev.set()
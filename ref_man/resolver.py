@@ -0,0 +1,350 @@
+from typing import Callable, Dict, List, Iterator, Tuple, Optional, Any
+import re
+import json
+import time
+import logging
+from queue import Queue, Empty
+from threading import Thread, Lock
+from difflib import SequenceMatcher
+
+from .arxiv import arxiv_lookup
+from .bibtex import renderer
+from .semantic_scholar import SSCache, read_data, semantic_scholar_paper_details
+from .scheduler import scheduler, bulk
+
+
+_arxiv_regexp = re.compile(r"(?:arxiv[:\s]*|arxiv\.org/(?:abs|pdf)/)" +
+                           r"(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[A-Z]{2})?/\d{7})(v\d+)?",
+                           re.IGNORECASE)
+_doi_regexp = re.compile(r"\b(10\.\d{4,9}/[^\s\"<>]+)")
+_url_regexp = re.compile(r"(?:https?://|doi:|arxiv:)\S+", re.IGNORECASE)
+_year_regexp = re.compile(r"\b(19[5-9]\d|20[0-4]\d)[a-z]?\b")
+_quoted_regexp = re.compile(r"[\"“”]([^\"“”]{10,})[\"“”]")
+_paren_year_regexp = re.compile(r"\((?:19|20)\d{2}[a-z]?\)\.?\s*([A-Za-z][^.?!]{9,}[.?!]?)")
+_year_dot_regexp = re.compile(r"(?:19|20)\d{2}[a-z]?\.\s+([A-Za-z][^.?!]{9,}[.?!]?)")
+_sentence_regexp = re.compile(r"(?<=[a-zA-Z0-9)\]])[.?!]\s+(?=[A-Z0-9\"“(])")
+_word_regexp = re.compile(r"[a-z0-9]+")
+_venue_regexp = re.compile(r"^In\b|\b(?:Proceedings|Conference|Journal|Transactions|" +
+                           r"Workshop|Symposium)\b")
+
+
+def parse_reference(ref: str) -> Dict[str, Any]:
+    """Parse arXiv id, DOI, title and year out of a free text reference.
+
+    The title is taken from, in order, a quoted string (IEEE style), the
+    sentence after a parenthesized year (APA) or after a year followed by a
+    period (ACM), and otherwise the sentence which looks least like a list of
+    authors or a venue.
+
+    """
+    arxiv = _arxiv_regexp.search(ref)
+    doi = _doi_regexp.search(ref)
+    text = _url_regexp.sub("", ref)
+    year = _year_regexp.search(text)
+    title = ""
+    for regexp in [_quoted_regexp, _paren_year_regexp, _year_dot_regexp]:
+        match = regexp.search(text)
+        if match:
+            title = match.group(1)
+            break
+    if not title:
+        best = -100.0
+        for sentence in _sentence_regexp.split(text):
+            words = sentence.split()
+            # Author lists have commas and "and", venues have digits and
+            # abbreviations like "Proc" or "Syst"
+            score = len(words) - 2 * sentence.count(",") - 3 * sentence.count(" and ") -\
+                3 * any(c.isdigit() for c in sentence) -\
+                5 * bool(_venue_regexp.search(sentence)) -\
+                sum(len(w) <= 4 and w.istitle() for w in words)
+            if len(words) >= 3 and score > best:
+                best, title = score, sentence
+    return {"arxiv": arxiv.group(1) if arxiv else "",
+            "doi": doi.group(1).rstrip(".,;") if doi else "",
+            "title": title.strip(" .,;\"“”"),
+            "year": year.group(1) if year else ""}
+
+
+def _normalize(title: str) -> str:
+    return " ".join(_word_regexp.findall(title.lower()))
+
+
+def title_confidence(parsed: Dict[str, Any], title: str, year: Any) -> float:
+    """Confidence that a record with `title` and `year` matches the `parsed`
+    reference, from the similarity of the titles. A mismatch of years costs
+    10%."""
+    score = SequenceMatcher(None, _normalize(parsed["title"]), _normalize(title)).ratio()
+    if parsed["year"] and year and str(year) != parsed["year"]:
+        score *= 0.9
+    return round(score, 3)
+
+
+def ss_search_record(result: Dict[str, Any]) -> Dict[str, Any]:
+    "Convert a Semantic Scholar search result to the format of the API."
+    def text(x):
+        return x.get("text") if isinstance(x, dict) else x
+    return {"paperId": result.get("id"), "title": text(result.get("title")) or "",
+            "year": text(result.get("year")), "venue": text(result.get("venue")) or "",
+            "doi": (result.get("doiInfo") or {}).get("doi"),
+            "authors": [{"name": a[0]["name"] if isinstance(a, list) else a.get("name")}
+                        for a in result.get("authors") or []]}
+
+
+class Stage:
+    """A stage of :class:`Resolver` run by `workers` threads.
+
+    Each thread takes up to `batch_size` items from the queue, waiting up to
+    `wait` seconds to fill a batch, and calls `func` on them. `func` returns
+    the next stage of each item, `None` to emit it.
+
+    """
+    def __init__(self, name: str, func: Callable[[List[Dict]], List[Tuple[Optional[str], Dict]]],
+                 workers: int = 1, batch_size: int = 1, wait: float = 0.05):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.wait = wait
+        self.queue: Queue = Queue()
+        self.items = 0
+        self.calls = 0
+        self.busy = 0.0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self._lock = Lock()
+
+    def next_batch(self) -> Optional[List[Dict]]:
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.time() + self.wait
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def record(self, start: float, end: float, n: int):
+        with self._lock:
+            self.items += n
+            self.calls += 1
+            self.busy += end - start
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = end if self.last is None else max(self.last, end)
+
+    def stats(self) -> Dict[str, Any]:
+        wall = (self.last - self.first) if self.first is not None else 0  # type: ignore
+        return {"items": self.items, "calls": self.calls, "busy_seconds": round(self.busy, 3),
+                "wall_seconds": round(wall, 3),
+                "items_per_sec": round(self.items / wall, 1) if wall else None}
+
+
+class Resolver:
+    """Resolve free text references to records in a pipeline of concurrent stages.
+
+    1. `parse` extracts arXiv id, DOI, title and year with :func:`parse_reference`.
+    2. `cache` looks up the arXiv id and DOI in the Semantic Scholar cache.
+    3. `doi` fetches the misses with a DOI from Semantic Scholar.
+    4. `arxiv` fetches the misses with an arXiv id from arXiv, in batches of
+       up to 50 ids per request.
+    5. `title` searches DBLP for the rest, and for anything not found by id,
+       falling back to Semantic Scholar search when DBLP has no good match.
+
+    Upstream requests are run as bulk work on the shared
+    :class:`~ref_man.scheduler.Scheduler`. Each result has the `source` it
+    was resolved from, the `record`, its `bibtex` and a `confidence` which is
+    1.0 for matches by id and the title similarity for matches by title.
+
+    Args:
+        data_dir: Directory of the Semantic Scholar cache
+        ss_cache: The Semantic Scholar cache
+        dblp_fetch: DBLP fetch function. See :func:`~ref_man.dblp.dblp_helper`
+        dblp_helper: DBLP helper
+        semantic_search: Optional :class:`~ref_man.semantic_scholar.SemanticSearch`
+        logger: Logger instance
+        concurrency: Number of threads for each of the upstream stages
+        min_confidence: Title matches below this go to the next source
+
+    """
+    def __init__(self, data_dir: str, ss_cache: SSCache, dblp_fetch: Callable,
+                 dblp_helper: Callable, semantic_search: Any, logger: logging.Logger,
+                 concurrency: int = 16, min_confidence: float = 0.8):
+        self.data_dir = data_dir
+        self.ss_cache = ss_cache
+        self.dblp_fetch = dblp_fetch
+        self.dblp_helper = dblp_helper
+        self.semantic_search = semantic_search
+        self.logger = logger
+        self.concurrency = concurrency
+        self.min_confidence = min_confidence
+
+    def _result(self, item: Dict, source: str, record: Dict[str, Any],
+                confidence: float, kind: str) -> Tuple[None, Dict]:
+        item.update({"source": source, "record": record, "confidence": confidence,
+                     "bibtex": renderer.render(kind, record)})
+        return None, item
+
+    def _parse(self, items: List[Dict]) -> List[Tuple[Optional[str], Dict]]:
+        for item in items:
+            item["parsed"] = parse_reference(item["query"])
+        return [("cache", item) for item in items]
+
+    def _cache(self, items: List[Dict]) -> List[Tuple[Optional[str], Dict]]:
+        routes: List[Tuple[Optional[str], Dict]] = []
+        for item in items:
+            parsed = item["parsed"]
+            data = None
+            for id_type in ["arxiv", "doi"]:
+                paper_id = parsed[id_type] and self.ss_cache[id_type].get(parsed[id_type])
+                data = read_data(self.data_dir, paper_id) if paper_id else None
+                if data is not None:
+                    break
+            if data is not None:
+                routes.append(self._result(item, "ss_cache", data, 1.0, "ss"))
+            elif parsed["doi"]:
+                routes.append(("doi", item))
+            elif parsed["arxiv"]:
+                routes.append(("arxiv", item))
+            else:
+                routes.append(("title", item))
+        return routes
+
+    def _not_found(self, item: Dict) -> Tuple[Optional[str], Dict]:
+        if item["parsed"]["title"] and not item.get("tried_title"):
+            return "title", item
+        item.update({"source": None, "record": None, "confidence": 0.0, "bibtex": None})
+        return None, item
+
+    def _doi(self, items: List[Dict]) -> List[Tuple[Optional[str], Dict]]:
+        item = items[0]
+        data = semantic_scholar_paper_details("doi", item["parsed"]["doi"], self.data_dir,
+                                              self.ss_cache, False, priority=bulk)
+        if isinstance(data, (str, bytes)):
+            data = json.loads(data)
+        if isinstance(data, dict) and data.get("paperId"):
+            return [self._result(item, "ss", data, 1.0, "ss")]
+        elif item["parsed"]["arxiv"]:
+            return [("arxiv", item)]
+        return [self._not_found(item)]
+
+    def _arxiv(self, items: List[Dict]) -> List[Tuple[Optional[str], Dict]]:
+        ids = sorted({item["parsed"]["arxiv"] for item in items})
+        try:
+            entries = scheduler.run(bulk, arxiv_lookup, ids)
+        except Exception as e:
+            self.logger.error(f"Error {e} fetching {len(ids)} ids from arXiv")
+            entries = {}
+        routes = []
+        for item in items:
+            entry = entries.get(item["parsed"]["arxiv"])
+            if entry:
+                routes.append(self._result(item, "arxiv", entry, 1.0, "arxiv"))
+            else:
+                routes.append(self._not_found(item))
+        return routes
+
+    def _title(self, items: List[Dict]) -> List[Tuple[Optional[str], Dict]]:
+        item = items[0]
+        item["tried_title"] = True
+        parsed = item["parsed"]
+        q: Queue = Queue()
+        best: Tuple[float, Optional[Dict], str] = (0.0, None, "")
+        # Punctuation like "&" and "?" in the title would break the query
+        query = _normalize(parsed["title"])
+        try:
+            scheduler.run(bulk, self.dblp_fetch, query, q)
+            hits = self.dblp_helper(q).get(query, [])
+        except Exception as e:
+            self.logger.error(f"Error {e} searching DBLP for {parsed['title']}")
+            hits = []
+        for hit in hits:
+            if isinstance(hit, dict):
+                score = title_confidence(parsed, hit.get("title", ""), hit.get("year"))
+                if score > best[0]:
+                    best = (score, hit, "dblp")
+        if best[0] < self.min_confidence and self.semantic_search is not None:
+            try:
+                response = json.loads(scheduler.run(
+                    bulk, self.semantic_search.semantic_scholar_search, parsed["title"]))
+            except Exception as e:
+                self.logger.error(f"Error {e} searching Semantic Scholar for {parsed['title']}")
+                response = {}
+            for result in response.get("results") or []:
+                record = ss_search_record(result)
+                score = title_confidence(parsed, record["title"], record["year"])
+                if score > best[0]:
+                    best = (score, record, "ss_search")
+        score, record, source = best
+        if record is None:
+            return [self._not_found(item)]
+        return [self._result(item, source, record, score,
+                             "dblp" if source == "dblp" else "ss")]
+
+    def resolve(self, refs: List[str]) -> Iterator[Dict[str, Any]]:
+        """Resolve `refs` and yield the results as they complete.
+
+        Each result has the `index` and `query` of the reference, its `parsed`
+        fields, `source`, `record`, `bibtex` and `confidence`. `source` and
+        `record` are `None` if the reference couldn't be resolved.
+
+        The last item yielded is :code:`{"done": True, "count": n, "stages": stats}`
+        with the throughput of each stage.
+
+        """
+        stages = {s.name: s for s in
+                  [Stage("parse", self._parse, 1, 100, 0),
+                   Stage("cache", self._cache, 1, 100, 0),
+                   Stage("doi", self._doi, self.concurrency),
+                   Stage("arxiv", self._arxiv, max(1, self.concurrency // 8), 50),
+                   Stage("title", self._title, self.concurrency)]}
+        out: Queue = Queue()
+
+        def run(stage: Stage):
+            while True:
+                batch = stage.next_batch()
+                if batch is None:
+                    return
+                start = time.time()
+                try:
+                    routes = stage.func(batch)
+                except Exception as e:
+                    self.logger.error(f"Error {e} in stage {stage.name}")
+                    routes = [(None, dict(item, source=None, record=None, confidence=0.0,
+                                          bibtex=None, error=str(e))) for item in batch]
+                stage.record(start, time.time(), len(batch))
+                for route, item in routes:
+                    if route is None:
+                        out.put(item)
+                    else:
+                        stages[route].queue.put(item)
+
+        threads = [Thread(target=run, args=[stage], daemon=True)
+                   for stage in stages.values() for _ in range(stage.workers)]
+        for t in threads:
+            t.start()
+        start = time.time()
+        for i, ref in enumerate(refs):
+            stages["parse"].queue.put({"index": i, "query": ref})
+        try:
+            for _ in refs:
+                item = out.get()
+                item.pop("tried_title", None)
+                yield item
+        finally:
+            for stage in stages.values():
+                for _ in range(stage.workers):
+                    stage.queue.put(None)
+        duration = time.time() - start
+        stats = {name: stage.stats() for name, stage in stages.items()}
+        self.logger.info(f"Resolved {len(refs)} references in {duration:.2f}s. " +
+                         ", ".join(f"{k}: {v['items_per_sec']}/s" for k, v in stats.items()
+                                   if v["items"]))
+        yield {"done": True, "count": len(refs), "seconds": round(duration, 3),
+               "refs_per_sec": round(len(refs) / duration, 1) if duration else None,
+               "stages": stats}
@@ -0,0 +1,128 @@
+from typing import Callable, Dict, Any, Optional
+import os
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future
+
+from .tracing import tracer
+
+
+interactive = "interactive"
+bulk = "bulk"
+background = "background"
+priorities = [interactive, bulk, background]
+
+
+class Scheduler:
+    """Run upstream work on a shared pool of threads with priority classes.
+
+    There are three classes, `interactive` for single lookups from Emacs,
+    `bulk` for batch fetches and `background` for maintenance like updating
+    the links cache. Idle threads always pick the highest priority queued
+    task, and each class can use at most its share of the threads, so bulk
+    and background work always leave some threads for interactive lookups.
+
+    The threads are started on first use, so that a scheduler created before
+    the workers are forked by :class:`~ref_man.prefork.PreforkServer` works
+    in each of them.
+
+    Args:
+        num_threads: Size of the thread pool
+        shares: Fraction of the threads each class can use at most
+
+    """
+    def __init__(self, num_threads: int = 32,
+                 shares: Dict[str, float] = {interactive: 1.0, bulk: 0.75, background: 0.25}):
+        self.shares = shares
+        self._reset()
+        self.configure(num_threads)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {p: deque() for p in priorities}
+        self._running = {p: 0 for p in priorities}
+        self._completed = {p: 0 for p in priorities}
+        self._local = threading.local()
+        self._threads: list = []
+
+    def configure(self, num_threads: int):
+        """Set the size of the pool to `num_threads`."""
+        with self._cond:
+            self.num_threads = max(1, num_threads)
+            self.limits = {p: max(1, int(self.num_threads * self.shares[p]))
+                           for p in priorities}
+
+    def _start_threads(self):
+        while len(self._threads) < self.num_threads:
+            t = threading.Thread(target=self._worker, daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _next(self):
+        for p in priorities:
+            if self._queues[p] and self._running[p] < self.limits[p]:
+                return p
+        return None
+
+    def _worker(self):
+        self._local.in_pool = True
+        while True:
+            with self._cond:
+                p = self._next()
+                while p is None:
+                    self._cond.wait()
+                    p = self._next()
+                future, func, args, kwargs = self._queues[p].popleft()
+                self._running[p] += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[p] -= 1
+                    self._completed[p] += 1
+                    self._cond.notify_all()
+
+    def submit(self, priority: str, func: Callable, *args, **kwargs) -> Future:
+        """Queue `func` with `args` and `kwargs` in class `priority`.
+
+        `func` runs in a copy of the caller's context, so that context
+        variables like the current trace are carried over.
+
+        """
+        future: Future = Future()
+        ctx = contextvars.copy_context()
+        with self._cond:
+            self._start_threads()
+            self._queues[priority].append((future, ctx.run, (func, *args), kwargs))
+            self._cond.notify()
+        return future
+
+    def run(self, priority: str, func: Callable, *args,
+            timeout: Optional[float] = None, **kwargs) -> Any:
+        """Run `func` in class `priority` and wait for the result.
+
+        If called from a thread of the pool itself, `func` is run directly to
+        avoid waiting on the pool from inside it.
+
+        """
+        if getattr(self._local, "in_pool", False):
+            return func(*args, **kwargs)
+        # Includes the time spent waiting for a thread
+        with tracer.span("scheduler", "scheduler", priority=priority):
+            return self.submit(priority, func, *args, **kwargs).result(timeout)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._cond:
+            return {p: {"queued": len(self._queues[p]), "running": self._running[p],
+                        "completed": self._completed[p], "limit": self.limits[p]}
+                    for p in priorities}
+
+
+scheduler = Scheduler()
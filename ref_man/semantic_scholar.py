@@ -1,73 +1,370 @@
 from typing import List, Dict, Any, Union, Optional
 import os
+import re
 import json
-import requests
+import time
 from subprocess import Popen, PIPE
 import shlex
 import pathlib
+import fcntl
+from threading import RLock
+
+from .const import upstream
+from .singleflight import single_flight
+from .scheduler import scheduler, interactive
+from .id_index import IdIndex, open_or_build
+from .tracing import tracer
+from .concurrency import limits
+from .write_behind import cache_writer
 
 
 assoc = [(x, i) for i, x in enumerate(["acl", "arxiv", "corpus", "doi"])]
+_paper_id_regexp = re.compile(r"^[0-9a-f]{40}$")
+
+
+class _Snapshot:
+    """Immutable state of :class:`SSCache`.
+
+    Entries appended after the index was built are in `base`, and the most
+    recent ones in the small `delta`, so that adding entries copies only
+    `delta`. `delta` is merged into `base` when it grows beyond
+    :attr:`SSCache.max_delta`.
+
+    """
+    __slots__ = ("index", "base", "delta")
+
+    def __init__(self, index: Optional[IdIndex], base: Dict[str, Dict[str, str]],
+                 delta: Dict[str, Dict[str, str]]):
+        self.index = index
+        self.base = base
+        self.delta = delta
+
+    def get(self, id_type: str, ID: str) -> Optional[str]:
+        paper_id = self.delta[id_type].get(ID)
+        if paper_id is None:
+            paper_id = self.base[id_type].get(ID)
+        if paper_id is None and self.index is not None:
+            paper_id = self.index.get(id_type, ID)
+        return paper_id
+
+
+class IdTable:
+    """Mapping of one type of identifier to `paperId` in :class:`SSCache`.
+
+    Supports :code:`ID in table`, :code:`table[ID]`, :meth:`get` and
+    :func:`len`. Entries appended after the index was built are looked up
+    first.
+
+    """
+    def __init__(self, id_type: str, cache: "SSCache"):
+        self.id_type = id_type
+        self.cache = cache
+
+    def get(self, ID: str, default: Optional[str] = None) -> Optional[str]:
+        paper_id = self.cache._snapshot.get(self.id_type, ID)
+        return default if paper_id is None else paper_id
+
+    def __contains__(self, ID: str) -> bool:
+        return self.get(ID) is not None
+
+    def __getitem__(self, ID: str) -> str:
+        paper_id = self.get(ID)
+        if paper_id is None:
+            raise KeyError(ID)
+        return paper_id
+
+    def __len__(self) -> int:
+        snapshot = self.cache._snapshot
+        return len(snapshot.base[self.id_type]) + len(snapshot.delta[self.id_type]) +\
+            (snapshot.index.counts[self.id_type] if snapshot.index else 0)
+
+
+class SSCache:
+    """In memory index of the Semantic Scholar cache.
+
+    Maps `acl`, `arxiv`, `corpus` and `doi` ids to Semantic Scholar `paperId`
+    and can be used like the :class:`dict` of :class:`dict` it replaces,
+    e.g., :code:`ss_cache["doi"][doi]`.
+
+    The index is backed by the `metadata` file in `data_dir`. Most of it is
+    kept in a compact memory mapped :class:`~ref_man.id_index.IdIndex` in
+    `metadata.idx` which is rebuilt by :meth:`load` when it's out of date.
+    Entries appended to `metadata` after that, by this or other processes,
+    are kept in :class:`dict` and picked up with :meth:`refresh`.
+
+    The index is safe to use from many threads. Its state is an immutable
+    snapshot which writers replace as a whole under a lock (copy on write),
+    so lookups never wait for a lock, even while an index is loaded, and see
+    all the ids of an entry or none of them.
+
+    Args:
+        data_dir: Directory where the cache is located
+        max_delta: Number of recent entries beyond which they're merged with
+                   the rest of the entries not in the index
+
+    """
+    def __init__(self, data_dir: str, max_delta: int = 1024):
+        self.data_dir = data_dir
+        self.metadata_file = os.path.join(data_dir, "metadata")
+        self.index_file = self.metadata_file + ".idx"
+        self.max_delta = max_delta
+        self._snapshot = _Snapshot(None, {k: {} for k, _ in assoc}, {k: {} for k, _ in assoc})
+        self._cache = {k: IdTable(k, self) for k, _ in assoc}
+        self._offset = 0
+        self._inode = 0
+        self._lock = RLock()
+
+    def __getitem__(self, key: str) -> IdTable:
+        return self._cache[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._cache
+
+    def keys(self):
+        return self._cache.keys()
+
+    def values(self):
+        return self._cache.values()
+
+    def items(self):
+        return self._cache.items()
+
+    def add(self, c: List[str]):
+        """Add a metadata entry `c` to the index.
+
+        `c` is a list of `[acl, arxiv, corpus, doi, paperId]` where any
+        of the ids except `paperId` can be empty.
+
+        """
+        self.add_many([c])
+
+    def add_many(self, entries: List[List[str]]):
+        "Add metadata `entries` to the index at once. See :meth:`add`."
+        if not entries:
+            return
+        with self._lock:
+            snapshot = self._snapshot
+            base, delta = snapshot.base, snapshot.delta
+            if sum(map(len, delta.values())) + len(entries) > self.max_delta:
+                base = {k: {**v, **delta[k]} for k, v in base.items()}
+                delta = {k: {} for k in delta}
+                target = base
+            else:
+                delta = {k: dict(v) for k, v in delta.items()}
+                target = delta
+            for c in entries:
+                for key, ind in assoc:
+                    if c[ind]:
+                        target[key][c[ind]] = c[-1]
+            self._snapshot = _Snapshot(snapshot.index, base, delta)
+
+    def load(self):
+        """Open the compact index, building it if required, and read the
+        entries appended to `metadata` after it.
+
+        Papers added by this process which are yet to be written by
+        :data:`~ref_man.write_behind.cache_writer` are added again, as they
+        aren't in `metadata` when it's reloaded, e.g., after eviction.
+
+        """
+        index = open_or_build(self.metadata_file, self.index_file)
+        if index is not None:
+            with self._lock:
+                base: Dict[str, Dict[str, str]] = {k: {} for k, _ in assoc}
+                for c in index.unindexed:
+                    for key, ind in assoc:
+                        if c[ind]:
+                            base[key][c[ind]] = c[-1]
+                self._offset = index.metadata_offset
+                self._inode = index.metadata_inode
+                self._snapshot = _Snapshot(index, base, {k: {} for k, _ in assoc})
+                self.add_many([line.split(",") for line in cache_writer.pending(self.data_dir)])
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Read entries appended to `metadata` since the last read.
+
+        Only complete lines are consumed so that a concurrent partial write is
+        read on the next call. If `metadata` was replaced, e.g., after
+        eviction, the index is loaded again.
+
+        Returns:
+            The number of entries read.
+
+        """
+        if self._inode and os.stat(self.metadata_file).st_ino != self._inode:
+            self.load()
+            return 0
+        with self._lock:
+            with open(self.metadata_file, "rb") as f:
+                if not self._inode:
+                    self._inode = os.fstat(f.fileno()).st_ino
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            lines = [*filter(None, data[:end].decode("utf-8").split("\n"))]
+            self.add_many([line.split(",") for line in lines])
+        return len(lines)
 
 
 def load_ss_cache(data_dir):
     """Load the ss_cache metadata from the disk.
 
     The cache is indexed as a file in `metadata` and the file data itself is
-    named as the Semantic Scholar `corpusId` for the paper. We load metadata on
+    named as the Semantic Scholar `paperId` for the paper. We load metadata on
     startup and fetch the rest as needed.
 
     Args:
         data_dir: Directory where the cache is located
 
     """
-    with open(os.path.join(data_dir, "metadata")) as f:
-        _cache = [*filter(None, f.read().split("\n"))]
-    ss_cache = {"acl": {}, "doi": {}, "arxiv": {}, "corpus": {}}
-    for _ in _cache:
-        c = _.split(",")
-        for key, ind in assoc:
-            if c[ind]:
-                ss_cache[key][c[ind]] = c[-1]
+    ss_cache = SSCache(data_dir)
+    ss_cache.load()
     print(f"Loaded cache with {sum(len(x) for x in ss_cache.values())} entries")
     return ss_cache
 
 
+def record_access(path: str):
+    """Record a read of the cache file at `path` by setting its access time.
+
+    The access time is set explicitly as `relatime` and `noatime` mounts don't
+    update it on reads. The modification time is kept as it is.
+
+    """
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def read_data(data_dir: str, paper_id: str) -> Optional[Dict[str, Any]]:
+    """Read the data for `paper_id` from the cache and record the access.
+
+    Papers fetched by this process which are yet to be written are read from
+    :data:`~ref_man.write_behind.cache_writer`.
+
+    Returns:
+        The data or `None` if it's not in the cache or `paper_id` isn't a
+        valid paperId.
+
+    """
+    # paper_id can come from a request and mustn't reach outside data_dir
+    if not _paper_id_regexp.match(paper_id):
+        return None
+    data = cache_writer.get(data_dir, paper_id)
+    if data is not None:
+        return data
+    path = os.path.join(data_dir, paper_id)
+    try:
+        with tracer.span("cache_read", "ss", paper_id=paper_id), open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    record_access(path)
+    return data
+
+
+def append_metadata(data_dir: str, lines: List[str], fsync: bool = False):
+    """Append `lines` to the `metadata` file in `data_dir` under an exclusive lock.
+
+    If the file was replaced while waiting for the lock, e.g., by
+    :func:`~ref_man.eviction.compact_metadata`, the new file is used. With
+    `fsync` the file is synced before the lock is released.
+
+    """
+    metadata_file = os.path.join(data_dir, "metadata")
+    while True:
+        with tracer.span("metadata_append", "ss", lines=len(lines)),\
+                open(metadata_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_ino != os.stat(metadata_file).st_ino:
+                continue
+            f.write("".join(line + "\n" for line in lines))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            return
+
+
 # NOTE: There's a separate acl_id here, because SS allows query by acl_id but
 #       doesn't return it if it exists in the result.
-def save_data(data, data_dir, ss_cache, acl_id):
+def save_data(data, data_dir, ss_cache, acl_id, content: Optional[bytes] = None):
     """Save Semantic Scholar cache to disk.
 
     We read and write data for individual papers instead of one big json object.
+    The paper is added to the index in memory at once and written in the
+    background by :data:`~ref_man.write_behind.cache_writer`, which writes
+    the file before appending to `metadata`, so that other processes never
+    read a partial file or an entry without one.
 
     Args:
         data: data for the paper
         data_dir: Directory where the cache is located
         ss_cache: The Semantic Scholar cache
         acl_id: ACL Id for the paper
+        content: Optional JSON `data` was parsed from, which is written as it is
 
     """
-    with open(os.path.join(data_dir, data["paperId"]), "w") as f:
-        json.dump(data, f)
     c = [acl_id if acl_id else "",
          data["arxivId"] if data["arxivId"] else "",
          str(data["corpusId"]),
          data["doi"] if data["doi"] else "",
          data["paperId"]]
-    for key, ind in assoc:
-        if c[ind]:
-            ss_cache[key][c[ind]] = c[-1]
-    # ss_cache["acl"][c[0]] = c[-1]
-    # ss_cache["arxiv"][c[1]] = c[-1]
-    # ss_cache["corpus"][c[2]] = c[-1]
-    # ss_cache["doi"][c[3]] = c[-1]
-    with open(os.path.join(data_dir, "metadata"), "a") as f:
-        f.write(",".join(c) + "\n")
-    print("Updated metadata")
+    ss_cache.add(c)
+    cache_writer.put(data_dir, data, ",".join(c), content)
+
+
+def normalize_id(id_type: str, ID: str) -> str:
+    """Normalize paper identifier `ID` of type `id_type` for comparison.
+
+    DOIs and arXiv ids are case insensitive.
+
+    """
+    ID = ID.strip()
+    return ID.lower() if id_type in {"doi", "arxiv"} else ID
+
+
+def parse_fields(fields: str) -> Dict[str, Any]:
+    """Parse a field projection string into a nested spec.
+
+    Fields are separated by commas and nested fields of `references`,
+    `citations`, `authors` etc. by dots. E.g., :code:`"title,year,citations.title"`
+    gives :code:`{"title": None, "year": None, "citations": {"title": None}}`.
+    `None` means the whole value is selected.
+
+    """
+    spec: Dict[str, Any] = {}
+    for field in filter(None, (f.strip() for f in fields.split(","))):
+        node = spec
+        parts = field.split(".")
+        for part in parts[:-1]:
+            if node.get(part, {}) is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return spec
+
+
+def project_fields(data: Any, spec: Dict[str, Any]) -> Any:
+    """Select only the fields in `spec` from `data`.
+
+    Lists are projected element wise. See :func:`parse_fields` for `spec`.
+
+    """
+    if isinstance(data, list):
+        return [project_fields(x, spec) for x in data]
+    elif isinstance(data, dict):
+        return {k: (data[k] if sub is None else project_fields(data[k], sub))
+                for k, sub in spec.items() if k in data}
+    else:
+        return data
 
 
 def semantic_scholar_paper_details(id_type: str, ID: str, data_dir: str,
-                                   ss_cache: Dict[str, Dict[str, Any]], force: bool):
+                                   ss_cache: SSCache, force: bool,
+                                   priority: str = interactive):
     """Get semantic scholar paper details
 
     The Semantic Scholar cache is checked first and if it's a miss then the
@@ -80,44 +377,61 @@ def semantic_scholar_paper_details(id_type: str, ID: str, data_dir: str,
         data_dir: Directory where the cache is loacaded
         ss_cache: The Semantic Scholar cache
         force: Force fetch from Semantic Scholar server, ignoring cache
+        priority: Scheduling class of the fetch from the server
 
     """
-    urls = {"ss": f"https://api.semanticscholar.org/v1/paper/{ID}",
-            "doi": f"https://api.semanticscholar.org/v1/paper/{ID}",
-            "mag": f"https://api.semanticscholar.org/v1/paper/MAG:{ID}",
-            "arxiv": f"https://api.semanticscholar.org/v1/paper/arXiv:{ID}",
-            "acl": f"https://api.semanticscholar.org/v1/paper/ACL:{ID}",
-            "pubmed": "https://api.semanticscholar.org/v1/paper/PMID:{ID}",
-            "corpus": f"https://api.semanticscholar.org/v1/paper/CorpusID:{ID}"}
+    api = upstream["ss_api"]
+    urls = {"ss": f"{api}/v1/paper/{ID}",
+            "doi": f"{api}/v1/paper/{ID}",
+            "mag": f"{api}/v1/paper/MAG:{ID}",
+            "arxiv": f"{api}/v1/paper/arXiv:{ID}",
+            "acl": f"{api}/v1/paper/ACL:{ID}",
+            "pubmed": f"{api}/v1/paper/PMID:{ID}",
+            "corpus": f"{api}/v1/paper/CorpusID:{ID}"}
     if id_type not in urls:
         return json.dumps("INVALID ID TYPE")
     else:
-        if id_type == "ss" and not force and ID in os.listdir(data_dir):
-            print(f"Fetching from disk for {id_type}, {ID}")
-            with open(os.path.join(data_dir, ID)) as f:
-                return json.load(f)
-        elif (id_type in {"doi", "acl", "arxiv", "corpus"}
-              and ID in ss_cache[id_type] and ss_cache[id_type][ID]
-              and not force):
-            print(f"Fetching from cache for {id_type}, {ID}")
-            with open(os.path.join(data_dir, ss_cache[id_type][ID])) as f:
-                return json.load(f)
-        else:
-            acl_id = ""
-            if id_type == "acl":
-                acl_id = ID
-            if not force:
-                print(f"Data not in cache for {id_type}, {ID}. Fetching")
+        if (id_type in {"doi", "acl", "arxiv", "corpus"}
+           and not force and ID not in ss_cache[id_type]):
+            # Another worker may have fetched it already
+            ss_cache.refresh()
+        if not force and id_type in {"ss", "doi", "acl", "arxiv", "corpus"}:
+            if id_type == "ss":
+                paper_id = ID if _paper_id_regexp.match(ID) else None
             else:
-                print(f"Forced Fetching for {id_type}, {ID}")
-            url = urls[id_type] + "?include_unknown_references=true"
-            response = requests.get(url)
+                paper_id = ss_cache[id_type].get(ID)
+            # The file may have been evicted or deleted even if it's in the index
+            data = read_data(data_dir, paper_id) if paper_id else None
+            if data is not None:
+                if id_type == "ss":
+                    print(f"Fetching from disk for {id_type}, {ID}")
+                else:
+                    print(f"Fetching from cache for {id_type}, {ID}")
+                return data
+        acl_id = ""
+        if id_type == "acl":
+            acl_id = ID
+        if not force:
+            print(f"Data not in cache for {id_type}, {ID}. Fetching")
+        else:
+            print(f"Forced Fetching for {id_type}, {ID}")
+        url = urls[id_type] + "?include_unknown_references=true"
+
+        def fetch():
+            with tracer.span("ss_fetch", "ss", id_type=id_type, ID=ID) as span:
+                response = limits.get(url)
+                span.update(status=response.status_code, bytes=len(response.content))
             if response.status_code == 200:
-                save_data(json.loads(response.content), data_dir, ss_cache, acl_id)
+                with tracer.span("parse", "ss"):
+                    data = json.loads(response.content)
+                save_data(data, data_dir, ss_cache, acl_id, response.content)
                 return response.content  # already JSON
             else:
                 print(f"Server error. Could not fetch")
                 return json.dumps(None)
+        # Concurrent lookups of the same paper share one request
+        return single_flight.do(("ss", id_type, normalize_id(id_type, ID)),
+                                scheduler.run, priority, fetch)
 
 
 class SemanticSearch:
@@ -228,8 +542,10 @@ class SemanticSearch:
         headers = {'User-agent': 'Mozilla/5.0', 'Origin': 'https://www.semanticscholar.org'}
         print("Sending request to semanticscholar search with query" +
               f": {query} and params {self.params}")
-        response = requests.post("https://www.semanticscholar.org/api/1/search",
-                                 headers=headers, json=params)
+        with tracer.span("ss_search", "ss", query=query):
+            response = scheduler.run(interactive, limits.post,
+                                     f"{upstream['ss_search']}/api/1/search",
+                                     headers=headers, json=params)
         if response.status_code == 200:
             results = json.loads(response.content)["results"]
             print(f"Got {len(results)} results for query: {query}")
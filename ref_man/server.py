@@ -1,33 +1,51 @@
-from typing import Callable, List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Any
 import os
 import json
+import gzip
+import signal
 import time
-import logging
 import requests
-from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Lock
 import flask
 from flask import Flask, request, Response
-from werkzeug import serving
 
 import re
 import operator
-from bs4 import BeautifulSoup
 
 from common_pyutil.log import get_stream_logger
 
-from .const import default_headers, __version__
+from .const import default_headers, upstream, __version__
 from .arxiv import arxiv_get, arxiv_fetch, arxiv_helper
 from .dblp import dblp_helper
-from .semantic_scholar import SemanticSearch, load_ss_cache, semantic_scholar_paper_details
+from .semantic_scholar import (SemanticSearch, load_ss_cache, semantic_scholar_paper_details,
+                               parse_fields, project_fields)
 from .cache import CacheHelper
+from .batch import (iter_batch, collect, post_json_wrapper, wants_stream, stream_results,
+                    parse_json_request, retry_policy)
+from .bibtex import converters, renderer as bib_renderer
+from .startup import Subsystems
+from .prefork import PreforkServer, make_servers, serve, server_urls
+from .proxy import ProxyMonitor
+from .singleflight import single_flight
+from .scheduler import scheduler, bulk
+from .jobs import JobManager
+from .eviction import CacheEvictor
+from .resolver import Resolver
+from .title_lookup import TitleLookup, default_sources
+from .pdf_index import PdfIndex
+from .tracing import tracer
+from .profiling import sample_stacks, collapsed, top_functions, tracemalloc_top
+from .concurrency import limits
+from .write_behind import cache_writer
+from .events import events
 
 
 app = Flask(__name__)
 
 
-def fetch_url_info(url, headers, q=None):
-    response = requests.get(url, headers=headers)
+def fetch_url_info(url, q=None, headers=default_headers):
+    from bs4 import BeautifulSoup
+    response = limits.get(url, headers=headers)
     if response.status_code == 200:
         soup = BeautifulSoup(response.content)
         title = soup.find("title").text
@@ -61,93 +79,27 @@ def fetch_url_info(url, headers, q=None):
         return retval
 
 
-def parallel_fetch(urls: List[str], fetch_func: Callable[[str, Queue], None],
-                   batch_size: int):
-    def helper(q: Queue):
-        responses = {}
-        while not q.empty():
-            url, retval = q.get()
-            responses[url] = retval
-        return responses
-    j = 0
-    content = {}
-    while True:
-        _urls = urls[(batch_size * j): (batch_size * (j + 1))].copy()
-        if not _urls:
-            break
-        q: Queue = Queue()
-        threads = []
-        for url in _urls:
-            threads.append(Thread(target=fetch_func, args=[url, q]))
-            threads[-1].start()
-        for t in threads:
-            t.join()
-        content.update(helper(q))
-        j += 1
-
-
-def post_json_wrapper(request: flask.Request, fetch_func: Callable[[str, Queue], None],
-                      helper: Callable, batch_size: int, host: str,
-                      logger: logging.Logger):
-    """Helper function to parallelize the requests and gather them.
+def compress_response(response: Response, min_size: int = 1024) -> Response:
+    """Gzip compress `response` if the client accepts it.
 
-    Args:
-        request: An instance :class:`~Flask.Request`
-        fetch_func: :func:`fetch_func` fetches the request from the server
-        helper: :func:`helper` validates and collates the results
-        batch_size: Number of simultaneous fetch requests
-        verbosity: verbosity level
+    Only textual and JSON responses larger than `min_size` bytes are
+    compressed. Streamed responses are left as they are.
 
     """
-    if not isinstance(request.json, str):
-        data = request.json
-    else:
-        try:
-            data = json.loads(request.json)
-        except Exception:
-            return json.dumps("BAD REQUEST")
-    logger.info(f"Fetching {len(data)} queries from {host}")
-    verbose = True
-    j = 0
-    content: Dict[str, str] = {}
-    while True:
-        _data = data[(batch_size * j): (batch_size * (j + 1))].copy()
-        for k, v in content.items():
-            if v == ["ERROR"]:
-                _data.append(k)
-        if not _data:
-            break
-        q: Queue = Queue()
-        threads = []
-        for d in _data:
-            # FIXME: This should also send the logger instance
-            threads.append(Thread(target=fetch_func, args=[d, q],
-                                  kwargs={"verbose": verbose}))
-            threads[-1].start()
-        for t in threads:
-            t.join()
-        content.update(helper(q))
-        j += 1
-    return json.dumps(content)
-
-
-def check_proxy(proxies: Dict[str, str], flag: Event):
-    check_count = 0
-    while flag.is_set():
-        try:
-            response = requests.get("http://google.com", proxies=proxies,
-                                    timeout=1)
-            if response.status_code != 200:
-                flag.clear()
-            else:
-                check_count = 0
-        except requests.exceptions.Timeout:
-            check_count += 1
-            print(f"Proxy failed {check_count} times")
-        if check_count > 2:
-            flag.clear()
-        time.sleep(10)
-    print("Proxy failed. Exiting from check.")
+    mimetype = response.mimetype or ""
+    if response.status_code != 200 or response.direct_passthrough or\
+       response.is_streamed or "Content-Encoding" in response.headers or\
+       "gzip" not in request.headers.get("Accept-Encoding", "").lower() or\
+       not (mimetype.startswith("text/") or mimetype == "application/json"):
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    with tracer.span("compress", "server", bytes=len(data)):
+        response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
 
 
 class Server:
@@ -162,8 +114,14 @@ class Server:
 
     host: host on which to bind
     port: port on which to bind
+    unix_socket: Path of a Unix domain socket on which to listen, in addition
+                 to or instead of `port`. Connections on both are kept alive
+                 between requests if `threaded`.
+    tcp: Whether to listen on `port`
     batch_size: Number of parallel requests to send in case parallel requests is
-                implemented for that method
+                implemented for that method. It's the initial concurrency limit
+                of each upstream host, which then adapts to the latency and errors
+                of the host. See :class:`~ref_man.concurrency.UpstreamLimits`
     data_dir: Directory where the Semantic Scholar Cache is stored.
               See :func:`load_ss_cache`
     proxy_port: Port for the proxy server. Used by `fetch_proxy`, usually for PDFs.
@@ -177,11 +135,45 @@ class Server:
                           in case of an error.
     verbosity: Verbosity control
     threaded: Start the flask server in threaded mode. Defaults to `True`.
+    workers: Number of worker processes. If more than one, the server is run
+             with :class:`~ref_man.prefork.PreforkServer`. The caches are on
+             disk and are shared by all the workers.
+    job_retention: Seconds for which results of finished batch jobs are kept.
+                   See :class:`~ref_man.jobs.JobManager`
+    cache_budget: Disk budget in MiB for the Semantic Scholar cache. 0 means
+                  no limit. See :class:`~ref_man.eviction.CacheEvictor`
+    evict_interval: Seconds between checks of the Semantic Scholar cache size
+    cache_fsync: Sync writes to the Semantic Scholar cache to disk.
+                 See :class:`~ref_man.write_behind.WriteBehind`
+    events_keepalive: Seconds after which an idle `/events` stream sends a
+                      keepalive comment. See :class:`~ref_man.events.EventBus`
+    org_dirs: Comma separated directories with org files. Papers referred to
+              in them aren't evicted from the Semantic Scholar cache.
+    max_concurrency: Maximum concurrency limit of any upstream host
+    rate_limits: Comma separated maximum requests per second of hosts, e.g.,
+                 `dblp=5,export.arxiv.org=1`
+    max_attempts: Maximum attempts for each query of a batch
+    retry_backoff: Maximum seconds before the first retry of a failed query
+                   of a batch, doubled for each retry.
+                   See :class:`~ref_man.batch.RetryPolicy`
+    threads: Number of threads for upstream requests in each worker. They're
+             shared by interactive, bulk and background requests.
+             See :class:`~ref_man.scheduler.Scheduler`
+    pdf_index_processes: Processes for extracting metadata from the pdfs in
+                         `local_pdfs_dir`. See :class:`~ref_man.pdf_index.PdfIndex`
+    debug_endpoints: Enable the `/debug` endpoints
+    trace_file: File to which request traces are written. Tracing is enabled
+                if it or `debug_endpoints` is given.
+                See :class:`~ref_man.tracing.Tracer`
+    trace_sample: Fraction of traces written to `trace_file`
+    trace_slow_ms: Requests slower than this many milliseconds are always traced
 
     """
     def __init__(self, args):
         self.host = "127.0.0.1"
         self.port = args.port
+        self.unix_socket = args.unix_socket
+        self.tcp = args.tcp
         self.batch_size = args.batch_size
         self.data_dir = args.data_dir
         self.proxy_port = args.proxy_port
@@ -190,6 +182,19 @@ class Server:
         self.chrome_debugger_path = args.chrome_debugger_path
         self.verbosity = args.verbosity
         self.threaded = args.threaded
+        self.workers = max(1, args.workers)
+        self.debug_endpoints = args.debug_endpoints
+        if args.trace_file or self.debug_endpoints:
+            tracer.configure(args.trace_file, args.trace_sample, args.trace_slow_ms)
+        scheduler.configure(args.threads)
+        limits.configure(self.batch_size, args.max_concurrency,
+                         {k: float(v) for k, v in (x.split("=") for x in
+                                                   args.rate_limits.split(",") if x)},
+                         os.path.join(self.data_dir, "concurrency_limits.json"))
+        retry_policy.configure(args.max_attempts, args.retry_backoff)
+        cache_writer.configure(fsync=args.cache_fsync)
+        events.configure(os.path.join(self.data_dir, ".ref_man_events"),
+                         keepalive=args.events_keepalive)
         # We set "error" to warning
         verbosity_levels = {"info", "error", "debug"}
         if self.verbosity not in verbosity_levels:
@@ -200,53 +205,113 @@ class Server:
         else:
             self.logger = get_stream_logger("ref_man_logger", log_level=self.verbosity)
             self.logger.debug(f"Log level is set to {args.verbosity}.")
+        self.local_pdfs_dir = args.local_pdfs_dir
+        self.remote_pdfs_dir = args.remote_pdfs_dir
+        self.remote_links_cache = args.remote_links_cache
+        self.soups: Dict[str, Any] = {}
+        self.ss_cache = None
+        self.cache_evictor = None
+        self.cache_budget = args.cache_budget
+        self.evict_interval = args.evict_interval
+        self.org_dirs = [x for x in args.org_dirs.split(",") if x]
+        self.cache_helper = None
+        self.pdf_index = None
+        self.pdf_index_processes = args.pdf_index_processes
+        self.semantic_search = None
+        self.update_cache_run = None
+        # NOTE: Everything expensive is initialized in the background by
+        #       init_subsystems after the port is bound. See `/ready`
+        self.subsystems = Subsystems(self.logger)
+        self.jobs = JobManager(os.path.join(self.data_dir, ".ref_man_jobs"), self.logger,
+                               args.job_retention)
+
+        # TODO: Maybe start up the proxy from here
+        # TODO: Maybe ssh_socks proxy server should also be entirely in python
+        #       paramiko maybe? Or some tunnel library
+        self.proxy_monitor = ProxyMonitor(self.logger, args.proxy_check_interval)
+        if self.proxy_port:
+            self.proxy_monitor.add("proxy", self.proxy_port)
+        if self.proxy_everything_port:
+            self.proxy_monitor.add("everything", self.proxy_everything_port)
+
+        self.init_routes()
+
+    def load_conference_files(self):
         # NOTE: This soup stuff should be separate buffer
+        from bs4 import BeautifulSoup
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         self.cvpr_files = [os.path.join(cur_dir, f) for f in os.listdir(cur_dir)
                            if f.lower().startswith("cvpr")]
-        self.soups = {}
         for f in self.cvpr_files:
             with open(f) as _f:
                 self.soups[f] = BeautifulSoup(_f.read(), features="lxml")
         self.logger.debug(f"Loaded conference files {self.soups.keys()}")
 
+    def load_ss_cache(self, evict: bool):
         self.ss_cache = load_ss_cache(self.data_dir)
-        self.update_cache_run = None
-        if args.local_pdfs_dir and args.remote_pdfs_dir and args.remote_links_cache:
-            self.cache_helper = CacheHelper(args.local_pdfs_dir, args.remote_pdfs_dir,
-                                            args.remote_links_cache, self.logger)
+        self.cache_evictor = CacheEvictor(self.data_dir, self.ss_cache,
+                                          int(self.cache_budget * 2**20), self.logger,
+                                          self.evict_interval, self.org_dirs)
+        if evict:
+            self.cache_evictor.start()
+
+    def init_cache_helper(self, check: bool):
+        if self.local_pdfs_dir and self.remote_pdfs_dir and self.remote_links_cache:
+            self.cache_helper = CacheHelper(self.local_pdfs_dir, self.remote_pdfs_dir,
+                                            self.remote_links_cache, self.logger, check)
         else:
-            self.cache_helper = None
             self.logger.warn("All arguments required for pdf cache not given.\n" +
                              "Will not maintain remote pdf links cache.")
 
-        # TODO: Maybe start up the proxy from here
-        # TODO: Maybe ssh_socks proxy server should also be entirely in python
-        #       paramiko maybe? Or some tunnel library
-        # if self.proxy_port:
-        #     self.logger.info(f"Will redirect fetch_proxy to on {self.proxy_port}")
-        #     proxies = {"http": f"http://127.0.0.1:{self.proxy_port}",
-        #                "https": f"http://127.0.0.1:{self.proxy_port}"}
-        #     # flag = Event()
-        #     # flag.set()
-        #     # check_proxy_thread = Thread(target=check_proxy, args=[proxies, flag])
-        #     # check_proxy_thread.start()
-        # else:
-        #     proxies = None
-        # if self.proxy_everything_port:
-        #     self.logger.info(f"Will proxy everything on {self.proxy_everything_port}")
-        #     everything_proxies = {"http": f"http://127.0.0.1:{self.proxy_everything_port}",
-        #                           "https": f"http://127.0.0.1:{self.proxy_everything_port}"}
-        #     flag = Event()
-        #     flag.set()
-        #     check_proxy_thread = Thread(target=check_proxy, args=[proxies, flag])
-        #     check_proxy_thread.start()
-        # else:
-        #     everything_proxies = None
-
-        self.check_proxies()
+    def init_pdf_index(self, update: bool):
+        self.subsystems.wait("ss_cache")
+        self.pdf_index = PdfIndex(self.local_pdfs_dir, self.data_dir, self.ss_cache,
+                                  self.logger, self.pdf_index_processes or None)
+        self.pdf_index.load()
+        if update:
+            Thread(target=self.pdf_index.update, daemon=True).start()
+
+    def init_proxies(self):
+        self.proxy_monitor.start()
+        # TODO: rest of helpers should also support proxy
+        # CHECK: Why are the interfaces to _dblp_helper and arxiv_helper different?
+        #        Ideally there should be a single specification
+        # NOTE: The proxies are looked up for each request so that it's routed
+        #       according to the current state of the proxy
+        _proxy = (lambda: self.everything_proxies) if self.proxy_everything else None
+        self.dblp_fetch, self.dblp_helper = dblp_helper(_proxy, True, self.proxy_monitor)
+
+    def init_semantic_search(self):
         self.semantic_search = SemanticSearch(self.chrome_debugger_path)
-        self.init_routes()
+
+    def init_subsystems(self, worker_index: int = 0):
+        """Initialize the subsystems in background threads.
+
+        Args:
+            worker_index: Index of the worker process. Only the first worker
+                          checks and fixes the pdf links cache, updates the
+                          local pdf index and evicts from the Semantic
+                          Scholar cache.
+
+        """
+        self.subsystems.start("conference_files", self.load_conference_files)
+        self.subsystems.start("ss_cache", self.load_ss_cache, worker_index == 0)
+        self.subsystems.start("cache_helper", self.init_cache_helper, worker_index == 0)
+        if self.local_pdfs_dir:
+            self.subsystems.start("pdf_index", self.init_pdf_index, worker_index == 0)
+        self.subsystems.start("proxies", self.init_proxies)
+        self.subsystems.start("semantic_search", self.init_semantic_search)
+
+    def not_ready(self, name: str) -> Optional[str]:
+        """Wait for subsystem `name` and return an error message if it failed
+        or isn't configured."""
+        if self.subsystems.wait(name):
+            return None
+        states = self.subsystems.states()
+        if name not in states:
+            return json.dumps(self.loge(f"{name} not configured"))
+        else:
+            return json.dumps(self.loge(f"{name} not available: " + states[name]["state"]))
 
     def logi(self, msg: str) -> str:
         self.logger.info(msg)
@@ -264,53 +329,73 @@ class Server:
         self.logger.error(msg)
         return msg
 
+    @property
+    def proxies(self) -> Optional[Dict[str, str]]:
+        "Proxies for `fetch_proxy` if the proxy is healthy"
+        return self.proxy_monitor.proxies("proxy")
+
+    @property
+    def everything_proxies(self) -> Optional[Dict[str, str]]:
+        "Proxies for everything else if the proxy is healthy"
+        return self.proxy_monitor.proxies("everything")
+
     def check_proxies(self) -> str:
-        msgs = []
+        """Probe all the proxies now, irrespective of their state."""
+        msgs = self.proxy_monitor.probe_all(force=True)
         if self.proxy_everything_port:
-            self.everything_proxies = None
-            everything_proxies = {"http": f"http://127.0.0.1:{self.proxy_everything_port}",
-                                  "https": f"http://127.0.0.1:{self.proxy_everything_port}"}
-            try:
-                response = requests.get("http://google.com", proxies=everything_proxies,
-                                        timeout=1)
-                if response.status_code == 200:
-                    msg = "Proxy everything seems to work"
-                    self.logger.info(msg)
-                else:
-                    msg = "Proxy everything seems reachable but wrong" +\
-                        f" status_code {response.status_code}"
-                    self.logger.info(msg)
-                self.logger.warning("Warning: proxy_everything is only implemented for DBLP.")
-                msg += "Warning: proxy_everything is only implemented for DBLP."
-                self.everything_proxies = everything_proxies
-            except requests.exceptions.Timeout:
-                msg = "Proxy for everything else not reachable"
-                self.logger.error(msg)
-            msgs.append(msg)
-        if self.proxy_port is not None:
-            self.proxies: Optional[Dict[str, str]] = None
-            proxies = {"http": f"http://127.0.0.1:{self.proxy_port}",
-                       "https": f"http://127.0.0.1:{self.proxy_port}"}
-            try:
-                response = requests.get("http://google.com", proxies=proxies,
-                                        timeout=1)
-                if response.status_code == 200:
-                    msg = f"Proxy {self.proxy_port} seems to work"
-                    self.logger.info(msg)
-                    self.proxies = proxies
-                else:
-                    msg = f"Proxy seems reachable but wrong status_code {response.status_code}"
-                    self.logger.info(msg)
-            except requests.exceptions.Timeout:
-                msg = "Timeout: Proxy not reachable. Will not proxy"
-                self.logger.error(msg)
-            except requests.exceptions.ProxyError:
-                msg = "ProxyError: Proxy not reachable. Will not proxy"
-                self.logger.error(msg)
-            msgs.append(msg)
+            msgs.append("Warning: proxy_everything is only implemented for DBLP.")
+        for msg in msgs:
+            self.logger.info(msg)
         return "\n".join(msgs)
 
+    def read_download(self, url: str, response: requests.Response,
+                      chunk_size: int = 2**16, interval: float = 0.25) -> bytes:
+        """Read the body of a streamed `response` for `url` and publish its progress.
+
+        `download` events with the bytes `received` so far and the `total`
+        from `Content-Length`, if any, are published at most every `interval`
+        seconds, and when the download ends.
+
+        """
+        total = int(response.headers.get("Content-Length") or 0) or None
+        chunks: List[bytes] = []
+        received = 0
+        last_event = time.time()
+        events.publish("download", {"url": url, "state": "downloading",
+                                    "received": 0, "total": total})
+        try:
+            for chunk in response.iter_content(chunk_size):
+                chunks.append(chunk)
+                received += len(chunk)
+                if time.time() - last_event > interval:
+                    events.publish("download", {"url": url, "state": "downloading",
+                                                "received": received, "total": total})
+                    last_event = time.time()
+        except Exception as e:
+            events.publish("download", {"url": url, "state": "error", "error": str(e),
+                                        "received": received, "total": total})
+            raise
+        events.publish("download", {"url": url, "state": "finished",
+                                    "status": response.status_code,
+                                    "received": received, "total": total})
+        return b"".join(chunks)
+
     def init_routes(self):
+        @app.before_request
+        def start_trace():
+            flask.g.trace_token = tracer.start(request.path, method=request.method,
+                                               query=request.query_string.decode("utf-8"))
+
+        @app.after_request
+        def compress(response: Response) -> Response:
+            if tracer.current:
+                response.headers["X-Trace-Id"] = tracer.current.id
+            return compress_response(response)
+
+        @app.teardown_request
+        def finish_trace(exc):
+            tracer.finish(flask.g.pop("trace_token", None))
+
         @app.route("/arxiv", methods=["GET", "POST"])
         def arxiv():
             if request.method == "GET":
@@ -320,9 +405,8 @@ class Server:
                     return json.dumps("NO ID GIVEN")
                 return arxiv_get(id)
             else:
-                result = post_json_wrapper(request, arxiv_fetch, arxiv_helper,
-                                           self.batch_size, "Arxiv", self.logger)
-                return json.dumps(result)
+                return post_json_wrapper(request, arxiv_fetch, arxiv_helper,
+                                         limits.window(upstream["arxiv"]), "Arxiv", self.logger)
 
         @app.route("/semantic_scholar", methods=["GET", "POST"])
         def ss():
@@ -339,18 +423,113 @@ class Server:
                     force = True
                 else:
                     force = False
+                error = self.not_ready("ss_cache")
+                if error:
+                    return error
                 data = semantic_scholar_paper_details(id_type, id, self.data_dir,
                                                       self.ss_cache, force)
+                if request.args.get("fields"):
+                    if isinstance(data, (str, bytes)):
+                        data = json.loads(data)
+                    # Errors and misses, e.g., `None`, are returned as they are
+                    if isinstance(data, dict):
+                        data = project_fields(data, parse_fields(request.args["fields"]))
+                    with tracer.span("serialize", "server"):
+                        data = json.dumps(data)
+                    return Response(data, mimetype="application/json")
+                if isinstance(data, (dict, list)):
+                    with tracer.span("serialize", "server"):
+                        data = json.dumps(data)
+                    return Response(data, mimetype="application/json")
                 return data
             else:
                 return json.dumps("METHOD NOT IMPLEMENTED")
 
+        @app.route("/pin", methods=["GET"])
+        def pin():
+            """Pin a paper in the Semantic Scholar cache so that it's never evicted.
+
+            The paper is given by `id` and `id_type` (default `ss`) arguments.
+            With a `remove` argument it's unpinned instead.
+            """
+            if "id" not in request.args:
+                return json.dumps("NO ID GIVEN")
+            error = self.not_ready("ss_cache")
+            if error:
+                return error
+            id_type = request.args.get("id_type", "ss")
+            if "remove" in request.args:
+                self.cache_evictor.unpin(id_type, request.args["id"])
+                return self.logi(f"Unpinned {id_type}:{request.args['id']}")
+            else:
+                self.cache_evictor.pin(id_type, request.args["id"])
+                return self.logi(f"Pinned {id_type}:{request.args['id']}")
+
+        @app.route("/ss_cache_usage", methods=["GET"])
+        def ss_cache_usage():
+            """Report the disk usage and budget of the Semantic Scholar cache,
+            and the papers written by this worker.
+
+            With an `evict` argument the cache is evicted right away if it's
+            over budget.
+            """
+            error = self.not_ready("ss_cache")
+            if error:
+                return error
+            if "evict" in request.args:
+                return json.dumps(self.cache_evictor.evict())
+            total, files = self.cache_evictor.usage()
+            return json.dumps({"bytes": total, "files": len(files),
+                               "budget": self.cache_evictor.budget,
+                               "last_run": self.cache_evictor.last_run,
+                               "writer": cache_writer.stats()})
+
+        @app.route("/bibtex", methods=["POST"])
+        def bibtex():
+            """Render a batch of records to BibTeX with unique citation keys.
+
+            The JSON data is a list of objects with a `source` which is one of
+            `dblp`, `arxiv`, `ss` or `dict`, and either the record as `data`
+            or, for `ss`, an `id` and optional `id_type` to read it from the
+            Semantic Scholar cache. Returns a list of BibTeX strings in the
+            same order, `null` for records which couldn't be converted.
+            """
+            data = parse_json_request(request)
+            if not isinstance(data, list):
+                return json.dumps("BAD REQUEST")
+            items = []
+            for item in data:
+                source = item.get("source") if isinstance(item, dict) else None
+                if source not in converters:
+                    items.append(None)
+                elif source == "ss" and "id" in item:
+                    error = self.not_ready("ss_cache")
+                    if error:
+                        return error
+                    record = semantic_scholar_paper_details(item.get("id_type", "ss"),
+                                                            item["id"], self.data_dir,
+                                                            self.ss_cache, False,
+                                                            priority=bulk)
+                    if isinstance(record, (str, bytes)):
+                        record = json.loads(record)
+                    items.append((source, record) if isinstance(record, dict) else None)
+                else:
+                    items.append((source, item.get("data") or {}))
+            rendered = bib_renderer.render_many([x for x in items if x is not None])
+            result = []
+            for x in items:
+                result.append(rendered.pop(0) if x is not None else None)
+            return Response(json.dumps(result), mimetype="application/json")
+
         @app.route("/semantic_scholar_search", methods=["GET", "POST"])
         def ss_search():
             if "q" in request.args and request.args["q"]:
                 query = request.args["q"]
             else:
                 return json.dumps("NO QUERY GIVEN or EMPTY QUERY")
+            error = self.not_ready("semantic_search")
+            if error:
+                return error
             if request.method == "GET":
                 return self.semantic_search.semantic_scholar_search(query)
             else:
@@ -360,9 +539,72 @@ class Server:
                     kwargs = {}
                 return self.semantic_search.semantic_scholar_search(query, **kwargs)
 
+        @app.route("/title_lookup", methods=["GET"])
+        def title_lookup():
+            """Look up a paper by its `title` in DBLP, Semantic Scholar search
+            and arXiv at once and return the first good match.
+
+            Optional arguments are the `year` of the paper, `grace_ms` to wait
+            for the other sources after a good match and `sequential` to try
+            the sources one after the other instead. See
+            :class:`~ref_man.title_lookup.TitleLookup` for the result.
+            """
+            title = request.args.get("title", "").strip()
+            if not title:
+                return json.dumps("NO TITLE GIVEN")
+            error = self.not_ready("proxies")
+            if error:
+                return error
+            semantic_search = self.semantic_search if not self.not_ready("semantic_search")\
+                else None
+            lookup = TitleLookup(default_sources(self.dblp_fetch, self.dblp_helper,
+                                                 semantic_search))
+            grace = request.args.get("grace_ms")
+            result = lookup.lookup(title, request.args.get("year", ""),
+                                   "sequential" in request.args,
+                                   float(grace) / 1000 if grace else None)
+            return Response(json.dumps(result), mimetype="application/json")
+
+        @app.route("/resolve_references", methods=["POST"])
+        def resolve_references():
+            """Resolve a list of free text references to structured records.
+
+            The JSON data is a list of reference strings. See
+            :class:`~ref_man.resolver.Resolver` for the pipeline and the
+            results. If the request has a `stream` argument or accepts
+            `application/x-ndjson`, each result is streamed as an NDJSON record
+            as soon as it's resolved, followed by a final record with the
+            throughput of each stage. Otherwise the results are returned in
+            order as `results` with the throughput as `stats`.
+            """
+            data = parse_json_request(request)
+            if not isinstance(data, list):
+                return json.dumps("BAD REQUEST")
+            for name in ["ss_cache", "proxies"]:
+                error = self.not_ready(name)
+                if error:
+                    return error
+            semantic_search = self.semantic_search if not self.not_ready("semantic_search")\
+                else None
+            resolver = Resolver(self.data_dir, self.ss_cache, self.dblp_fetch, self.dblp_helper,
+                                semantic_search, self.logger, self.batch_size)
+            results = resolver.resolve([str(x) for x in data])
+            if wants_stream(request):
+                return Response((json.dumps(x) + "\n" for x in results),
+                                mimetype="application/x-ndjson")
+            else:
+                *items, stats = results
+                return Response(json.dumps({"results": sorted(items, key=lambda x: x["index"]),
+                                            "stats": stats}),
+                                mimetype="application/json")
+
         @app.route("/url_info", methods=["GET"])
         def url_info():
-            """Fetch info about a given url or urls based on certain rules."""
+            """Fetch info about a given url or urls based on certain rules.
+
+            Results for `urls` are streamed as NDJSON if requested.
+            See :func:`~ref_man.batch.post_json_wrapper`.
+            """
             if "url" in request.args and request.args["url"]:
                 url = request.args["url"]
                 urls = None
@@ -372,20 +614,77 @@ class Server:
             else:
                 return json.dumps("NO URL or URLs GIVEN")
             if urls is not None:
-                return parallel_fetch(urls, fetch_url_info, self.batch_size)
+                results = iter_batch(urls, fetch_url_info, collect, self.batch_size)
+                if wants_stream(request):
+                    return stream_results(results)
+                else:
+                    return json.dumps(dict(results))
             elif url is not None:
                 return json.dumps(fetch_url_info(url))
             else:
                 return json.dumps("NO URL or URLs GIVEN")
 
+        @app.route("/local_pdf")
+        def local_pdf():
+            """Look up a pdf in `local_pdfs_dir`.
+
+            Either `url` for an arXiv or doi.org url, or `id` and `id_type` are
+            required. `id_type` can be `arxiv`, `doi`, `ss`, `title` or any
+            other type in the Semantic Scholar cache. Returns the metadata and
+            `path` of the file. See :class:`~ref_man.pdf_index.PdfIndex`.
+            """
+            error = self.not_ready("pdf_index")
+            if error:
+                return error
+            if self.pdf_index is None:
+                return json.dumps(self.loge("Local pdf index is not available."))
+            if request.args.get("url"):
+                entry = self.pdf_index.lookup_url(request.args["url"])
+            elif request.args.get("id") and request.args.get("id_type"):
+                entry = self.pdf_index.lookup(request.args["id_type"], request.args["id"])
+            else:
+                return json.dumps("NO URL or ID and ID_TYPE GIVEN")
+            if entry is None:
+                return json.dumps("NOT FOUND")
+            return json.dumps(entry)
+
+        @app.route("/update_pdf_index")
+        def update_pdf_index():
+            """Update the index of `local_pdfs_dir` in the background.
+
+            With a `wait` argument, wait for the update and return its summary.
+            """
+            error = self.not_ready("pdf_index")
+            if error:
+                return error
+            if self.pdf_index is None:
+                return json.dumps(self.loge("Local pdf index is not available."))
+            if "wait" in request.args:
+                return json.dumps(self.pdf_index.update())
+            Thread(target=self.pdf_index.update, daemon=True).start()
+            return json.dumps({"updating": True, "last_update": self.pdf_index.last_update})
+
         @app.route("/fetch_proxy")
         def fetch_proxy():
             """Fetch URL with :attr:`self.proxies` if :attr:`self.proxies` is not `None`.
+
+            arXiv and doi.org urls of papers in the local pdf index are served
+            from the local file unless `no_local` is given. The progress of
+            the download is published as `download` events, see `/events`.
             """
             if "url" in request.args and request.args["url"]:
                 url = request.args["url"]
             else:
                 return json.dumps("NO URL GIVEN or BAD URL")
+            if self.pdf_index and "no_local" not in request.args:
+                entry = self.pdf_index.lookup_url(url)
+                if entry:
+                    self.logger.debug(f"Serving {url} from {entry['path']}")
+                    with open(entry["path"], "rb") as f:
+                        return Response(f.read(), mimetype="application/pdf")
+            error = self.not_ready("proxies")
+            if error:
+                return error
             # DEBUG code
             # if url == "https://arxiv.org/pdf/2006.01912":
             #     with os.path.expanduser("~/pdf_file.pdf", "rb") as f:
@@ -393,35 +692,38 @@ class Server:
             #     response = make_response(pdf_data)
             #     response.headers["Content-Type"] = "application/pdf"
             #     return response
-            self.logger.debug(f"Fetching {url} with proxies {self.proxies}")
-            if self.proxies:
+            proxies = self.proxies
+            self.logger.debug(f"Fetching {url} with proxies {proxies}")
+            if proxies:
                 try:
-                    response = requests.get(url, headers=default_headers, proxies=self.proxies)
-                except requests.exceptions.Timeout:
+                    with tracer.span("proxy_fetch", "server", url=url):
+                        response = limits.get(url, headers=default_headers, proxies=proxies,
+                                              timeout=(self.proxy_monitor.timeout, None),
+                                              stream=True)
+                except (requests.exceptions.ConnectTimeout, requests.exceptions.ProxyError):
                     self.logger.error("Proxy not reachable. Fetching without proxy")
-                    self.proxies = None
-                    response = requests.get(url, headers=default_headers)
-                except requests.exceptions.ProxyError:
-                    self.logger.error("Proxy not reachable. Fetching without proxy")
-                    self.proxies = None
-                    response = requests.get(url, headers=default_headers)
+                    self.proxy_monitor.report_failure("proxy")
+                    with tracer.span("fetch", "server", url=url):
+                        response = limits.get(url, headers=default_headers, stream=True)
             else:
                 self.logger.warn("Proxy dead. Fetching without proxy")
-                response = requests.get(url, headers=default_headers)
+                with tracer.span("fetch", "server", url=url):
+                    response = limits.get(url, headers=default_headers, stream=True)
+            content = self.read_download(url, response)
             if url.startswith("http:") or response.url.startswith("https:"):
-                return Response(response.content)
+                return Response(content)
             elif response.url != url:
                 if response.headers["Content-Type"] in\
                    {"application/pdf", "application/octet-stream"}:
-                    return Response(response.content)
+                    return Response(content)
                 elif response.headers["Content-Type"].startswith("text"):
                     return json.dumps({"redirect": response.url,
-                                       "content": response.content.decode("utf-8")})
+                                       "content": content.decode("utf-8")})
                 else:
                     return json.dumps({"redirect": response.url,
                                        "content": "Error, unknown content from redirect"})
             else:
-                return Response(response.content)
+                return Response(content)
 
         @app.route("/progress")
         def progress():
@@ -437,6 +739,9 @@ class Server:
 
         @app.route("/update_links_cache")
         def update_links_cache():
+            error = self.not_ready("cache_helper")
+            if error:
+                return error
             if not self.cache_helper:
                 return self.loge("Cache helper is not available.")
             if not self.update_cache_run:
@@ -452,6 +757,9 @@ class Server:
 
         @app.route("/force_stop_update_cache")
         def foce_stop_update_cache():
+            error = self.not_ready("cache_helper")
+            if error:
+                return error
             if not self.cache_helper:
                 return self.loge("Cache helper is not available.")
             if not self.update_cache_run:
@@ -462,6 +770,9 @@ class Server:
 
         @app.route("/cache_updated")
         def cache_updated():
+            error = self.not_ready("cache_helper")
+            if error:
+                return error
             if not self.cache_helper:
                 return self.loge("Cache helper is not available.")
             if not self.update_cache_run:
@@ -475,8 +786,40 @@ class Server:
             else:
                 return self.logi("Nothing was updated in last call to update cache")
 
+        @app.route("/events")
+        def events_stream():
+            """Stream progress events as server-sent events.
+
+            Instead of polling `/cache_updated` and `/jobs/<job_id>`, a client
+            can keep this connection open. Events are pushed as they happen
+            in any worker, with the topic as the event type:
+
+            - `cache`: progress of the pdf links cache update. The current
+              state is sent first.
+            - `job`: status of a batch job, without its results.
+            - `download`: progress of a download by `/fetch_proxy`.
+
+            The data of each event is a JSON object with `topic`, `time`,
+            `pid` and `data`. Optional argument `topics` is a comma separated
+            list of topics, all by default. A client reconnecting with a
+            `Last-Event-ID` header gets the events it missed, if they're
+            still in the events log.
+            """
+            topics = {x for x in request.args.get("topics", "").split(",") if x}
+            initial = []
+            if (not topics or "cache" in topics) and self.cache_helper:
+                initial.append(("cache", {"state": self.cache_helper.state}))
+            sub = events.subscribe(topics, request.headers.get("Last-Event-ID"))
+            response = Response(events.stream(sub, initial), mimetype="text/event-stream")
+            response.headers["Cache-Control"] = "no-cache"
+            response.headers["X-Accel-Buffering"] = "no"
+            return response
+
         @app.route("/check_proxies")
         def check_proxies():
+            error = self.not_ready("proxies")
+            if error:
+                return error
             return self.check_proxies()
 
         @app.route("/get_cvpr_url", methods=["GET"])
@@ -492,6 +835,9 @@ class Server:
                 except Exception:
                     year = None
                 title = request.args["title"]
+            error = self.not_ready("conference_files")
+            if error:
+                return error
             if year:
                 soups = self.soups[f"cvpr_{year}"].find_all("a")
             else:
@@ -524,28 +870,212 @@ class Server:
         def version():
             return f"ref-man python server {__version__}"
 
-        # TODO: rest of helpers should also support proxy
-        # CHECK: Why are the interfaces to _dblp_helper and arxiv_helper different?
-        #        Ideally there should be a single specification
-        _proxy = self.everything_proxies if self.proxy_everything else None
-        dblp_fetch, _dblp_helper = dblp_helper(_proxy, True)
+        @app.route("/ready", methods=["GET"])
+        def ready():
+            """Report the initialization state of each subsystem."""
+            return json.dumps({"ready": self.subsystems.ready,
+                               "subsystems": self.subsystems.states()})
+
+        @app.route("/coalescing_stats", methods=["GET"])
+        def coalescing_stats():
+            """Report upstream requests made and saved by coalescing identical lookups."""
+            return json.dumps(single_flight.stats())
+
+        @app.route("/scheduler_stats", methods=["GET"])
+        def scheduler_stats():
+            """Report queued, running and completed upstream requests by priority."""
+            return json.dumps(scheduler.stats())
+
+        @app.route("/concurrency_limits", methods=["GET"])
+        def concurrency_limits():
+            """Report the adaptive concurrency limit, latency and errors of each
+            upstream host in this worker."""
+            return json.dumps(limits.stats())
+
+        @app.route("/proxy_status", methods=["GET"])
+        def proxy_status():
+            """Report the circuit breaker state of each proxy."""
+            return json.dumps(self.proxy_monitor.status())
 
         @app.route("/dblp", methods=["POST"])
         def dblp():
             """Fetch from DBLP"""
-            result = post_json_wrapper(request, dblp_fetch, _dblp_helper,
-                                       self.batch_size, "DBLP", self.logger)
+            error = self.not_ready("proxies")
+            if error:
+                return error
+            result = post_json_wrapper(request, self.dblp_fetch, self.dblp_helper,
+                                       limits.window(upstream["dblp"]), "DBLP", self.logger)
             return result
 
+        @app.route("/jobs", methods=["GET", "POST"])
+        def jobs():
+            """Submit a batch job or list all the jobs.
+
+            A POST with a `source` argument, one of `dblp` or `arxiv`, and the
+            queries as JSON data like for `/dblp` and `/arxiv` starts a job
+            and returns its status with the job `id` right away. Submitting
+            the same queries again returns the existing job while it's
+            running or retained.
+            """
+            if request.method == "GET":
+                return json.dumps(self.jobs.list())
+            source = request.args.get("source", "")
+            if source == "dblp":
+                error = self.not_ready("proxies")
+                if error:
+                    return error
+                fetch_func, helper = self.dblp_fetch, self.dblp_helper
+            elif source == "arxiv":
+                fetch_func, helper = arxiv_fetch, arxiv_helper
+            else:
+                return json.dumps("INVALID SOURCE")
+            data = parse_json_request(request)
+            if not isinstance(data, list):
+                return json.dumps("BAD REQUEST")
+            return json.dumps(self.jobs.submit(source, data, fetch_func, helper,
+                                               limits.window(upstream[source]),
+                                               {"verbose": True}))
+
+        @app.route("/jobs/<job_id>", methods=["GET"])
+        def job_status(job_id):
+            """Status of a job.
+
+            With an `offset` argument, also return the results after the first
+            `offset` ones, so that partial results can be read incrementally.
+            """
+            offset = request.args.get("offset")
+            status = self.jobs.status(job_id, int(offset) if offset else None)
+            if status is None:
+                return json.dumps("NO SUCH JOB")
+            return json.dumps(status)
+
+        @app.route("/jobs/<job_id>/cancel", methods=["GET", "POST"])
+        def cancel_job(job_id):
+            """Cancel a job. Results fetched so far are kept."""
+            status = self.jobs.cancel(job_id)
+            if status is None:
+                return json.dumps("NO SUCH JOB")
+            return json.dumps(status)
+
+        if self.debug_endpoints:
+            self.init_debug_routes()
+
         @app.route("/shutdown")
         def shutdown():
-            if self.cache_helper:
-                self.logd("Shutting down cache helper.")
-                self.cache_helper.shutdown()
-            func = request.environ.get('werkzeug.server.shutdown')
-            func()
+            self.shutdown_helpers()
+            if self.workers > 1:
+                # The parent stops all the workers
+                os.kill(os.getppid(), signal.SIGTERM)
+            else:
+                func = request.environ.get('werkzeug.server.shutdown')
+                func()
             return self.logi("Shutting down")
 
+    def init_debug_routes(self):
+        "Routes for debugging and profiling, enabled with `--debug-endpoints`."
+        # Only one profile at a time in each worker
+        profile_lock = Lock()
+
+        def profile_response(text: str) -> Response:
+            response = Response(text, mimetype="text/plain")
+            response.headers["X-Worker-Pid"] = str(os.getpid())
+            return response
+
+        @app.route("/debug/profile")
+        def debug_profile():
+            """Profile all the threads of this worker by sampling their stacks.
+
+            Arguments are `seconds` (default 10, at most 300), `interval` in
+            milliseconds (default 5), `idle` to include threads waiting for
+            work and `format`. `format` can be `collapsed`
+            (default) for stacks ready for `flamegraph.pl` or speedscope, or
+            `top` for a pstats like table of functions. Requests made during
+            the profile, background cache updates and batch fetches all show
+            up. See :func:`~ref_man.profiling.sample_stacks`.
+            """
+            seconds = min(float(request.args.get("seconds", 10)), 300)
+            interval = max(float(request.args.get("interval", 5)), 1) / 1000
+            if not profile_lock.acquire(blocking=False):
+                return json.dumps("PROFILE ALREADY RUNNING")
+            try:
+                counts, samples = sample_stacks(seconds, interval, "idle" in request.args)
+            finally:
+                profile_lock.release()
+            if request.args.get("format") == "top":
+                return profile_response(top_functions(counts, samples, interval,
+                                                      int(request.args.get("n", 40))))
+            return profile_response(collapsed(counts))
+
+        @app.route("/debug/tracemalloc")
+        def debug_tracemalloc():
+            """Top allocations of this worker with :mod:`tracemalloc`.
+
+            Arguments are `seconds` to trace for (default 10 if tracemalloc
+            isn't already running), `n` (default 25), `group` which can be
+            `lineno` (default), `filename` or `traceback` and `frames` for
+            the depth of tracebacks. See :func:`~ref_man.profiling.tracemalloc_top`.
+            """
+            group = request.args.get("group", "lineno")
+            if group not in {"lineno", "filename", "traceback"}:
+                return json.dumps("BAD GROUP")
+            frames = int(request.args.get("frames", 10 if group == "traceback" else 1))
+            if not profile_lock.acquire(blocking=False):
+                return json.dumps("PROFILE ALREADY RUNNING")
+            try:
+                text = tracemalloc_top(min(float(request.args.get("seconds", 0)), 300),
+                                       int(request.args.get("n", 25)), group, frames)
+            finally:
+                profile_lock.release()
+            return profile_response(text)
+
+        @app.route("/debug/traces")
+        def debug_traces():
+            """Recent slow traces of this worker, slowest first.
+
+            Traces slower than `--trace-slow-ms` are kept. Takes optional
+            arguments `n` for the number of traces and `format`. With
+            :code:`format=chrome` the traces are returned in the Chrome trace
+            event format, which can be loaded in `chrome://tracing` or
+            Perfetto.
+            """
+            traces = tracer.slow_traces(int(request.args.get("n", 20)))
+            if request.args.get("format") == "chrome":
+                return Response(json.dumps([e for t in traces for e in t.events()]),
+                                mimetype="application/json")
+            return Response(json.dumps({"pid": os.getpid(), "counts": tracer.counts,
+                                        "slow_ms": tracer.slow_ms,
+                                        "traces": [t.summary() for t in traces]}),
+                            mimetype="application/json")
+
+    def shutdown_helpers(self):
+        "Stop the background helpers of this process."
+        if not cache_writer.flush(timeout=60):
+            self.logger.error("Timed out writing the Semantic Scholar cache")
+        events.stop()
+        self.proxy_monitor.stop()
+        limits.stop()
+        if self.cache_evictor:
+            self.cache_evictor.stop()
+        if self.cache_helper:
+            self.logd("Shutting down cache helper.")
+            self.cache_helper.shutdown()
+
     def run(self):
         "Run the server"
-        serving.run_simple(self.host, self.port, app, threaded=self.threaded)
+        if self.workers > 1:
+            PreforkServer(self.host, self.port, app, self.workers, self.threaded,
+                          self.logger, on_worker_start=self.init_subsystems,
+                          on_worker_exit=self.shutdown_helpers,
+                          unix_socket=self.unix_socket, tcp=self.tcp).serve_forever()
+        else:
+            self.init_subsystems()
+            servers = make_servers(self.host, self.port, app, self.threaded,
+                                   self.unix_socket, self.tcp)
+            self.logger.info(f"Serving on {server_urls(servers)}")
+            try:
+                serve(servers, lambda: False)
+            finally:
+                for server in servers:
+                    server.server_close()
+                if self.unix_socket and os.path.exists(self.unix_socket):
+                    os.unlink(self.unix_socket)
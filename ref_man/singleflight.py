@@ -0,0 +1,67 @@
+from typing import Any, Callable, Dict, Hashable, Tuple
+from threading import Event, Lock
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Any = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream lookups into one.
+
+    Calls to :meth:`do` with the same `key` while one is in flight wait for
+    it and all get its result, instead of each sending its own request.
+    The first element of `key` is the source (e.g., `"dblp"` or `"ss"`) and
+    is used for the counters in :meth:`stats`.
+
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, source: str, what: str):
+        counts = self._stats.setdefault(source, {"calls": 0, "upstream": 0, "coalesced": 0})
+        counts["calls"] += 1
+        counts[what] += 1
+
+    def do(self, key: Tuple, func: Callable, *args, **kwargs) -> Any:
+        """Call `func` with `args` and `kwargs` unless a call with `key` is in flight.
+
+        Exceptions raised by `func` are raised in all the waiting callers.
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._count(key[0], "upstream")
+            else:
+                self._count(key[0], "coalesced")
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Counts of calls, upstream requests made and upstream requests saved
+        for each source."""
+        with self._lock:
+            return {k: v.copy() for k, v in self._stats.items()}
+
+
+single_flight = SingleFlight()
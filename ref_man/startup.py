@@ -0,0 +1,68 @@
+from typing import Callable, Dict
+import time
+import logging
+from threading import Thread, Event, Lock
+
+
+class Subsystems:
+    """Initialize subsystems in the background and keep track of their state.
+
+    The server starts listening immediately and each subsystem is initialized
+    in its own thread. Routes which need a subsystem :meth:`wait` for it and
+    `/ready` reports :meth:`states`.
+
+    Args:
+        logger: Logger instance
+
+    """
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self._states: Dict[str, str] = {}
+        self._durations: Dict[str, float] = {}
+        self._events: Dict[str, Event] = {}
+        self._lock = Lock()
+
+    def _run(self, name: str, func: Callable, *args):
+        with self._lock:
+            self._states[name] = "initializing"
+        start = time.time()
+        try:
+            func(*args)
+            state = "ready"
+        except Exception as e:
+            self.logger.error(f"Error initializing {name}: {e}")
+            state = f"error: {e}"
+        with self._lock:
+            self._states[name] = state
+            self._durations[name] = time.time() - start
+        self.logger.debug(f"{name} {state} in {self._durations[name]:.3f} seconds")
+        self._events[name].set()
+
+    def start(self, name: str, func: Callable, *args):
+        """Initialize subsystem `name` by calling `func` with `args` in a thread."""
+        with self._lock:
+            self._states[name] = "pending"
+            self._events[name] = Event()
+        Thread(target=self._run, args=[name, func, *args], daemon=True).start()
+
+    def wait(self, name: str, timeout: float = 60) -> bool:
+        """Wait for subsystem `name` to be initialized.
+
+        Returns:
+            True if the subsystem was initialized without errors.
+
+        """
+        if name not in self._events:
+            return False
+        self._events[name].wait(timeout)
+        return self._states[name] == "ready"
+
+    def states(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {k: {"state": v, "duration": self._durations.get(k)}
+                    for k, v in self._states.items()}
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(v == "ready" for v in self._states.values())
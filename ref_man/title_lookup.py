@@ -0,0 +1,209 @@
+from typing import Callable, Dict, List, Optional, Any, Tuple
+import re
+import json
+import time
+from queue import Queue, Empty
+
+from .arxiv import arxiv_search
+from .batch import is_error
+from .bibtex import renderer
+from .resolver import title_confidence, ss_search_record, _normalize
+from .scheduler import scheduler, interactive
+from .tracing import tracer
+
+
+Search = Callable[[str], List[Dict[str, Any]]]
+
+_arxiv_url_regexp = re.compile(r"arxiv\.org/abs/([^\s]+?)(?:v\d+)?$")
+
+# Kind of the records of each source for :data:`~ref_man.bibtex.renderer`
+kinds = {"dblp": "dblp", "ss_search": "ss", "arxiv": "arxiv"}
+
+
+def record_ids(source: str, record: Dict[str, Any]) -> Dict[str, str]:
+    "Identifiers of a `record` from `source`."
+    if source == "dblp":
+        ids = {"dblp": record.get("key"), "doi": record.get("doi")}
+        ee = record.get("ee") or []
+        for url in ee if isinstance(ee, list) else [ee]:
+            match = _arxiv_url_regexp.search(url)
+            if match:
+                ids["arxiv"] = match.group(1)
+    elif source == "ss_search":
+        ids = {"ss": record.get("paperId"), "doi": record.get("doi")}
+    else:
+        ids = {"arxiv": record.get("id"), "doi": record.get("doi")}
+    return {k: v for k, v in ids.items() if v}
+
+
+def dblp_source(dblp_fetch: Callable, dblp_helper: Callable) -> Search:
+    "DBLP title search with the fetch function and helper of :func:`~ref_man.dblp.dblp_helper`."
+    def search(title: str) -> List[Dict[str, Any]]:
+        q: Queue = Queue()
+        # Punctuation like "&" and "?" in the title would break the query
+        query = _normalize(title)
+        dblp_fetch(query, q)
+        hits = dblp_helper(q).get(query, [])
+        if is_error(hits):
+            raise ValueError(hits[0])
+        return [hit for hit in hits if isinstance(hit, dict)]
+    return search
+
+
+def ss_search_source(semantic_search: Any) -> Search:
+    "Semantic Scholar search with a :class:`~ref_man.semantic_scholar.SemanticSearch`."
+    def search(title: str) -> List[Dict[str, Any]]:
+        response = json.loads(semantic_search.semantic_scholar_search(title))
+        if "error" in response:
+            raise ValueError(response["error"])
+        return [ss_search_record(x) for x in response.get("results") or []]
+    return search
+
+
+class TitleLookup:
+    """Look up a paper by its title in several sources at once.
+
+    The title is sent to all the `sources` at the same time and the lookup
+    returns as soon as one of them has a match with at least
+    `min_confidence`, after waiting `grace` seconds more for the others.
+    Identifiers of the matches from all the sources which answered by then,
+    e.g., the DBLP key, the DOI and the arXiv id, are merged. Searches not
+    yet started are cancelled and the results of the rest are ignored.
+
+    With `sequential`, the sources are instead tried one after the other
+    until one has a good match, which is how the Emacs client looked up
+    titles before.
+
+    Args:
+        sources: Functions searching a source for a title and returning the
+                 records found, by name of the source, e.g., `dblp`. The
+                 order is the order of preference of the sources.
+        min_confidence: Minimum title similarity of a good match.
+                        See :func:`~ref_man.resolver.title_confidence`
+        grace: Seconds to wait for the other sources after a good match
+        timeout: Maximum seconds to wait for the sources
+        priority: Scheduling class of the searches
+
+    """
+    def __init__(self, sources: Dict[str, Search], min_confidence: float = 0.8,
+                 grace: float = 0.1, timeout: float = 10, priority: str = interactive):
+        self.sources = sources
+        self.min_confidence = min_confidence
+        self.grace = grace
+        self.timeout = timeout
+        self.priority = priority
+
+    def _search(self, name: str, title: str) -> Tuple[str, Any, float]:
+        start = time.monotonic()
+        with tracer.span("title_search", "title_lookup", source=name):
+            try:
+                return "ok", self.sources[name](title), time.monotonic() - start
+            except Exception as e:
+                return "error", str(e), time.monotonic() - start
+
+    def _best(self, parsed: Dict[str, str],
+              records: List[Dict[str, Any]]) -> Tuple[float, Optional[Dict[str, Any]]]:
+        best: Tuple[float, Optional[Dict[str, Any]]] = (0.0, None)
+        for record in records:
+            score = title_confidence(parsed, record.get("title") or "", record.get("year"))
+            if score > best[0]:
+                best = (score, record)
+        return best
+
+    def _answer(self, parsed: Dict[str, str], name: str, outcome: Tuple[str, Any, float],
+                status: Dict[str, Dict[str, Any]],
+                answers: Dict[str, Tuple[float, Dict[str, Any]]]) -> float:
+        kind, value, took = outcome
+        status[name] = {"status": kind, "ms": round(took * 1000, 1)}
+        if kind == "error":
+            status[name]["error"] = value
+            return 0.0
+        score, record = self._best(parsed, value)
+        if record is None:
+            status[name]["status"] = "no_result"
+            return 0.0
+        status[name]["confidence"] = score
+        answers[name] = (score, record)
+        return score
+
+    def lookup(self, title: str, year: str = "", sequential: bool = False,
+               grace: Optional[float] = None) -> Dict[str, Any]:
+        """Look up `title`.
+
+        Args:
+            title: The title
+            year: Optional year of the paper. A mismatch reduces the confidence.
+            sequential: Try the sources one after the other
+            grace: Override :attr:`grace`
+
+        Returns:
+            The best match as `source`, `record`, `bibtex` and `confidence`,
+            which are `None` and 0 if nothing was found, the merged `ids` of
+            the good matches, and the `status` of each source, one of `ok`,
+            `no_result`, `error`, `late` if it hadn't answered by the end and
+            `cancelled` or `skipped` if it wasn't searched.
+
+        """
+        parsed = {"title": title, "year": str(year or "")}
+        grace = self.grace if grace is None else grace
+        start = time.monotonic()
+        status: Dict[str, Dict[str, Any]] = {}
+        answers: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        with tracer.span("title_lookup", "title_lookup", sequential=sequential) as span:
+            if sequential:
+                for name in self.sources:
+                    if answers and max(answers.values(), key=lambda x: x[0])[0] >=\
+                       self.min_confidence:
+                        status[name] = {"status": "skipped"}
+                        continue
+                    outcome = scheduler.run(self.priority, self._search, name, title)
+                    self._answer(parsed, name, outcome, status, answers)
+            else:
+                done: Queue = Queue()
+                futures = {name: scheduler.submit(self.priority,
+                                                  lambda x: done.put((x, self._search(x, title))),
+                                                  name)
+                           for name in self.sources}
+                deadline = start + self.timeout
+                while len(status) < len(futures):
+                    try:
+                        name, outcome = done.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except Empty:
+                        break
+                    if self._answer(parsed, name, outcome, status, answers) >=\
+                       self.min_confidence:
+                        deadline = min(deadline, time.monotonic() + grace)
+                for name, future in futures.items():
+                    if name not in status:
+                        status[name] = {"status": "cancelled" if future.cancel() else "late"}
+            span["answered"] = len(answers)
+        result = self._merge(answers)
+        result.update({"title": title, "status": {k: status[k] for k in self.sources},
+                       "elapsed_ms": round((time.monotonic() - start) * 1000, 1)})
+        return result
+
+    def _merge(self, answers: Dict[str, Tuple[float, Dict[str, Any]]]) -> Dict[str, Any]:
+        order = {name: i for i, name in enumerate(self.sources)}
+        # Best match first and the order of preference among equally good ones
+        ranked = sorted(answers.items(), key=lambda x: (-x[1][0], order[x[0]]))
+        if not ranked:
+            return {"source": None, "record": None, "bibtex": None, "confidence": 0.0,
+                    "ids": {}}
+        source, (score, record) = ranked[0]
+        ids: Dict[str, str] = {}
+        for name, (s, r) in ranked:
+            if name == source or s >= self.min_confidence:
+                for k, v in record_ids(name, r).items():
+                    ids.setdefault(k, v)
+        return {"source": source, "record": record, "confidence": score, "ids": ids,
+                "bibtex": renderer.render(kinds.get(source, source), record)}
+
+
+def default_sources(dblp_fetch: Callable, dblp_helper: Callable,
+                    semantic_search: Any = None) -> Dict[str, Search]:
+    "DBLP, Semantic Scholar search if `semantic_search` is given, and arXiv."
+    sources = {"dblp": dblp_source(dblp_fetch, dblp_helper)}
+    if semantic_search is not None:
+        sources["ss_search"] = ss_search_source(semantic_search)
+    sources["arxiv"] = arxiv_search
+    return sources
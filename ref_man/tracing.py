@@ -0,0 +1,207 @@
+from typing import Dict, List, Optional, Any, Iterator
+import os
+import json
+import time
+import uuid
+import fcntl
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+
+
+class Trace:
+    """Spans recorded for one request.
+
+    Args:
+        name: Name of the request, e.g., the url path
+        args: Extra arguments shown with the request span
+
+    """
+    def __init__(self, name: str, args: Dict[str, Any]):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.args = args
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[Dict[str, Any]] = []
+
+    def now(self) -> float:
+        "Microseconds since the epoch with the resolution of :func:`time.perf_counter`."
+        return (self.start + time.perf_counter() - self._perf) * 1e6
+
+    def events(self) -> List[Dict[str, Any]]:
+        "The trace as complete events of the Chrome trace event format."
+        pid = os.getpid()
+        root = {"name": self.name, "cat": "request", "ph": "X", "ts": self.start * 1e6,
+                "dur": self.duration * 1e6, "pid": pid, "tid": self.spans[0]["tid"]
+                if self.spans else threading.get_ident(),
+                "args": {"trace_id": self.id, **self.args}}
+        return [root, *({**s, "pid": pid, "args": {"trace_id": self.id, **s["args"]}}
+                        for s in self.spans)]
+
+    def summary(self) -> Dict[str, Any]:
+        return {"id": self.id, "name": self.name, "start": self.start,
+                "duration_ms": round(self.duration * 1000, 2), "args": self.args,
+                "spans": [{"name": s["name"], "cat": s["cat"], "tid": s["tid"],
+                           "offset_ms": round(s["ts"] / 1000 - self.start * 1000, 2),
+                           "duration_ms": round(s["dur"] / 1000, 2), **s["args"]}
+                          for s in sorted(self.spans, key=lambda x: x["ts"])]}
+
+
+class Tracer:
+    """Lightweight tracing of requests with named spans.
+
+    A trace is started for each request with :meth:`start` and code called
+    while handling it records spans with :meth:`span`. The current trace is
+    kept in a :class:`contextvars.ContextVar`, so spans in threads of the
+    :class:`~ref_man.scheduler.Scheduler` are attributed to the request that
+    queued the work.
+
+    A fraction `sample_rate` of traces is appended to `trace_file` in the
+    Chrome trace event format, which can be opened in `chrome://tracing` or
+    Perfetto. The file is rotated when it grows beyond `max_bytes`. Traces
+    slower than `slow_ms` are kept in memory, irrespective of sampling, and
+    are also written to the file.
+
+    When disabled, which is the default, :meth:`span` costs a context variable
+    lookup.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = ""
+        self.sample_rate = 0.0
+        self.slow_ms = 1000.0
+        self.max_bytes = 64 * 2**20
+        self.backups = 3
+        self.slow: deque = deque(maxlen=100)
+        self.counts = {"traces": 0, "sampled": 0, "slow": 0}
+        self._current: ContextVar[Optional[Trace]] = ContextVar("ref_man_trace", default=None)
+        self._lock = threading.Lock()
+
+    def configure(self, trace_file: str = "", sample_rate: float = 0.01,
+                  slow_ms: float = 1000, keep: int = 100,
+                  max_bytes: int = 64 * 2**20, backups: int = 3):
+        """Enable tracing.
+
+        Args:
+            trace_file: File to which sampled and slow traces are written.
+                        Traces aren't written if not given.
+            sample_rate: Fraction of traces written to `trace_file`
+            slow_ms: Traces slower than this many milliseconds are kept
+            keep: Number of slow traces kept
+            max_bytes: Size at which `trace_file` is rotated
+            backups: Number of rotated files kept
+
+        """
+        self.enabled = True
+        self.trace_file = trace_file
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.slow = deque(maxlen=keep)
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    @property
+    def current(self) -> Optional[Trace]:
+        return self._current.get()
+
+    def start(self, name: str, **args) -> Optional[Token]:
+        """Start a trace for a request in the current context.
+
+        Returns:
+            A token for :meth:`finish` or `None` if tracing is disabled.
+
+        """
+        if not self.enabled:
+            return None
+        return self._current.set(Trace(name, args))
+
+    def finish(self, token: Optional[Token]) -> Optional[Trace]:
+        """Finish the trace started with `token` and export it if it's sampled
+        or slow."""
+        if token is None:
+            return None
+        trace = self._current.get()
+        self._current.reset(token)
+        if trace is None:
+            return None
+        trace.duration = time.time() - trace.start
+        slow = trace.duration * 1000 >= self.slow_ms
+        sampled = random.random() < self.sample_rate
+        with self._lock:
+            self.counts["traces"] += 1
+            self.counts["sampled"] += sampled
+            self.counts["slow"] += slow
+            if slow:
+                self.slow.append(trace)
+        if self.trace_file and (sampled or slow):
+            try:
+                self._write(trace.events())
+            except OSError:
+                pass
+        return trace
+
+    @contextmanager
+    def request(self, name: str, **args) -> Iterator[Optional[Trace]]:
+        "Trace the enclosed block as a request."
+        token = self.start(name, **args)
+        try:
+            yield self.current if token else None
+        finally:
+            self.finish(token)
+
+    @contextmanager
+    def span(self, name: str, cat: str = "", **args) -> Iterator[Dict[str, Any]]:
+        """Record the enclosed block as span `name` of category `cat` in the
+        current trace, if any.
+
+        Yields a dictionary of arguments of the span which can be updated in
+        the block, e.g., with the size of a response.
+
+        """
+        trace = self._current.get()
+        if trace is None:
+            yield args
+            return
+        start = trace.now()
+        try:
+            yield args
+        finally:
+            trace.spans.append({"name": name, "cat": cat, "ph": "X", "ts": start,
+                                "dur": trace.now() - start,
+                                "tid": threading.get_ident(), "args": args})
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.trace_file}.{i}"):
+                os.replace(f"{self.trace_file}.{i}", f"{self.trace_file}.{i + 1}")
+        os.replace(self.trace_file, f"{self.trace_file}.1")
+
+    def _write(self, events: List[Dict[str, Any]]):
+        # The closing bracket of the JSON array is optional in the trace event
+        # format, so events can simply be appended.
+        data = "".join(json.dumps(e) + ",\n" for e in events)
+        with open(self.trace_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_ino != os.stat(self.trace_file).st_ino:
+                # Rotated by another worker while waiting for the lock
+                return self._write(events)
+            if f.tell() > self.max_bytes:
+                self._rotate()
+                return self._write(events)
+            if f.tell() == 0:
+                f.write("[\n")
+            f.write(data)
+
+    def slow_traces(self, n: int = 20) -> List[Trace]:
+        "The `n` slowest of the recent slow traces."
+        with self._lock:
+            traces = list(self.slow)
+        return sorted(traces, key=lambda x: x.duration, reverse=True)[:n]
+
+
+tracer = Tracer()
@@ -0,0 +1,172 @@
+from typing import Dict, List, Optional, Any, Tuple
+import os
+import json
+import time
+import tempfile
+from threading import Condition, Thread
+
+from .tracing import tracer
+
+
+class WriteBehind:
+    """Single writer of the Semantic Scholar cache.
+
+    :meth:`put` queues the data of a paper and its `metadata` line and
+    returns immediately, so a fetch doesn't wait for the disk. A writer
+    thread writes the queued papers in batches of up to `max_batch`, waiting
+    up to `max_delay` seconds for a batch to fill. For each batch the paper
+    files are written and renamed into place, and then all the `metadata`
+    lines are appended with one write, so that other processes never see a
+    `metadata` entry without its file. With `fsync`, the files of a batch are
+    synced together before they're renamed, and `metadata` and the directory
+    once per batch (group commit) instead of once per paper.
+
+    Until it's written, a paper is served from memory by :meth:`get`.
+    :meth:`flush` waits until everything queued so far is on disk.
+
+    The thread is started on first use so that it runs in the worker
+    processes of :class:`~ref_man.prefork.PreforkServer`.
+
+    Args:
+        max_batch: Maximum papers written in one batch
+        max_delay: Seconds to wait for more papers before writing a batch
+        fsync: Sync the writes to disk
+
+    """
+    def __init__(self, max_batch: int = 64, max_delay: float = 0.05, fsync: bool = True):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = Condition()
+        # Pending papers by data_dir and paperId, in the order they were put
+        self._pending: Dict[Tuple[str, str], Tuple[Dict[str, Any], str, Optional[bytes]]] = {}
+        self._queued = 0
+        self._written = 0
+        self._errors = 0
+        self._batches = 0
+        self._thread: Optional[Thread] = None
+
+    def configure(self, max_batch: int = 64, max_delay: float = 0.05, fsync: bool = True):
+        "Set the batch size, the delay and whether writes are synced."
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.fsync = fsync
+
+    def put(self, data_dir: str, data: Dict[str, Any], metadata_line: str,
+            content: Optional[bytes] = None):
+        """Queue the `data` of a paper and its `metadata_line` to be written to `data_dir`.
+
+        If given, `content` is written as it is instead of encoding `data`
+        again, e.g., the body of the response `data` was parsed from.
+
+        """
+        with self._cond:
+            if self._thread is None:
+                self._thread = Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            key = (data_dir, data["paperId"])
+            # A paper fetched again is written once with the latest data
+            self._pending.pop(key, None)
+            self._pending[key] = (data, metadata_line, content)
+            self._queued += 1
+            self._cond.notify_all()
+
+    def get(self, data_dir: str, paper_id: str) -> Optional[Dict[str, Any]]:
+        "The data of `paper_id` if it's yet to be written."
+        with self._cond:
+            item = self._pending.get((data_dir, paper_id))
+        return item[0] if item else None
+
+    def pending(self, data_dir: str) -> List[str]:
+        "The `metadata` lines of the papers for `data_dir` yet to be written."
+        with self._cond:
+            return [item[1] for (d, _), item in self._pending.items() if d == data_dir]
+
+    def _take(self) -> List[Tuple[Tuple[str, str], Tuple[Dict[str, Any], str, Optional[bytes]]]]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [*self._pending.items()][:self.max_batch]
+
+    def _loop(self):
+        while True:
+            batch = self._take()
+            by_dir: Dict[str, List[Tuple[Dict[str, Any], str, Optional[bytes]]]] = {}
+            for (data_dir, _), item in batch:
+                by_dir.setdefault(data_dir, []).append(item)
+            written = errors = 0
+            for data_dir, items in by_dir.items():
+                try:
+                    self._write(data_dir, items)
+                    written += len(items)
+                except Exception as e:
+                    print(f"Error {e} writing {len(items)} papers to {data_dir}")
+                    errors += len(items)
+            with self._cond:
+                for key, item in batch:
+                    # Keep it if it was put again while being written
+                    if self._pending.get(key) is item:
+                        self._pending.pop(key)
+                self._written += written
+                self._errors += errors
+                self._batches += 1
+                self._cond.notify_all()
+
+    def _write(self, data_dir: str, items: List[Tuple[Dict[str, Any], str, Optional[bytes]]]):
+        # Imported here as semantic_scholar imports this module
+        from .semantic_scholar import append_metadata
+        with tracer.span("cache_write", "ss", papers=len(items)):
+            temp_files = []
+            for data, _, content in items:
+                with tempfile.NamedTemporaryFile("wb", dir=data_dir, suffix=".tmp",
+                                                 delete=False) as f:
+                    # json.dump encodes in pure Python which is much slower
+                    f.write(content or json.dumps(data).encode())
+                temp_files.append((f.name, data["paperId"]))
+            # Synced after all are written so that the journal commits of the
+            # batch can be merged
+            if self.fsync:
+                for name, _ in temp_files:
+                    fd = os.open(name, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            for name, paper_id in temp_files:
+                os.replace(name, os.path.join(data_dir, paper_id))
+            append_metadata(data_dir, [x[1] for x in items], self.fsync)
+            if self.fsync:
+                fd = os.open(data_dir, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all the papers queued so far are written.
+
+        Returns:
+            False if they weren't written within `timeout`.
+
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"pending": len(self._pending), "queued": self._queued,
+                    "written": self._written, "batches": self._batches,
+                    "errors": self._errors}
+
+
+cache_writer = WriteBehind()
@@ -0,0 +1,63 @@
+import io
+
+from ref_man.atom import iter_entries, parse_feed
+
+
+FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:arxiv="http://arxiv.org/schemas/atom">
+  <title>ArXiv Query</title>
+  <entry>
+    <id>http://arxiv.org/abs/1706.03762v5</id>
+    <updated>2017-12-06T03:30:32Z</updated>
+    <published>2017-06-12T17:57:34Z</published>
+    <title>Attention Is All
+      You Need</title>
+    <summary>  The dominant sequence transduction models.  </summary>
+    <author><name>Ashish Vaswani</name></author>
+    <author><name>Noam Shazeer</name></author>
+    <arxiv:doi>10.1000/xyz</arxiv:doi>
+    <arxiv:comment>15 pages</arxiv:comment>
+    <link title="pdf" href="http://arxiv.org/pdf/1706.03762v5" rel="related"/>
+    <arxiv:primary_category term="cs.CL"/>
+    <category term="cs.CL"/><category term="cs.LG"/>
+  </entry>
+  <entry>
+    <id>http://arxiv.org/abs/hep-th/9901001</id>
+    <published>1999-01-01T00:00:00Z</published>
+    <title>Old Style</title>
+  </entry>
+  <entry>
+    <id>http://arxiv.org/api/errors#incorrect_id_format_for_bad</id>
+    <summary>incorrect id format for bad</summary>
+  </entry>
+</feed>"""
+
+
+def test_parse_entry_fields():
+    entry = parse_feed(FEED)["1706.03762"]
+    assert entry["version"] == 5
+    assert entry["title"] == "Attention Is All You Need"
+    assert entry["abstract"] == "The dominant sequence transduction models."
+    assert entry["authors"] == ["Ashish Vaswani", "Noam Shazeer"]
+    assert entry["year"] == "2017"
+    assert entry["categories"] == ["cs.CL", "cs.LG"]
+    assert entry["primary_category"] == "cs.CL"
+    assert entry["doi"] == "10.1000/xyz"
+    assert entry["comment"] == "15 pages"
+    assert entry["journal_ref"] == ""
+    assert entry["url"] == "https://arxiv.org/abs/1706.03762"
+    assert entry["pdf_url"] == "http://arxiv.org/pdf/1706.03762v5"
+
+
+def test_old_style_ids_and_errors():
+    entries = list(iter_entries(FEED))
+    assert entries[1]["id"] == "hep-th/9901001" and entries[1]["version"] is None
+    assert entries[2] == {"error": "incorrect id format for bad"}
+    assert set(parse_feed(FEED)) == {"1706.03762", "hep-th/9901001"}
+
+
+def test_sources_and_chunks():
+    expected = list(iter_entries(FEED))
+    assert list(iter_entries(FEED, chunk_size=7)) == expected
+    assert list(iter_entries(io.BytesIO(FEED), chunk_size=13)) == expected
+    assert list(iter_entries(FEED[i:i + 5] for i in range(0, len(FEED), 5))) == expected
@@ -0,0 +1,138 @@
+import json
+import logging
+import time
+from threading import Lock
+
+import flask
+import pytest
+
+from ref_man import batch
+from ref_man.batch import (RetryPolicy, collect, iter_batch, post_json_wrapper,
+                           set_failed_headers)
+
+
+logger = logging.getLogger("test")
+
+
+class FakeSource:
+    """Fetch function whose ids fail `failures[id]` times, -1 for always.
+
+    Queries can be comma separated ids with a result for each.
+
+    """
+    def __init__(self, failures={}, latency=0.0):
+        self.failures = dict(failures)
+        self.latency = latency
+        self.fetched = []
+        self._lock = Lock()
+
+    def __call__(self, query, q, **kwargs):
+        with self._lock:
+            self.fetched.append(query)
+        time.sleep(self.latency)
+        for x in query.split(","):
+            with self._lock:
+                fail = self.failures.get(x, 0)
+                if fail > 0:
+                    self.failures[x] -= 1
+            q.put((x, ["ERROR, upstream"] if fail else {"id": x}))
+
+
+def test_attempt_cap():
+    source = FakeSource({"a": -1, "b": 1})
+    failed = []
+    results = dict(iter_batch(["a", "b", "c"], source, collect, 3,
+                              retry=RetryPolicy(3, 0.01), failed=failed))
+    assert source.fetched.count("a") == 3
+    assert source.fetched.count("b") == 2
+    assert source.fetched.count("c") == 1
+    assert results["a"] == ["ERROR, upstream"]
+    assert results["b"] == {"id": "b"} and results["c"] == {"id": "c"}
+    assert failed == ["a"]
+
+
+def test_single_attempt():
+    source = FakeSource({"a": 1})
+    failed = []
+    results = dict(iter_batch(["a"], source, collect, 1, retry=RetryPolicy(1), failed=failed))
+    assert source.fetched == ["a"] and failed == ["a"]
+    assert results["a"] == ["ERROR, upstream"]
+
+
+def test_backoff_does_not_block_fresh_queries():
+    source = FakeSource({"a": 1}, latency=0.05)
+    fresh = [f"q{i}" for i in range(10)]
+    retry = RetryPolicy(3)
+    retry.delay = lambda attempt: 0.2
+    start = time.monotonic()
+    order = []
+    for query, result in iter_batch(["a", *fresh], source, collect, 1, retry=retry):
+        order.append((query, time.monotonic() - start))
+    # Fresh queries are fetched while "a" waits, and "a" goes ahead of the
+    # rest once its backoff is over
+    index = source.fetched.index("a", 1)
+    assert 2 < index < len(fresh)
+    assert source.fetched[1:index] == fresh[:index - 1]
+    assert dict(order)["q0"] < 0.2
+    assert [q for q, _ in order].count("a") == 1
+
+
+def test_comma_separated_ids_retried_alone():
+    source = FakeSource({"2": 1})
+    failed = []
+    results = dict(iter_batch(["1,2,3"], source, collect, 1,
+                              retry=RetryPolicy(3, 0.01), failed=failed))
+    assert source.fetched == ["1,2,3", "2"]
+    assert results == {x: {"id": x} for x in ["1", "2", "3"]}
+    assert failed == []
+
+
+def test_comma_separated_ids_failed():
+    source = FakeSource({"2": -1})
+    failed = []
+    results = dict(iter_batch(["1,2,3", "4"], source, collect, 2,
+                              retry=RetryPolicy(3, 0.01), failed=failed))
+    assert source.fetched.count("2") == 2 and len(source.fetched) == 4
+    assert results["2"] == ["ERROR, upstream"]
+    assert failed == ["2"]
+
+
+def test_failed_headers():
+    response = flask.Response()
+    set_failed_headers(response, [])
+    assert response.headers["X-Failed-Count"] == "0"
+    assert "X-Failed-Queries" not in response.headers
+    set_failed_headers(response, ["a", "b"])
+    assert response.headers["X-Failed-Count"] == "2"
+    assert json.loads(response.headers["X-Failed-Queries"]) == ["a", "b"]
+    response = flask.Response()
+    set_failed_headers(response, ["x" * 100] * 100, max_size=1000)
+    assert response.headers["X-Failed-Count"] == "100"
+    assert "X-Failed-Queries" not in response.headers
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(batch.retry_policy, "delay", lambda attempt: 0.01)
+    return flask.Flask("test")
+
+
+def test_post_json_wrapper(app):
+    source = FakeSource({"a": -1})
+    with app.test_request_context("/dblp", method="POST", json=["a", "b"]):
+        response = post_json_wrapper(flask.request, source, collect, 2, "test", logger)
+    assert json.loads(response.get_data()) == {"a": ["ERROR, upstream"], "b": {"id": "b"}}
+    assert response.headers["X-Failed-Count"] == "1"
+    assert json.loads(response.headers["X-Failed-Queries"]) == ["a"]
+    assert source.fetched.count("a") == batch.retry_policy.max_attempts
+
+
+def test_post_json_wrapper_stream(app):
+    source = FakeSource({"a": -1})
+    with app.test_request_context("/dblp?stream", method="POST", json=["a", "b"]):
+        response = post_json_wrapper(flask.request, source, collect, 2, "test", logger)
+        records = [json.loads(x) for x in response.response]
+    assert response.mimetype == "application/x-ndjson"
+    assert {r["query"]: r["result"] for r in records[:-1]} ==\
+        {"a": ["ERROR, upstream"], "b": {"id": "b"}}
+    assert records[-1] == {"done": True, "count": 2, "failed": ["a"]}
@@ -0,0 +1,82 @@
+import re
+
+from ref_man.arxiv import dict_to_bibtex
+from ref_man.bibtex import BibtexRenderer, make_key, first_word_key, split_name, _suffix
+
+
+def _keys(bibs):
+    return [re.match(r"@\w+\{([^,]+),", b).group(1) if b else None for b in bibs]
+
+
+def _dblp(key, title, authors=["John Smith"], year="2020"):
+    return ("dblp", {"key": key, "title": title, "authors": authors, "year": year,
+                     "type": "Conference and Workshop Papers", "venue": "NeurIPS"})
+
+
+def test_make_key():
+    assert make_key(["Jürgen Schmidhuber"], "1997", "The Long Short-Term Memory") ==\
+        "schmidhuber1997long"
+    assert make_key([], "", "On a Thing") == "anonthing"
+    assert split_name("John Smith 0001") == ("Smith", "John")
+    assert split_name("Smith, John") == ("Smith", "John")
+
+
+def test_suffix():
+    assert [_suffix(i) for i in [0, 1, 25, 26, 27]] == ["a", "b", "z", "aa", "ab"]
+
+
+def test_render_many_unique_keys():
+    renderer = BibtexRenderer()
+    bibs = renderer.render_many([_dblp("a", "Deep Nets"), _dblp("b", "Deep Learning"),
+                                 _dblp("c", "Other Paper"), _dblp("d", "Deep Things")])
+    assert _keys(bibs) == ["smith2020deepa", "smith2020deepb", "smith2020other",
+                           "smith2020deepc"]
+
+
+def test_render_many_skips_taken_suffixes():
+    renderer = BibtexRenderer()
+    # "Deepa" gives the base key smith2020deepa which a suffixed key mustn't reuse
+    bibs = renderer.render_many([_dblp("a", "Deep Nets"), _dblp("b", "Deepa"),
+                                 _dblp("c", "Deep Learning")])
+    keys = _keys(bibs)
+    assert keys[1] == "smith2020deepa"
+    assert len(set(keys)) == 3
+    assert keys[0].startswith("smith2020deep") and keys[2].startswith("smith2020deep")
+
+
+def test_render_unconvertible_and_memo():
+    renderer = BibtexRenderer()
+    assert renderer.render_many([("dict", {"title": "No authors"}), _dblp("a", "Deep")])[0]\
+        is None
+    renderer.render(*_dblp("a", "Deep"))
+    assert renderer.hits == 1 and renderer.misses == 1
+    # Keys are unique only within a batch
+    assert _keys([renderer.render(*_dblp("x", "Deep"))]) == ["smith2020deep"]
+
+
+def test_memo_rerenders_changed_record():
+    renderer = BibtexRenderer()
+    record = {"paperId": "p1", "title": "Deep Nets", "authors": [{"name": "John Smith"}],
+              "year": 2020, "venue": ""}
+    assert "title={Deep Nets}" in renderer.render("ss", record)
+    renderer.render("ss", {**record})
+    assert renderer.hits == 1
+    # A refetched record with the same paperId
+    bib = renderer.render("ss", {**record, "title": "Deeper Nets", "venue": "ICML"})
+    assert "title={Deeper Nets}" in bib and "journal={ICML}" in bib
+    assert renderer.hits == 1 and renderer.misses == 2
+    assert len(renderer._memo) == 1
+    # Fields which aren't rendered don't matter
+    renderer.render("ss", {**record, "title": "Deeper Nets", "venue": "ICML",
+                           "citations": [1, 2]})
+    assert renderer.hits == 2
+
+
+def test_dict_to_bibtex_keeps_first_word_keys():
+    bib = dict_to_bibtex({"type": "misc", "title": "On the Origin of Species",
+                          "authors": ["Charles Darwin"], "year": "1859"})
+    assert _keys([bib]) == ["darwin1859on"]
+    bib = dict_to_bibtex({"type": "misc", "title": "Adam: A Method",
+                          "author": "Diederik Kingma and Jimmy Ba", "year": "2014"})
+    assert _keys([bib]) == ["kingma2014adam:"]
+    assert first_word_key(["John Smith"], "2020", "The Paper") == "smith2020the"
@@ -0,0 +1,142 @@
+import time
+import socket
+
+import pytest
+import requests
+
+from ref_man.concurrency import AdaptiveLimit, UpstreamLimits
+
+
+def _fill(limit):
+    "Acquire all the slots of `limit`."
+    n = int(limit.limit)
+    for _ in range(n):
+        assert limit.acquire(timeout=0)
+    return n
+
+
+def test_acquire_within_limit():
+    limit = AdaptiveLimit("host", initial=2)
+    _fill(limit)
+    assert limit.in_flight == 2
+    assert not limit.acquire(timeout=0.01)
+    limit.release(0.01, 200)
+    assert limit.acquire(timeout=0)
+
+
+def test_additive_increase_only_when_in_use():
+    limit = AdaptiveLimit("host", initial=4, max_limit=5)
+    # A single request at a time doesn't use the limit
+    for _ in range(10):
+        limit.acquire()
+        limit.release(0.01, 200)
+    assert limit.limit == 4
+    for _ in range(3):
+        n = _fill(limit)
+        for _ in range(n):
+            limit.release(0.01, 200)
+    assert 4 < limit.limit <= 5
+    for _ in range(20):
+        n = _fill(limit)
+        for _ in range(n):
+            limit.release(0.01, 200)
+    assert limit.limit == 5
+
+
+def test_multiplicative_decrease_once_per_burst():
+    limit = AdaptiveLimit("host", initial=16, backoff=0.5)
+    _fill(limit)
+    for status in [503, 500, None, 429]:
+        limit.release(0.01, status)
+    assert limit.limit == 8
+    assert limit.counts["errors"] == 3 and limit.counts["throttled"] == 1
+    for _ in range(12):
+        limit.release(0.01, 200)
+    time.sleep(0.11)
+    before = limit.limit
+    limit.acquire()
+    limit.release(0.01, 500)
+    assert limit.limit == before * 0.5
+
+
+def test_min_limit():
+    limit = AdaptiveLimit("host", initial=2, min_limit=1, backoff=0.1)
+    limit.acquire()
+    limit.release(0.01, 500)
+    assert limit.limit == 1
+
+
+def test_latency_backoff():
+    limit = AdaptiveLimit("host", initial=10, latency_factor=2.0)
+    for _ in range(25):
+        limit.acquire()
+        limit.release(0.01, 200)
+    for _ in range(10):
+        limit.acquire()
+        limit.release(0.2, 200)
+    assert limit.counts["latency_backoffs"] > 0
+    assert limit.limit < 10
+
+
+def test_pause():
+    limit = AdaptiveLimit("host")
+    limit.pause(0.2)
+    start = time.monotonic()
+    limit.acquire()
+    assert time.monotonic() - start >= 0.15
+    assert limit.counts["paused"] == 1
+
+
+def test_rate():
+    limit = AdaptiveLimit("host", rate=20, burst=1)
+    start = time.monotonic()
+    for _ in range(5):
+        limit.acquire()
+        limit.release(0.001, 200)
+    # The first token is in the bucket
+    assert time.monotonic() - start >= 0.18
+
+
+def _raise(exception):
+    def method(url, **kwargs):
+        raise exception
+    return method
+
+
+def test_proxy_failure_leaves_limit():
+    limits = UpstreamLimits()
+    url = "https://dblp.org/search/publ/api?q=x"
+    limit = limits.limit_for(url)
+    before = limit.limit
+    proxies = {"https": "http://127.0.0.1:9"}
+    for exception in [requests.exceptions.ProxyError, requests.exceptions.ConnectTimeout]:
+        with pytest.raises(exception):
+            limits.request(_raise(exception()), url, proxies=proxies)
+    assert limit.limit == before
+    assert limit.in_flight == 0
+    assert limit.counts["errors"] == 0
+
+
+def test_proxy_failure_real_proxy():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    limits = UpstreamLimits()
+    url = "http://127.0.0.1:9/x"
+    limit = limits.limit_for(url)
+    before = limit.limit
+    with pytest.raises(requests.exceptions.ProxyError):
+        limits.get(url, proxies={"http": f"http://127.0.0.1:{port}"}, timeout=(1, None))
+    assert limit.limit == before
+    assert limit.in_flight == 0
+
+
+def test_connect_timeout_without_proxy_decreases_limit():
+    limits = UpstreamLimits()
+    url = "https://dblp.org/search/publ/api?q=x"
+    limit = limits.limit_for(url)
+    before = limit.limit
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        limits.request(_raise(requests.exceptions.ConnectTimeout()), url)
+    assert limit.limit == before * limit.backoff
+    assert limit.counts["errors"] == 1
@@ -0,0 +1,103 @@
+import json
+import time
+
+from ref_man.events import EventBus, format_event
+
+
+def _bus(tmp_path, **kwargs):
+    bus = EventBus()
+    bus.configure(str(tmp_path / "events"), **kwargs)
+    return bus
+
+
+def _get(sub, timeout=2):
+    event_id, topic, line = sub.queue.get(timeout=timeout)
+    return event_id, topic, json.loads(line)["data"]
+
+
+def test_publish_subscribe(tmp_path):
+    bus = _bus(tmp_path)
+    sub = bus.subscribe({"job"})
+    bus.publish("cache", {"state": "updating"})
+    bus.publish("job", {"id": "a"})
+    event_id, topic, data = _get(sub)
+    assert topic == "job" and data == {"id": "a"}
+    assert sub.queue.empty()
+    bus.stop()
+
+
+def test_replay_from_last_event_id(tmp_path):
+    bus = _bus(tmp_path)
+    first = bus.subscribe()
+    for i in range(5):
+        bus.publish("job", {"i": i})
+    ids = [_get(first)[0] for _ in range(5)]
+    # A client which got the first two reconnects
+    sub = bus.subscribe(set(), ids[1])
+    assert [_get(sub) for _ in range(3)] ==\
+        [(ids[i], "job", {"i": i}) for i in range(2, 5)]
+    bus.publish("job", {"i": 5})
+    last_id, _, data = _get(sub)
+    assert data == {"i": 5}
+    # Nothing is replayed for the latest id, ids of another file or garbage
+    for last_id in [last_id, "1:0", "garbage"]:
+        assert bus.subscribe(set(), last_id).queue.empty()
+    bus.stop()
+
+
+def test_replay_filters_topics(tmp_path):
+    bus = _bus(tmp_path)
+    first = bus.subscribe()
+    bus.publish("job", {"i": 0})
+    bus.publish("download", {"i": 1})
+    bus.publish("job", {"i": 2})
+    start = _get(first)[0]
+    sub = bus.subscribe({"job"}, start)
+    assert _get(sub)[2] == {"i": 2}
+    time.sleep(0.2)
+    assert sub.queue.empty()
+    bus.stop()
+
+
+def test_events_of_other_processes(tmp_path):
+    bus = _bus(tmp_path, poll_interval=0.05)
+    sub = bus.subscribe()
+    # Another worker appends to the same file
+    other = _bus(tmp_path)
+    other.publish("cache", {"state": "finished"})
+    assert _get(sub)[1:] == ("cache", {"state": "finished"})
+    bus.stop()
+
+
+def test_rotation(tmp_path):
+    bus = _bus(tmp_path, max_size=500)
+    sub = bus.subscribe()
+    for i in range(20):
+        bus.publish("job", {"i": i})
+        time.sleep(0.01)
+    assert [_get(sub)[2]["i"] for _ in range(20)] == list(range(20))
+    assert (tmp_path / "events.1").exists()
+    bus.stop()
+
+
+def test_stream(tmp_path):
+    bus = _bus(tmp_path, keepalive=0.05)
+    sub = bus.subscribe()
+    stream = bus.stream(sub, [("cache", {"state": "idle"})])
+    assert next(stream) == "retry: 2000\n\n"
+    assert next(stream).startswith("event: cache\ndata: ")
+    assert next(stream) == ": keepalive\n\n"
+    bus.publish("job", {"i": 0})
+    event = next(stream)
+    assert event.startswith("id: ") and "\nevent: job\n" in event
+    bus.stop()
+    assert list(stream) == []
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_in_memory():
+    bus = EventBus()
+    sub = bus.subscribe({"job"})
+    bus.publish("job", {"i": 0})
+    assert _get(sub) == ("1", "job", {"i": 0})
+    assert format_event("job", "{}") == "event: job\ndata: {}\n\n"
@@ -0,0 +1,52 @@
+import os
+
+from ref_man.eviction import compact_metadata
+from ref_man.id_index import IdIndex
+from ref_man.semantic_scholar import SSCache
+
+
+def _pid(i):
+    return f"{i:040x}"
+
+
+def test_compact_metadata(tmp_path):
+    data_dir = str(tmp_path)
+    metadata = os.path.join(data_dir, "metadata")
+    with open(metadata, "w") as f:
+        f.write("".join(f",,{i},10.1/{i},{_pid(i)}\n" for i in range(10)))
+    cache = SSCache(data_dir)
+    cache.load()
+    assert cache["doi"].get("10.1/3") == _pid(3)
+    inode = os.stat(metadata).st_ino
+
+    assert compact_metadata(data_dir, {_pid(3), _pid(7), _pid(100)}) == 2
+    with open(metadata) as f:
+        lines = f.read().splitlines()
+    assert [line.split(",")[-1] for line in lines] ==\
+        [_pid(i) for i in range(10) if i not in {3, 7}]
+    assert os.stat(metadata).st_ino != inode
+    assert not [f for f in os.listdir(data_dir) if f.endswith(".tmp") or f.endswith(".tmp.idx")]
+
+    index = IdIndex(metadata + ".idx")
+    try:
+        assert index.metadata_inode == os.stat(metadata).st_ino
+        assert index.metadata_offset == os.path.getsize(metadata)
+        assert index.get("doi", "10.1/3") is None
+        assert index.get("doi", "10.1/4") == _pid(4)
+    finally:
+        index.close()
+
+    # Servers pick up the new file on refresh
+    cache.refresh()
+    assert cache["doi"].get("10.1/3") is None
+    assert cache["corpus"].get("9") == _pid(9)
+
+
+def test_compact_metadata_nothing_removed(tmp_path):
+    data_dir = str(tmp_path)
+    metadata = os.path.join(data_dir, "metadata")
+    with open(metadata, "w") as f:
+        f.write(f",,1,,{_pid(1)}\n")
+    assert compact_metadata(data_dir, set()) == 0
+    with open(metadata) as f:
+        assert f.read() == f",,1,,{_pid(1)}\n"
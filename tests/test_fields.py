@@ -0,0 +1,28 @@
+from ref_man.semantic_scholar import parse_fields, project_fields
+
+
+def test_parse_fields_nested():
+    assert parse_fields("title, year,citations.title,citations.authors.name") ==\
+        {"title": None, "year": None,
+         "citations": {"title": None, "authors": {"name": None}}}
+
+
+def test_parse_fields_whole_value_wins():
+    assert parse_fields("citations,citations.title") == {"citations": None}
+    assert parse_fields("citations.title,citations") == {"citations": None}
+    assert parse_fields(",,") == {}
+
+
+def test_project_fields():
+    data = {"title": "T", "year": 2020, "abstract": "A",
+            "citations": [{"title": "C1", "year": 2021, "authors": [{"name": "X", "id": 1}]},
+                          {"title": "C2", "year": 2022, "authors": []}]}
+    spec = parse_fields("title,citations.title,citations.authors.name,missing")
+    assert project_fields(data, spec) ==\
+        {"title": "T", "citations": [{"title": "C1", "authors": [{"name": "X"}]},
+                                     {"title": "C2", "authors": []}]}
+
+
+def test_project_fields_leaves_other_values():
+    assert project_fields(None, {"title": None}) is None
+    assert project_fields("ERROR", {"title": None}) == "ERROR"
@@ -0,0 +1,61 @@
+import os
+
+from ref_man.id_index import IdIndex, open_or_build
+
+
+def _pid(i):
+    return f"{i:040x}"
+
+
+def _write(path, lines):
+    with open(path, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_build_and_lookup(tmp_path):
+    metadata = str(tmp_path / "metadata")
+    lines = [f"acl{i},{1000 + i}.0001,{i},10.1/{i},{_pid(i)}" for i in range(1000)]
+    # A later line for the same DOI overrides the earlier one
+    lines.append(f",,,10.1/5,{_pid(5000)}")
+    lines.append(",2001.00001,,,NOT_A_PAPER_ID")
+    _write(metadata, lines)
+    with open(metadata, "a") as f:
+        f.write(",,,10.1/partial")
+    IdIndex.build(metadata, metadata + ".idx")
+    index = IdIndex(metadata + ".idx")
+    try:
+        assert index.num_papers == 1001
+        assert index.counts == {"acl": 1000, "arxiv": 1000, "corpus": 1000, "doi": 1000}
+        for i in [0, 1, 499, 999]:
+            assert index.get("acl", f"acl{i}") == _pid(i)
+            assert index.get("arxiv", f"{1000 + i}.0001") == _pid(i)
+            assert index.get("corpus", str(i)) == _pid(i)
+        assert index.get("doi", "10.1/5") == _pid(5000)
+        assert index.get("doi", "10.1/missing") is None
+        assert index.unindexed == [["", "2001.00001", "", "", "NOT_A_PAPER_ID"]]
+        # The partial last line isn't consumed
+        assert index.metadata_offset == os.path.getsize(metadata) - len(",,,10.1/partial")
+    finally:
+        index.close()
+
+
+def test_open_or_build_rebuilds(tmp_path):
+    metadata = str(tmp_path / "metadata")
+    path = metadata + ".idx"
+    assert open_or_build(metadata, path) is None
+    _write(metadata, [f",,1,,{_pid(1)}"])
+    index = open_or_build(metadata, path)
+    assert index.get("corpus", "1") == _pid(1)
+    index.close()
+    # Small appends are read from metadata, not indexed again
+    with open(metadata, "a") as f:
+        f.write(f",,2,,{_pid(2)}\n")
+    index = open_or_build(metadata, path)
+    assert index.get("corpus", "2") is None
+    index.close()
+    # A replaced metadata file is indexed again
+    _write(metadata + ".new", [f",,3,,{_pid(3)}"])
+    os.replace(metadata + ".new", metadata)
+    index = open_or_build(metadata, path)
+    assert index.get("corpus", "3") == _pid(3) and index.get("corpus", "1") is None
+    index.close()
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import logging
+
+import pytest
+
+from ref_man import batch
+from ref_man.batch import collect
+from ref_man.jobs import JobManager
+
+
+logger = logging.getLogger("test")
+
+
+def fetch_ok(query, q, **kwargs):
+    q.put((query, {"title": query}))
+
+
+def fetch_error(query, q, **kwargs):
+    q.put((query, ["ERROR, upstream"]))
+
+
+def fetch_slow(query, q, **kwargs):
+    time.sleep(5)
+    q.put((query, {"title": query}))
+
+
+def wait(manager, job_id, timeout=5):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        state = manager.status(job_id)
+        if state["status"] != "running":
+            return state
+        time.sleep(0.02)
+    raise TimeoutError(job_id)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return JobManager(str(tmp_path), logger, save_interval=0)
+
+
+def test_results_in_ndjson(manager, tmp_path):
+    queries = [f"q{i}" for i in range(20)]
+    job_id = manager.submit("test", queries, fetch_ok, collect, 4)["id"]
+    assert wait(manager, job_id)["status"] == "finished"
+    with open(tmp_path / f"{job_id}.json") as f:
+        state = json.load(f)
+    assert "results" not in state
+    assert state["done"] == 20
+    with open(tmp_path / f"{job_id}.ndjson") as f:
+        lines = [json.loads(x) for x in f]
+    assert sorted(x[0] for x in lines) == sorted(queries)
+    # Another worker reads the results from the files
+    other = JobManager(str(tmp_path), logger)
+    status = other.status(job_id, offset=5)
+    assert status["done"] == 20 and status["offset"] == 5
+    assert [*status["results"]] == [x[0] for x in lines[5:]]
+    assert [x["id"] for x in other.list()] == [job_id]
+    assert "results" not in other.list()[0]
+
+
+def test_partly_written_results_ignored(manager, tmp_path):
+    job_id = manager.submit("test", ["a", "b"], fetch_ok, collect, 2)["id"]
+    wait(manager, job_id)
+    with open(tmp_path / f"{job_id}.ndjson", "a") as f:
+        f.write('["c", {"ti')
+    other = JobManager(str(tmp_path), logger)
+    assert sorted(other.status(job_id, offset=0)["results"]) == ["a", "b"]
+
+
+def test_expired_jobs_removed(tmp_path):
+    manager = JobManager(str(tmp_path), logger, retention=0)
+    job_id = manager.submit("test", ["a"], fetch_ok, collect, 1)["id"]
+    wait(manager, job_id)
+    time.sleep(0.01)
+    assert manager.list() == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_cancel_during_backoff(manager, monkeypatch):
+    monkeypatch.setattr(batch.retry_policy, "delay", lambda attempt: 30)
+    job_id = manager.submit("test", ["a", "b"], fetch_error, collect, 2)["id"]
+    time.sleep(0.2)
+    start = time.monotonic()
+    manager.cancel(job_id)
+    state = wait(manager, job_id)
+    assert state["status"] == "cancelled"
+    assert time.monotonic() - start < 2
+
+
+def test_cancel_from_other_worker(manager, tmp_path):
+    job_id = manager.submit("test", ["a", "b"], fetch_slow, collect, 2)["id"]
+    time.sleep(0.1)
+    start = time.monotonic()
+    JobManager(str(tmp_path), logger).cancel(job_id)
+    assert os.path.exists(tmp_path / f"{job_id}.cancel")
+    state = wait(manager, job_id)
+    assert state["status"] == "cancelled"
+    assert time.monotonic() - start < 2
@@ -0,0 +1,71 @@
+import logging
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ref_man import proxy
+from ref_man.proxy import CircuitBreaker, ProxyMonitor
+
+
+class _Proxy(BaseHTTPRequestHandler):
+    status = 200
+
+    def do_GET(self):
+        self.send_response(self.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    monkeypatch.setattr(proxy, "proxy_check_url", "http://check.invalid/")
+    handler = type("Handler", (_Proxy,), {})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    monitor = ProxyMonitor(logging.getLogger("test"))
+    monitor.add("proxy", httpd.server_address[1])
+    yield monitor, handler
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.open
+    breaker.record_success()
+    breaker.record_failure(trip=True)
+    assert breaker.state == CircuitBreaker.open
+
+
+def test_probe_ok(monitor):
+    monitor, handler = monitor
+    assert monitor.proxies("proxy") is None
+    assert "seems to work" in monitor.probe("proxy")
+    assert monitor.proxies("proxy")["http"].startswith("http://127.0.0.1:")
+
+
+@pytest.mark.parametrize("status", [403, 502])
+def test_probe_wrong_status_opens_breaker(monitor, status):
+    monitor, handler = monitor
+    monitor.probe("proxy")
+    assert monitor.proxies("proxy") is not None
+    handler.status = status
+    msg = monitor.probe("proxy")
+    assert f"wrong status_code {status}. Breaker is open" in msg
+    assert monitor.proxies("proxy") is None
+    assert monitor.status()["proxy"]["state"] == CircuitBreaker.open
+
+
+def test_probe_unreachable(monitor):
+    monitor, handler = monitor
+    monitor.ports["proxy"] = 9
+    assert "not reachable" in monitor.probe("proxy")
+    assert monitor.proxies("proxy") is None
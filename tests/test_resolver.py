@@ -0,0 +1,44 @@
+import pytest
+
+from ref_man.resolver import parse_reference, title_confidence
+
+
+@pytest.mark.parametrize("ref,expected", [
+    # IEEE
+    ('A. Vaswani, N. Shazeer, and N. Parmar, "Attention is all you need," in '
+     'Advances in Neural Information Processing Systems, 2017, pp. 5998-6008.',
+     {"title": "Attention is all you need", "year": "2017", "arxiv": "", "doi": ""}),
+    # APA
+    ("He, K., Zhang, X., Ren, S., & Sun, J. (2016). Deep residual learning for image "
+     "recognition. In Proceedings of the IEEE CVPR (pp. 770-778).",
+     {"title": "Deep residual learning for image recognition", "year": "2016",
+      "arxiv": "", "doi": ""}),
+    # ACM with a DOI
+    ("Jacob Devlin, Ming-Wei Chang, Kenton Lee, and Kristina Toutanova. 2019. BERT: "
+     "Pre-training of deep bidirectional transformers for language understanding. In "
+     "Proceedings of NAACL. https://doi.org/10.18653/v1/N19-1423.",
+     {"title": "BERT: Pre-training of deep bidirectional transformers for language "
+      "understanding", "year": "2019", "arxiv": "", "doi": "10.18653/v1/N19-1423"}),
+    # Sentence heuristic with an arXiv id
+    ("Kingma, D. P. and Ba, J. Adam: A method for stochastic optimization. "
+     "arXiv:1412.6980v9, 2014.",
+     {"title": "Adam: A method for stochastic optimization", "year": "2014",
+      "arxiv": "1412.6980", "doi": ""}),
+])
+def test_parse_reference(ref, expected):
+    assert parse_reference(ref) == expected
+
+
+def test_parse_reference_old_style_arxiv_and_url():
+    parsed = parse_reference("Some Author. A title of a paper here. "
+                             "https://arxiv.org/abs/hep-th/9901001v2")
+    assert parsed["arxiv"] == "hep-th/9901001"
+    assert parsed["year"] == ""
+
+
+def test_title_confidence():
+    parsed = {"title": "Attention Is All You Need!", "year": "2017"}
+    assert title_confidence(parsed, "attention is all you need", 2017) == 1.0
+    assert title_confidence(parsed, "Attention is all you need", "2018") == 0.9
+    assert title_confidence(parsed, "Something else entirely", 2017) < 0.5
+    assert title_confidence({"title": "A title", "year": ""}, "A title", 1999) == 1.0
@@ -0,0 +1,71 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from ref_man.singleflight import SingleFlight
+
+
+def _call_many(flight, key, func, n):
+    "Call `func` through `flight` from `n` threads at once."
+    results = [None] * n
+
+    def call(i):
+        try:
+            results[i] = flight.do(key, func)
+        except Exception as e:
+            results[i] = e
+    threads = [Thread(target=call, args=[i]) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+def test_coalesced():
+    flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {"title": "x"}
+    threads, results = _call_many(flight, ("dblp", "x"), fetch, 8)
+    # Let all the callers join the call in flight
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [{"title": "x"}] * 8
+    assert flight.stats() == {"dblp": {"calls": 8, "upstream": 1, "coalesced": 7}}
+    # Finished calls aren't cached
+    assert flight.do(("dblp", "x"), lambda: "again") == "again"
+    assert flight.stats()["dblp"]["upstream"] == 2
+
+
+def test_different_keys():
+    flight = SingleFlight()
+    assert flight.do(("ss", "a"), lambda: 1) == 1
+    assert flight.do(("ss", "b"), lambda x: x, 2) == 2
+    assert flight.stats()["ss"] == {"calls": 2, "upstream": 2, "coalesced": 0}
+
+
+def test_error_propagated_to_waiters():
+    flight = SingleFlight()
+    release = Event()
+
+    def fetch():
+        release.wait(5)
+        raise ValueError("upstream down")
+    threads, results = _call_many(flight, ("ss", "x"), fetch, 4)
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+    assert all(isinstance(r, ValueError) and str(r) == "upstream down" for r in results)
+    assert flight.stats()["ss"]["upstream"] == 1
+    # The failed call isn't remembered
+    with pytest.raises(KeyError):
+        flight.do(("ss", "x"), {}.__getitem__, "k")
+    assert flight.do(("ss", "x"), lambda: "ok") == "ok"
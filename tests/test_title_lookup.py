@@ -0,0 +1,132 @@
+import time
+from threading import Event
+
+import pytest
+
+from ref_man import title_lookup
+from ref_man.scheduler import Scheduler
+from ref_man.title_lookup import TitleLookup, record_ids
+
+
+title = "Attention Is All You Need"
+dblp_record = {"title": "Attention is All you Need.", "key": "conf/nips/VaswaniSPUJGKP17",
+               "year": "2017", "authors": ["Ashish Vaswani"], "doi": "10.5555/3295222",
+               "ee": "https://arxiv.org/abs/1706.03762v5"}
+ss_record = {"title": "Attention is All you Need", "paperId": "204e3073", "year": 2017,
+             "authors": [{"name": "Ashish Vaswani"}], "venue": "NIPS", "doi": None}
+arxiv_record = {"title": "Attention Is All You Need", "id": "1706.03762", "year": "2017",
+                "authors": ["Ashish Vaswani"], "doi": "10.48550/arXiv.1706.03762"}
+other_record = {"title": "Something else entirely", "id": "2001.00001", "doi": "10.1/other"}
+
+
+def source(records, delay=0.0, error=None, calls=None, name=""):
+    def search(title):
+        if calls is not None:
+            calls.append(name)
+        time.sleep(delay)
+        if error:
+            raise ValueError(error)
+        return records
+    return search
+
+
+def test_record_ids():
+    assert record_ids("dblp", dblp_record) == {"dblp": "conf/nips/VaswaniSPUJGKP17",
+                                               "doi": "10.5555/3295222",
+                                               "arxiv": "1706.03762"}
+    assert record_ids("ss_search", ss_record) == {"ss": "204e3073"}
+    assert record_ids("arxiv", other_record) == {"arxiv": "2001.00001", "doi": "10.1/other"}
+
+
+def test_hedged_statuses_and_merged_ids():
+    lookup = TitleLookup({"dblp": source([dblp_record], 0.05),
+                          "ss_search": source([ss_record], 0.02),
+                          "arxiv": source([arxiv_record], 2),
+                          "other": source([], error="upstream down")},
+                         grace=0.1)
+    start = time.monotonic()
+    result = lookup.lookup(title, "2017")
+    assert time.monotonic() - start < 1
+    status = {k: v["status"] for k, v in result["status"].items()}
+    assert status == {"dblp": "ok", "ss_search": "ok", "arxiv": "late", "other": "error"}
+    assert result["status"]["other"]["error"] == "upstream down"
+    # Equally good matches, the preferred source first, and the ids of both
+    assert result["source"] == "dblp" and result["confidence"] == 1.0
+    assert result["ids"] == {"dblp": "conf/nips/VaswaniSPUJGKP17", "doi": "10.5555/3295222",
+                             "arxiv": "1706.03762", "ss": "204e3073"}
+    assert result["bibtex"].startswith("@misc{vaswani2017attention,")
+
+
+def test_grace_window():
+    lookup = TitleLookup({"ss_search": source([ss_record]),
+                          "arxiv": source([arxiv_record], 0.2)}, grace=0.5)
+    result = lookup.lookup(title)
+    assert result["status"]["arxiv"]["status"] == "ok"
+    assert result["ids"]["doi"] == "10.48550/arXiv.1706.03762"
+    result = lookup.lookup(title, grace=0)
+    assert result["status"]["arxiv"]["status"] == "late"
+    assert "doi" not in result["ids"]
+
+
+def test_weak_match_ids_not_merged():
+    lookup = TitleLookup({"arxiv": source([other_record]), "ss_search": source([ss_record])})
+    result = lookup.lookup(title)
+    assert result["source"] == "ss_search"
+    assert result["status"]["arxiv"]["confidence"] < 0.8
+    assert result["ids"] == {"ss": "204e3073"}
+
+
+def test_preference_among_equal_matches():
+    lookup = TitleLookup({"arxiv": source([arxiv_record]),
+                          "ss_search": source([{**ss_record, "title": title}])}, grace=0.5)
+    assert lookup.lookup(title)["source"] == "arxiv"
+
+
+def test_no_match():
+    lookup = TitleLookup({"dblp": source([]), "arxiv": source([other_record])})
+    result = lookup.lookup(title)
+    assert result["status"]["dblp"]["status"] == "no_result"
+    # The best match is returned even if it's not good
+    assert result["source"] == "arxiv" and result["confidence"] < 0.8
+    lookup = TitleLookup({"dblp": source([], 1)}, timeout=0.1)
+    result = lookup.lookup(title)
+    assert result["source"] is None and result["ids"] == {}
+    assert result["status"]["dblp"]["status"] == "late"
+
+
+def test_cancelled(monkeypatch):
+    # With one thread the searches after the first wait in the queue
+    monkeypatch.setattr(title_lookup, "scheduler", Scheduler(num_threads=1))
+    release = Event()
+    calls = []
+    lookup = TitleLookup({"dblp": source([dblp_record], calls=calls, name="dblp"),
+                          "ss_search": lambda t: [ss_record] if release.wait(5) else [],
+                          "arxiv": source([arxiv_record], calls=calls, name="arxiv")},
+                         grace=0)
+    result = lookup.lookup(title)
+    release.set()
+    assert result["status"]["dblp"]["status"] == "ok"
+    assert result["status"]["ss_search"]["status"] in {"late", "cancelled"}
+    assert result["status"]["arxiv"]["status"] == "cancelled"
+    time.sleep(0.1)
+    assert calls == ["dblp"]
+
+
+def test_sequential():
+    calls = []
+    lookup = TitleLookup({"dblp": source([], calls=calls, name="dblp"),
+                          "ss_search": source([ss_record], calls=calls, name="ss_search"),
+                          "arxiv": source([arxiv_record], calls=calls, name="arxiv")})
+    result = lookup.lookup(title, sequential=True)
+    assert calls == ["dblp", "ss_search"]
+    assert {k: v["status"] for k, v in result["status"].items()} ==\
+        {"dblp": "no_result", "ss_search": "ok", "arxiv": "skipped"}
+    assert result["source"] == "ss_search"
+
+
+@pytest.mark.parametrize("sequential", [False, True])
+def test_all_errors(sequential):
+    lookup = TitleLookup({"dblp": source([], error="a"), "arxiv": source([], error="b")})
+    result = lookup.lookup(title, sequential=sequential)
+    assert result["source"] is None and result["bibtex"] is None
+    assert [v["status"] for v in result["status"].values()] == ["error", "error"]
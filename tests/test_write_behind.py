@@ -0,0 +1,121 @@
+import os
+import json
+import time
+from threading import Event
+
+import pytest
+
+from ref_man import write_behind
+from ref_man.eviction import compact_metadata
+from ref_man.semantic_scholar import SSCache, read_data, save_data
+from ref_man.write_behind import WriteBehind
+
+
+def _pid(i):
+    return f"{i:040x}"
+
+
+def _paper(i, title="Paper"):
+    return {"paperId": _pid(i), "title": f"{title} {i}", "arxivId": None,
+            "corpusId": i, "doi": f"10.1/{i}"}
+
+
+def _line(i):
+    return f",,{i},10.1/{i},{_pid(i)}"
+
+
+def _metadata(data_dir):
+    with open(os.path.join(data_dir, "metadata")) as f:
+        return f.read().splitlines()
+
+
+def _block(monkeypatch, writer):
+    "Block the writes of `writer` until the returned event is set."
+    started, release = Event(), Event()
+    write = writer._write
+
+    def blocked(data_dir, items):
+        started.set()
+        release.wait(5)
+        write(data_dir, items)
+    monkeypatch.setattr(writer, "_write", blocked)
+    return started, release
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    open(tmp_path / "metadata", "w").close()
+    return str(tmp_path)
+
+
+def test_get_serves_pending(data_dir, monkeypatch):
+    writer = WriteBehind(fsync=False)
+    started, release = _block(monkeypatch, writer)
+    writer.put(data_dir, _paper(1), _line(1))
+    assert started.wait(5)
+    assert writer.get(data_dir, _pid(1)) == _paper(1)
+    assert writer.pending(data_dir) == [_line(1)]
+    assert not os.path.exists(os.path.join(data_dir, _pid(1)))
+    release.set()
+    assert writer.flush(5)
+    assert writer.get(data_dir, _pid(1)) is None
+    assert writer.pending(data_dir) == []
+
+
+def test_put_again_while_writing(data_dir, monkeypatch):
+    writer = WriteBehind(fsync=False)
+    started, release = _block(monkeypatch, writer)
+    writer.put(data_dir, _paper(1), _line(1))
+    assert started.wait(5)
+    writer.put(data_dir, _paper(1, "Updated"), _line(1))
+    release.set()
+    assert writer.flush(5)
+    with open(os.path.join(data_dir, _pid(1))) as f:
+        assert json.load(f)["title"] == "Updated 1"
+    assert writer.stats()["written"] == 2
+    assert _metadata(data_dir) == [_line(1), _line(1)]
+
+
+def test_flush_waits_for_disk(data_dir, monkeypatch):
+    writer = WriteBehind(max_delay=0.1, fsync=True)
+    write = writer._write
+
+    def slow(data_dir, items):
+        time.sleep(0.2)
+        write(data_dir, items)
+    monkeypatch.setattr(writer, "_write", slow)
+    for i in range(10):
+        writer.put(data_dir, _paper(i), _line(i), json.dumps(_paper(i)).encode())
+    assert not writer.flush(0.01)
+    assert writer.flush(5)
+    assert _metadata(data_dir) == [_line(i) for i in range(10)]
+    for i in range(10):
+        with open(os.path.join(data_dir, _pid(i))) as f:
+            assert json.load(f) == _paper(i)
+    assert not [f for f in os.listdir(data_dir) if f.endswith(".tmp")]
+    assert writer.stats()["batches"] == 1
+
+
+def test_reload_keeps_unwritten_ids(data_dir, monkeypatch):
+    with open(os.path.join(data_dir, "metadata"), "w") as f:
+        f.write("".join(_line(i) + "\n" for i in range(5)))
+    cache = SSCache(data_dir)
+    cache.load()
+    started, release = _block(monkeypatch, write_behind.cache_writer)
+    try:
+        save_data(_paper(10), data_dir, cache, "")
+        assert started.wait(5)
+        assert cache["doi"].get("10.1/10") == _pid(10)
+        assert read_data(data_dir, _pid(10)) == _paper(10)
+        # Eviction replaces metadata and the index is loaded again
+        assert compact_metadata(data_dir, {_pid(0)}) == 1
+        cache.refresh()
+        assert cache["doi"].get("10.1/0") is None
+        assert cache["doi"].get("10.1/10") == _pid(10)
+        assert cache["corpus"].get("10") == _pid(10)
+    finally:
+        release.set()
+        assert write_behind.cache_writer.flush(5)
+    assert _metadata(data_dir)[-1] == _line(10)
+    cache.refresh()
+    assert cache["doi"].get("10.1/10") == _pid(10)